@@ -0,0 +1,187 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from features import FeatureSchema
+from solvers import LINKS, Design, LinearFit, as_design
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 2
+
+# Fit statistics copied from statsmodels results when present.
+DIAGNOSTICS = ['nobs', 'df_model', 'df_resid', 'scale', 'llf', 'aic', 'bic',
+               'ssr', 'rsquared', 'deviance', 'pearson_chi2', 'converged']
+
+
+class ModelArtifact:
+    """
+    Everything needed to score a fitted linear model or GLM: coefficients,
+    link and variance function, the feature schema and fit diagnostics.
+
+    Unlike a pickled statsmodels results object it holds no reference to
+    the training data. It is saved as one small `.npz` file, the arrays
+    alongside a versioned JSON header with the schema and its fingerprint,
+    and loads without importing statsmodels. Predictions repeat the
+    statsmodels arithmetic, so they are bit-identical to those of the
+    fitted model.
+    """
+
+    def __init__(self,
+                 params: np.ndarray,
+                 names: List[str],
+                 link: str = 'identity',
+                 variance: str = 'gaussian',
+                 bse: Optional[np.ndarray] = None,
+                 diagnostics: Optional[Dict[str, object]] = None,
+                 schema: Optional[FeatureSchema] = None) -> None:
+        self.params = np.asarray(params, dtype=np.float64)
+        self.names = names
+        self.link = link
+        self.variance = variance
+        self.bse = bse
+        self.diagnostics = diagnostics or {}
+        self.schema = schema
+
+    @classmethod
+    def from_results(cls,
+                     results: Any,
+                     schema: Optional[FeatureSchema] = None
+                     ) -> 'ModelArtifact':
+        """
+        Extract an artifact from a `LinearFit` or statsmodels OLS, WLS or
+        GLM results.
+        """
+        if isinstance(results, LinearFit):
+            names = results.names or [f'x{i}'
+                                      for i in range(len(results.params))]
+            diagnostics = {'deviance': results.deviance,
+                           'iterations': results.iterations,
+                           'converged': results.converged}
+            return cls(results.params, names, results.link,
+                       results.variance, None, diagnostics, schema)
+
+        family = getattr(results.model, 'family', None)
+        if family is None:
+            link, variance = 'identity', 'gaussian'
+        else:
+            link = type(family.link).__name__.lower()
+            variance = type(family).__name__.lower()
+        if link not in LINKS:
+            raise ValueError(f'Unsupported link function {link}')
+        diagnostics = {}
+        for name in DIAGNOSTICS:
+            try:
+                value = getattr(results, name)
+            except (AttributeError, NotImplementedError, ValueError):
+                continue
+            if np.ndim(value) == 0:
+                diagnostics[name] = _scalar(value)
+        return cls(np.asarray(results.params),
+                   [str(name) for name in results.model.exog_names],
+                   link, variance, np.asarray(results.bse), diagnostics,
+                   schema)
+
+    def predict(self,
+                exog: Union[pd.DataFrame, Design]
+                ) -> Union[pd.Series, np.ndarray]:
+        """
+        Predict the mean response. A DataFrame, dense or sparse, gives a
+        Series on the same index.
+        """
+        X = as_design(exog) if isinstance(exog, pd.DataFrame) else exog
+        _, inverse, _ = LINKS[self.link]
+        if sp.issparse(X):
+            mu = inverse(X @ self.params)
+        else:
+            mu = inverse(np.dot(X, self.params))
+        if isinstance(exog, pd.DataFrame):
+            return pd.Series(mu, index=exog.index)
+        return mu
+
+    def score(self, policies: pd.DataFrame) -> pd.Series:
+        """
+        Encode raw policies with the stored schema and predict.
+        """
+        if self.schema is None:
+            raise ValueError('Artifact has no feature schema to score with')
+        return self.predict(self.schema.transform_frame(policies))
+
+    def summary_text(self) -> str:
+        lines = [f'Family: {self.variance}, link: {self.link}']
+        lines.extend(f'{name}: {value}'
+                     for name, value in self.diagnostics.items())
+        lines.append('')
+        bse = self.bse if self.bse is not None else [np.nan] * len(self.names)
+        lines.append(f'{"":<30}{"coef":>14}{"std err":>14}')
+        lines.extend(f'{name:<30}{param:>14.6g}{err:>14.6g}'
+                     for name, param, err in zip(self.names, self.params, bse))
+        return '\n'.join(lines)
+
+    def to_dict(self) -> Dict[str, object]:
+        schema = fingerprint = None
+        if self.schema is not None:
+            schema = self.schema.to_dict()
+            fingerprint = self.schema.fingerprint()
+        return {
+            'version': ARTIFACT_VERSION,
+            'names': self.names,
+            'link': self.link,
+            'variance': self.variance,
+            'diagnostics': self.diagnostics,
+            'schema': schema,
+            'schema_fingerprint': fingerprint,
+        }
+
+    def save(self, path: str) -> None:
+        arrays = {'params': self.params}
+        if self.bse is not None:
+            arrays['bse'] = np.asarray(self.bse, dtype=np.float64)
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(self.to_dict())), **arrays)
+
+    @classmethod
+    def load(cls,
+             path: str,
+             schema: Optional[Union[FeatureSchema, str]] = None
+             ) -> 'ModelArtifact':
+        """
+        Load a saved artifact. With `schema`, the scoring feature schema or
+        its fingerprint, an artifact fitted with another schema is rejected,
+        as its coefficients would be applied to the wrong columns.
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            if meta.get('version') != ARTIFACT_VERSION:
+                raise ValueError(
+                    f'Unsupported model artifact version {meta.get("version")}'
+                )
+            params = arrays['params']
+            bse = arrays['bse'] if 'bse' in arrays.files else None
+        stored = meta['schema']
+        fingerprint = None
+        if stored is not None:
+            stored = FeatureSchema.from_dict(stored)
+            fingerprint = stored.fingerprint()
+            if fingerprint != meta['schema_fingerprint']:
+                raise ValueError('Model artifact schema does not match its '
+                                 'fingerprint')
+        if schema is not None:
+            if isinstance(schema, FeatureSchema):
+                schema = schema.fingerprint()
+            if fingerprint != schema:
+                raise ValueError('Model artifact was fitted with another '
+                                 'feature schema')
+        return cls(params, meta['names'], meta['link'], meta['variance'],
+                   bse, meta['diagnostics'], stored)
+
+
+def _scalar(value: Any) -> Optional[Union[float, int, bool]]:
+    value = np.asarray(value).item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
@@ -0,0 +1,286 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from build import run_models
+from features import FeatureSchema, aggregate_claims, unique_policies
+import instrument
+from instrument import span
+from loader import SOURCE_FILES, SOURCE_PATH, LocalBucket, read_frame
+from models import MLM_ENGINES, build_mlm
+from synthetic import BOOK_FILES, expected, write_book
+
+logger = logging.getLogger(__name__)
+
+# Book sizes of the default pipeline suite.
+SUITE_SIZES = [10000, 100000, 1000000]
+
+
+def benchmark_mlm(policies: pd.DataFrame,
+                  claims: pd.DataFrame,
+                  engines: Optional[List[str]] = None,
+                  holdout: float = 0.2,
+                  seed: int = 42) -> pd.DataFrame:
+    """
+    Fit the frequency and severity model of each ML engine on the same
+    training split and report fit time, peak memory and holdout MSE. Each
+    fit runs in a fresh process, whose peak RSS covers the native buffers
+    of the tree builders as well as Python and numpy allocations.
+
+    Severity is the average claim given a claim, so, as in the build,
+    every engine is trained and scored on the policies with a claim only.
+    """
+    schema = FeatureSchema.fit(policies)
+    features = unique_policies(schema.transform_frame(policies))
+    targets = aggregate_claims(features, claims)
+
+    rng = np.random.default_rng(seed)
+    test = pd.Series(rng.random(len(features)) < holdout,
+                     index=features.index)
+    splits = {
+        'freq': targets.counts,
+        'sev': targets.averages,
+    }
+
+    rows = []
+    for engine in engines or list(MLM_ENGINES):
+        _, freq_loss, sev_loss = MLM_ENGINES[engine]
+        for target, loss in (('freq', freq_loss), ('sev', sev_loss)):
+            dep = splits[target]
+            indep = features.loc[dep.index]
+            score = test.loc[dep.index].to_numpy()
+            logger.info(f'Fit {engine} {target} model with {loss} loss.')
+            row = _time_fit(engine, loss, dep[~score], indep[~score],
+                            indep[score])
+            observed = dep[score].to_numpy()
+            predicted = row.pop('predicted')
+            row.update(engine=engine, target=target, loss=loss,
+                       mse=float(np.mean((observed - predicted) ** 2)))
+            rows.append(row)
+    return pd.DataFrame(rows).set_index(['engine', 'target'])
+
+
+def _time_fit(engine: str,
+              loss: str,
+              dep: pd.Series,
+              indep: pd.DataFrame,
+              testing: pd.DataFrame) -> Dict[str, object]:
+    """
+    Fit a model and predict `testing` in a freshly spawned process, which
+    shares no pages with this one, and return the fit time, the peak RSS
+    of the process and its growth during the fit, and the predictions.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_fit_in_process, engine, loss, dep, indep,
+                           testing).result()
+
+
+def _fit_in_process(engine: str,
+                    loss: str,
+                    dep: pd.Series,
+                    indep: pd.DataFrame,
+                    testing: pd.DataFrame) -> Dict[str, object]:
+    # The peak RSS of this process alone, as RUSAGE_CHILDREN would report
+    # it to the parent if this were its only child.
+    baseline = _max_rss(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    model = build_mlm(dep, indep, engine=engine, loss=loss)
+    seconds = time.perf_counter() - start
+    peak = _max_rss(resource.RUSAGE_SELF)
+    return {'fit_seconds': seconds,
+            'peak_rss_mib': peak,
+            'peak_rss_delta_mib': peak - baseline,
+            'predicted': np.asarray(model.predict(testing))}
+
+
+def benchmark_pipeline(root: str,
+                       mlm_engine: str = 'forest',
+                       compress: bool = False,
+                       sparse: bool = False,
+                       trace: Optional[str] = None,
+                       upload: bool = True) -> Dict[str, float]:
+    """
+    Run every stage of the model build against the local bucket at `root`
+    and return the wall time of each stage and of each worker's fits, the
+    peak RSS of this process and of the pool workers, and each model's
+    MSE against the true means of a synthetic test book.
+
+    The models are built by `build.run_models`, the code the build runs.
+    Stages are timed with `instrument` spans, written to `trace` if given
+    and otherwise to a temporary file; each fit is timed by the span of
+    the worker running it. With `upload`, the results are stored in the
+    bucket as by the build, and the upload is timed too.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        trace = trace or os.path.join(tmp, 'trace.jsonl')
+        instrument.configure(trace)
+        try:
+            results, test, n_rows = _run_pipeline(root, mlm_engine,
+                                                  compress, sparse, upload)
+        finally:
+            instrument.disable()
+        stats = _durations(instrument.read_spans(trace))
+
+    stats['policies'], stats['claims'] = n_rows
+    stats['peak_rss_mib'] = _max_rss(resource.RUSAGE_SELF)
+    stats['peak_worker_rss_mib'] = _max_rss(resource.RUSAGE_CHILDREN)
+    truth = expected(test)
+    for kind, res in results.items():
+        for col in truth.columns:
+            error = res[col].to_numpy() - truth[col].to_numpy()
+            stats[f'mse_{kind}_{col}'] = float(np.mean(error ** 2))
+    return stats
+
+
+def _run_pipeline(root: str,
+                  mlm_engine: str,
+                  compress: bool,
+                  sparse: bool,
+                  upload: bool
+                  ) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame,
+                             Tuple[int, int]]:
+    bucket = LocalBucket(root)
+    with span('total'):
+        with span('load'):
+            policies, claims, test = (
+                read_frame(_source_blob(bucket, name))
+                for name in ('policies', 'claims', 'test')
+            )
+        with span('build_features', rows=len(policies)):
+            schema = FeatureSchema.fit(policies)
+            features = schema.transform_frame(policies, sparse)
+            testing = schema.transform_frame(test, sparse)
+        results = run_models(features, claims, testing, bucket, compress,
+                             mlm_engine, schema, upload=upload)
+    return results, test, (len(policies), len(claims))
+
+
+def _source_blob(bucket: LocalBucket, name: str):
+    """
+    The blob of a source file: the Parquet file of a synthetic book if
+    there is one, otherwise the pickle of a copy of the project bucket.
+    """
+    blob = bucket.blob(f'{SOURCE_PATH}/{BOOK_FILES[name]}')
+    if blob.exists():
+        return blob
+    return bucket.blob(f'{SOURCE_PATH}/{SOURCE_FILES[name]}')
+
+
+def _durations(spans: List[instrument.Record]) -> Dict[str, float]:
+    """
+    Total duration per span name, keyed by model as well for the spans
+    of one model, such as the worker fits.
+    """
+    durations = {}
+    for record in spans:
+        name = record['name']
+        if record.get('model'):
+            name = f'{name}[{record["model"]}]'
+        durations[name] = durations.get(name, 0.0) + record['duration']
+    return durations
+
+
+def run_suite(sizes: List[int],
+              work_dir: str,
+              mlm_engine: str = 'forest',
+              compress: bool = False,
+              seed: int = 0) -> pd.DataFrame:
+    """
+    Benchmark the pipeline on synthetic books of each size. Books are
+    written once under `work_dir` and reused by later runs. Each size runs
+    in a fresh interpreter, so the peak RSS is that of the size alone.
+    """
+    rows = []
+    for size in sizes:
+        root = os.path.join(work_dir, f'book-{size}-{seed}')
+        if not os.path.isdir(root):
+            write_book(root, size, seed=seed)
+        with tempfile.TemporaryDirectory() as cwd:
+            # Model logs and result copies are written to the working
+            # directory, which is discarded after the run.
+            command = [sys.executable, os.path.abspath(__file__),
+                       'pipeline', root, '--mlm-engine', mlm_engine]
+            if compress:
+                command.append('--compress')
+            output = subprocess.run(command, cwd=cwd, check=True,
+                                    stdout=subprocess.PIPE, text=True).stdout
+        rows.append(json.loads(output.splitlines()[-1]))
+    return pd.DataFrame(rows).set_index('policies')
+
+
+def _max_rss(who: int) -> float:
+    # Linux reports ru_maxrss in KiB.
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bedrock models offline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    mlm = commands.add_parser(
+        'mlm', help='compare the ML engines on a local copy of the data')
+    mlm.add_argument('root', help='directory holding the source files')
+    mlm.add_argument('--policies', default='train_policies.pkl')
+    mlm.add_argument('--claims', default='train_claims.pkl')
+    mlm.add_argument('--engine', action='append', choices=MLM_ENGINES,
+                     help='engine to run; defaults to all')
+
+    pipeline = commands.add_parser(
+        'pipeline', help='time every stage against one local bucket')
+    pipeline.add_argument('root', help='local bucket root')
+    pipeline.add_argument('--trace', help='keep the spans in this file')
+    pipeline.add_argument('--no-upload', dest='upload', action='store_false',
+                          help='do not store the results in the bucket')
+
+    suite = commands.add_parser(
+        'suite', help='run the pipeline benchmark on synthetic books')
+    suite.add_argument('work_dir', help='directory for the synthetic books')
+    suite.add_argument('--size', type=int, action='append',
+                       help=f'policies per book; defaults to {SUITE_SIZES}')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--out', help='append the results as JSON lines')
+
+    for command in (pipeline, suite):
+        command.add_argument('--mlm-engine', default='forest',
+                             choices=MLM_ENGINES)
+        command.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s: %(message)s')
+    if args.command == 'mlm':
+        bucket = LocalBucket(args.root)
+        policies = read_frame(bucket.blob(args.policies))
+        claims = read_frame(bucket.blob(args.claims))
+        print(benchmark_mlm(policies, claims, args.engine).to_string())
+    elif args.command == 'pipeline':
+        stats = benchmark_pipeline(args.root, args.mlm_engine,
+                                   args.compress, trace=args.trace,
+                                   upload=args.upload)
+        print(json.dumps(stats))
+    else:
+        results = run_suite(args.size or SUITE_SIZES, args.work_dir,
+                            args.mlm_engine, args.compress, args.seed)
+        if args.out:
+            with open(args.out, 'a') as f:
+                f.write(results.reset_index().to_json(orient='records',
+                                                      lines=True))
+        print(results.T.to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,29 @@
-import io
+import contextlib
 import json
 import logging
-import pickle
-from typing import Dict
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Optional, Tuple
 
 from google.cloud import storage
 import pandas as pd
 import pkg_resources
 
-from features import build_features, get_claim_amounts, get_claim_counts
-from models import evaluate_glm, evaluate_mlm, evaluate_slm
+from cache import DEFAULT_MAX_BYTES, BlobCache
+from features import FeatureSchema, aggregate_claims, unique_policies
+from loader import (SOURCE_FILES, SOURCE_PATH, Frames, LocalBucket,
+                    read_frame, store_results)
+from executor import ModelExecutor
+import instrument
+from instrument import span
+from models import submit_glm, submit_mlm, submit_slm
+from scoring import RatingModel
+from streaming import run_streaming_models
 
 CONFIG_PATH = 'config.json'
 
-SOURCE_PATH = 'bedrock'
-SOURCE_FILES = {
-    'policies': 'train_policies.pkl',
-    'claims': 'train_claims.pkl',
-    'test': 'test_policies.pkl'
-}
-SUBMISSION_PATH = 'submissions'
-SUBMISSION_FILES = {
-    'slm': 'astrange-LM-01Vanilla.pkl',
-    'glm': 'astrange-GLM-01Vanilla.pkl',
-    'mlm': 'astrange-ML-01Vanilla.pkl'
-}
+# Part of the cache key for feature frames; bump when the encoding changes.
+FEATURE_VERSION = '4'
 
 logging.basicConfig(
     level=logging.INFO,
@@ -39,70 +38,199 @@ def _load_config() -> Dict[str, str]:
         return json.load(f)
 
 
-def _get_pickle_file(path: str,
-                     client: storage.Client,
-                     bucket: str) -> pd.DataFrame:
+def _get_cache(config: Dict[str, str]) -> Optional[BlobCache]:
     """
-    Retrieve a pickle file from the target GCS bucket and convert to
-    DataFrame.
+    Build the local data cache if the config names a `cache_dir`.
+    """
+    if not config.get('cache_dir'):
+        return None
+    max_bytes = int(config.get('cache_max_bytes', DEFAULT_MAX_BYTES))
+    return BlobCache(config['cache_dir'], max_bytes)
+
+
+def _get_bucket(config: Dict[str, str]) -> storage.Bucket:
+    """
+    Fetch the bucket handle shared by every transfer in a run. A
+    `local_bucket` directory in the config replaces GCS for offline runs.
+    """
+    if config.get('local_bucket'):
+        return LocalBucket(config['local_bucket'])
+    client = storage.Client(project=config['project'])
+    return client.get_bucket(config['bucket'])
+
+
+def _get_source_file(path: str,
+                     bucket: storage.Bucket,
+                     batch_size: Optional[int] = None,
+                     cache: Optional[BlobCache] = None) -> Frames:
+    """
+    Stream a source file (pickle, Parquet or Arrow) from the target GCS
+    bucket into a DataFrame, or an iterator of DataFrames of `batch_size`
+    rows. With a cache the blob is only transferred when it has changed.
     """
     logger.info(f'Download {path}')
-    path = '/'.join([SOURCE_PATH, path])
-    bucket = client.get_bucket(bucket)
-    blob = bucket.blob(path)
-    df_io = io.BytesIO()
-    blob.download_to_file(df_io)
-    df_io.seek(0)
-    df = pickle.load(df_io)
-    df_io.close()
-    return df
-
-
-def _store_pickle_file(df: pd.DataFrame,
-                       name: str,
-                       client: storage.Client,
-                       bucket: str) -> None:
-    logger.info(f'Upload {name}')
-    filename = SUBMISSION_FILES.get(name)
-    path = '/'.join([SOURCE_PATH, SUBMISSION_PATH, filename])
-    bucket = client.get_bucket(bucket)
-    blob = bucket.blob(path)
-    df_io = io.BytesIO()
-    pickle.dump(df, df_io)
-    df_io.seek(0)
-    blob.upload_from_file(df_io)
-    df_io.close()
+    with span('read_source', file=path) as stage:
+        blob = bucket.blob('/'.join([SOURCE_PATH, path]))
+        if cache is None:
+            frames = read_frame(blob, batch_size)
+        elif batch_size is None:
+            with cache.use(blob) as local:
+                frames = read_frame(local)
+        else:
+            frames = _read_cached(cache, blob, batch_size)
+        if isinstance(frames, pd.DataFrame):
+            stage.set(rows=len(frames))
+    return frames
+
+
+def _read_cached(cache: BlobCache,
+                 blob: storage.Blob,
+                 batch_size: int) -> Iterator[pd.DataFrame]:
+    # The local copy is kept from eviction until every batch is read.
+    with cache.use(blob) as local:
+        yield from read_frame(local, batch_size)
+
+
+def _get_features(path: str,
+                  bucket: storage.Bucket,
+                  cache: Optional[BlobCache] = None,
+                  schema: Optional[FeatureSchema] = None,
+                  sparse: bool = False
+                  ) -> Tuple[pd.DataFrame, FeatureSchema]:
+    """
+    Retrieve a policy file and build its feature frame, fitting a feature
+    schema on it unless one is given. With `sparse` the frame holds sparse
+    columns and the linear models are fitted on a CSR design.
+
+    With a cache, the schema and features are stored against the content
+    key of the source blob and the features are memory-mapped on later
+    runs, skipping the download, unpickle and feature build.
+    """
+    if cache is None:
+        source = _get_source_file(path, bucket)
+        with span('build_features', file=path, rows=len(source)):
+            schema = schema or FeatureSchema.fit(source)
+            return schema.transform_frame(source, sparse), schema
+
+    source = None
+    blob_key = cache.key(bucket.blob('/'.join([SOURCE_PATH, path])))
+    if schema is None:
+        schema_key = cache.frame_key(blob_key, 'schema', FEATURE_VERSION)
+        stored = cache.get_object(schema_key)
+        if stored is None:
+            source = _get_source_file(path, bucket, cache=cache)
+            schema = FeatureSchema.fit(source)
+            cache.put_object(schema_key, schema.to_dict())
+        else:
+            schema = FeatureSchema.from_dict(stored)
+
+    key = cache.frame_key(blob_key, 'features', FEATURE_VERSION,
+                          schema.fingerprint(), str(sparse))
+    features = cache.get_frame(key)
+    if features is None:
+        if source is None:
+            source = _get_source_file(path, bucket, cache=cache)
+        with span('build_features', file=path, rows=len(source)):
+            features = schema.transform_frame(source, sparse)
+        cache.put_frame(key, features)
+    return features, schema
 
 
 def run_models(policies: pd.DataFrame,
                claims: pd.DataFrame,
                testing: pd.DataFrame,
-               config: Dict[str, str]) -> None:
+               bucket: storage.Bucket,
+               compress: bool = False,
+               mlm_engine: str = 'forest',
+               schema: Optional[FeatureSchema] = None,
+               tables: bool = False,
+               upload: bool = True) -> Dict[str, pd.DataFrame]:
     """
     With the loaded datasets, run the complete process of model building
-    for each of SLM, GLM and MLM.
+    for each of SLM, GLM and MLM, and return the test set predictions of
+    each. `policies` and `testing` are the feature frames encoded with
+    `schema`. With `compress` the SLM and GLM are fitted on the unique
+    rating cells. `mlm_engine` picks the ML model from
+    `models.MLM_ENGINES`. The predictions are stored in the bucket unless
+    `upload` is off. The linear models and GLMs are saved as compact
+    artifacts, and with `tables` every model is also exported as a rating
+    table for batch scoring.
     """
-    logging.info('Build features.')
-    policies = build_features(policies)
-    testing = build_features(testing)
-    grouped = claims.groupby('pol_id')
+    with span('aggregate_claims', rows=len(claims)):
+        policies = unique_policies(policies)
+        targets = aggregate_claims(policies, claims)
+        counts, averages = targets.counts, targets.averages
 
-    # Currently compute both averages and totals.
-    averages, totals = get_claim_amounts(policies, grouped)
-    counts = get_claim_counts(policies, grouped)
+    # All six fits run at once on one pool. The features and targets are
+    # placed in shared memory once rather than pickled to every task.
+    with ModelExecutor() as executor:
+        with span('share', rows=len(policies)):
+            policies = executor.share(policies)
+            testing = executor.share(testing)
+            counts = executor.share(counts)
+            averages = executor.share(averages)
+        with span('fit_models', engine=mlm_engine, compress=compress):
+            pending = {
+                'slm': submit_slm(policies, counts, averages, testing,
+                                  compress, executor, tables),
+                'glm': submit_glm(policies, counts, averages, testing,
+                                  compress, executor, tables),
+                'mlm': submit_mlm(policies, counts, averages, testing,
+                                  executor, mlm_engine, tables),
+            }
+            results = {name: model.result()
+                       for name, model in pending.items()}
 
-    res_slm = evaluate_slm(policies, counts, averages, testing)
-    res_glm = evaluate_glm(policies, counts, averages, testing)
-    res_mlm = evaluate_mlm(policies, counts, averages, testing)
+    # The predictions are stored first, so nothing is lost if an export
+    # fails.
+    if upload:
+        store_results(results, bucket)
+    with span('export', tables=tables):
+        for name, model in pending.items():
+            for part, artifact in model.artifacts().items():
+                if artifact is not None:
+                    artifact.schema = schema
+                    artifact.save(f'{name}_{part}.npz')
+            if tables:
+                built = {target: table
+                         for target, table in model.tables().items()
+                         if table is not None}
+                if not built:
+                    logger.warning(f'No rating table of {name} to export.')
+                    continue
+                logger.info(f'Export {name} rating table.')
+                RatingModel(schema, built).save(f'{name}_rating.npz')
+    return results
 
-    client = storage.Client(project=config['project'])
-    _store_pickle_file(res_slm, 'slm', client, config['bucket'])
-    _store_pickle_file(res_glm, 'glm', client, config['bucket'])
-    _store_pickle_file(res_mlm, 'mlm', client, config['bucket'])
 
-    res_slm.to_csv('slm.csv', encoding='utf-8')
-    res_glm.to_csv('glm.csv', encoding='utf-8')
-    res_mlm.to_csv('mlm.csv', encoding='utf-8')
+def run_streaming(bucket: storage.Bucket,
+                  cache: Optional[BlobCache],
+                  batch_size: int,
+                  sparse: bool = False) -> None:
+    """
+    Build every model out of core, streaming the policy files in chunks of
+    `batch_size` rows. The GLM fits re-read the policies on every IRLS
+    pass, up to 100 per model, so the policy and test files are held in
+    the cache, or a temporary one without `cache_dir`, for the whole run.
+    A pickled source is converted to Parquet there once, and every pass
+    streams the Parquet copy, so memory stays constant in the number of
+    policies after that first load.
+    """
+    with contextlib.ExitStack() as stack:
+        if cache is None:
+            cache = BlobCache(stack.enter_context(
+                tempfile.TemporaryDirectory(suffix='.cache')))
+
+        def source(name: str) -> Callable[[], Iterator[pd.DataFrame]]:
+            blob = bucket.blob('/'.join([SOURCE_PATH, SOURCE_FILES[name]]))
+            with span('read_source', file=SOURCE_FILES[name]):
+                local = stack.enter_context(cache.use_columnar(blob))
+            return lambda: read_frame(local, batch_size)
+
+        claims = _get_source_file(SOURCE_FILES['claims'], bucket, cache=cache)
+        results = run_streaming_models(source('policies'), claims,
+                                       source('test'), sparse)
+    store_results(results, bucket)
 
 
 def main() -> None:
@@ -119,19 +247,46 @@ def main() -> None:
             Store results on GCS/GDrive
     """
     config = _load_config()
-    client = storage.Client(project=config['project'])
+    if config.get('trace'):
+        instrument.configure(config['trace'])
+    bucket = _get_bucket(config)
+    cache = _get_cache(config)
+    sparse = bool(config.get('sparse', False))
+
+    if config.get('batch_size'):
+        run_streaming(bucket, cache, int(config['batch_size']), sparse)
+        return
+
+    # All three files are fetched at once, so the download time is that of
+    # the largest file rather than the sum of all three.
+    logger.info('Download source files and build features.')
+    with ThreadPoolExecutor(max_workers=len(SOURCE_FILES)) as executor:
+        policies = executor.submit(_get_features,
+                                   SOURCE_FILES['policies'], bucket, cache,
+                                   sparse=sparse)
+        claims = executor.submit(_get_source_file,
+                                 SOURCE_FILES['claims'], bucket, cache=cache)
+        if cache is None:
+            test = executor.submit(_get_source_file,
+                                   SOURCE_FILES['test'], bucket)
+        else:
+            test_path = '/'.join([SOURCE_PATH, SOURCE_FILES['test']])
+            test = executor.submit(cache.fetch, bucket.blob(test_path))
+
+        # The test set is encoded with the schema fitted on the training
+        # set so both share the same feature columns.
+        policies, schema = policies.result()
+        if cache is None:
+            test = schema.transform_frame(test.result(), sparse)
+        else:
+            test.result()
+            test, _ = _get_features(SOURCE_FILES['test'], bucket, cache,
+                                    schema, sparse)
 
-    policies = _get_pickle_file(SOURCE_FILES['policies'],
-                                client,
-                                config['bucket'])
-    claims = _get_pickle_file(SOURCE_FILES['claims'],
-                              client,
-                              config['bucket'])
-    test = _get_pickle_file(SOURCE_FILES['test'],
-                            client,
-                            config['bucket'])
-
-    run_models(policies, claims, test, config)
+    run_models(policies, claims.result(), test, bucket,
+               bool(config.get('compress', False)),
+               config.get('mlm_engine', 'forest'),
+               schema, bool(config.get('rating_tables', False)))
 
 
 if __name__ == '__main__':
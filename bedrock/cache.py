@@ -0,0 +1,267 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from features import sparse_frame
+from loader import (LocalBlob, LocalBucket, is_columnar, read_frame,
+                    write_parquet)
+from solvers import as_design, is_sparse_frame
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+BLOB_DIR = 'blobs'
+FRAME_DIR = 'frames'
+
+# Rows per row group of a pickle converted to Parquet.
+CONVERT_ROWS = 100000
+
+
+class BlobCache:
+    """
+    Size-bounded, content-addressed cache of bucket blobs and the numeric
+    frames derived from them.
+
+    Blobs are keyed on their generation and MD5 hash, so a changed source
+    file is fetched again while an unchanged one never leaves the local
+    disk. Derived frames are stored as `.npy` files and memory-mapped on
+    load, or as `.npz` CSR matrices when sparse. Every write goes through a
+    temporary path and a rename, and the least recently used entries are
+    evicted once the cache exceeds `max_bytes`. Blobs held through `use`
+    are never evicted while they are being read.
+    """
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, BLOB_DIR), exist_ok=True)
+        os.makedirs(os.path.join(root, FRAME_DIR), exist_ok=True)
+        self._blobs = LocalBucket(os.path.join(root, BLOB_DIR))
+        # Paths of blobs being read, with the number of readers of each.
+        self._in_use: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def key(self, blob) -> str:
+        """
+        Content key for a blob, taken from its generation and MD5 hash.
+        """
+        blob.reload()
+        ident = '#'.join([str(blob.bucket.name),
+                          blob.name,
+                          str(blob.generation),
+                          str(getattr(blob, 'md5_hash', None))])
+        return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+    def fetch(self, blob) -> LocalBlob:
+        """
+        Return a local copy of `blob`, downloading it only on a cache miss.
+        The copy survives the eviction that follows its own download, but
+        not later ones: read it inside `use` instead when other threads
+        fill the cache at the same time.
+        """
+        with self.use(blob) as cached:
+            return cached
+
+    @contextlib.contextmanager
+    def use(self, blob) -> Iterator[LocalBlob]:
+        """
+        Fetch `blob` as `fetch` does and keep the local copy out of eviction
+        until the block exits.
+        """
+        _, ext = os.path.splitext(blob.name)
+        cached = self._blobs.blob(self.key(blob) + ext)
+        self._pin(cached.path, 1)
+        try:
+            if cached.exists():
+                logger.info(f'Cache hit for {blob.name}')
+                _touch(cached.path)
+            else:
+                logger.info(f'Cache miss for {blob.name}')
+                self._download(blob, cached.path)
+                self.evict()
+            yield cached
+        finally:
+            self._pin(cached.path, -1)
+
+    @contextlib.contextmanager
+    def use_columnar(self, blob,
+                     batch_size: int = CONVERT_ROWS) -> Iterator[LocalBlob]:
+        """
+        Hold a local copy of `blob` that can be read in batches, as `use`
+        does. A pickle is converted to Parquet once, `batch_size` rows to a
+        row group, and the Parquet copy is kept under the same content key,
+        so later reads stream it without unpickling the whole file.
+        """
+        with self.use(blob) as cached:
+            if is_columnar(cached.name):
+                yield cached
+                return
+            root, _ = os.path.splitext(cached.name)
+            columnar = self._blobs.blob(root + '.parquet')
+            self._pin(columnar.path, 1)
+            try:
+                if columnar.exists():
+                    _touch(columnar.path)
+                else:
+                    logger.info(f'Convert {blob.name} to Parquet')
+                    write_parquet(read_frame(cached, batch_size),
+                                  columnar.path)
+                    self.evict()
+                yield columnar
+            finally:
+                self._pin(columnar.path, -1)
+
+    def get_frame(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Load a cached numeric frame, memory-mapping its values, or return
+        None on a miss.
+        """
+        path = self._frame_path(key)
+        if not os.path.isdir(path):
+            return None
+        _touch(path)
+        with open(os.path.join(path, 'columns.json'), 'r') as f:
+            meta = json.load(f)
+        index = np.load(os.path.join(path, 'index.npy'))
+        index = pd.Index(index, name=meta['index'])
+        if meta.get('sparse'):
+            values = sp.load_npz(os.path.join(path, 'values.npz'))
+            return sparse_frame(values, index, meta['columns'])
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        return pd.DataFrame(values, index=index, columns=meta['columns'],
+                            copy=False)
+
+    def put_frame(self, key: str, df: pd.DataFrame) -> None:
+        """
+        Store a frame with a single numeric dtype under `key`. Its values
+        are written as one matrix, in CSR form for a sparse frame.
+        """
+        path = self._frame_path(key)
+        if os.path.isdir(path):
+            return
+        sparse = is_sparse_frame(df)
+        tmp_path = tempfile.mkdtemp(dir=self.root, suffix='.tmp')
+        try:
+            if sparse:
+                sp.save_npz(os.path.join(tmp_path, 'values.npz'),
+                            as_design(df))
+            else:
+                np.save(os.path.join(tmp_path, 'values.npy'),
+                        np.ascontiguousarray(df.to_numpy()))
+            np.save(os.path.join(tmp_path, 'index.npy'),
+                    df.index.to_numpy())
+            with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+                json.dump({'index': df.index.name,
+                           'columns': [str(c) for c in df.columns],
+                           'sparse': sparse}, f)
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same frame first.
+            if not os.path.isdir(path):
+                raise
+        finally:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+        self.evict()
+
+    def get_object(self, key: str) -> Optional[Dict[str, object]]:
+        """
+        Load a cached JSON object, or return None on a miss.
+        """
+        path = self._frame_path(key) + '.json'
+        if not os.path.isfile(path):
+            return None
+        _touch(path)
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def put_object(self, key: str, data: Dict[str, object]) -> None:
+        """
+        Store a JSON-serialisable object under `key`.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._frame_path(key) + '.json')
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def frame_key(self, *parts: str) -> str:
+        return hashlib.sha256('#'.join(parts).encode('utf-8')).hexdigest()
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries until the cache fits within
+        `max_bytes`. Blobs in use are skipped, so the cache may stay over
+        its limit while a blob larger than `max_bytes` is being read.
+        """
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with self._lock:
+                if path in self._in_use:
+                    continue
+                logger.info(f'Evict {path} from cache')
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    # A concurrent fetch may already have evicted this entry.
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+            total -= size
+
+    def _download(self, blob, path: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                blob.download_to_file(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _pin(self, path: str, readers: int) -> None:
+        with self._lock:
+            count = self._in_use.get(path, 0) + readers
+            if count:
+                self._in_use[path] = count
+            else:
+                del self._in_use[path]
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        entries = []
+        for sub in (BLOB_DIR, FRAME_DIR):
+            directory = os.path.join(self.root, sub)
+            for entry in os.scandir(directory):
+                try:
+                    if entry.is_dir():
+                        size = sum(f.stat().st_size
+                                   for f in os.scandir(entry.path))
+                    else:
+                        size = entry.stat().st_size
+                    entries.append((entry.stat().st_mtime, entry.path, size))
+                except FileNotFoundError:
+                    continue
+        return entries
+
+    def _frame_path(self, key: str) -> str:
+        return os.path.join(self.root, FRAME_DIR, key)
+
+
+def _touch(path: str) -> None:
+    os.utime(path, None)
@@ -0,0 +1,190 @@
+import logging
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from solvers import is_sparse_frame
+
+logger = logging.getLogger(__name__)
+
+# Shared memory blocks attached by this process, kept open for its
+# lifetime so the arrays viewing them stay valid.
+_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+# Threads each fit in this process may use, set in pool workers to their
+# share of the cores. None outside a pool, where a fit may use them all.
+_threads: Optional[int] = None
+
+# Fits submitted by a run: frequency and severity of each of three models.
+# A larger pool would leave its extra workers idle and their cores unused.
+RUN_FITS = 6
+
+
+class SharedArray:
+    """
+    Picklable handle to a numpy array held in shared memory. Only the
+    block name, shape and dtype cross the process boundary.
+    """
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str) -> None:
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @classmethod
+    def create(cls, array: np.ndarray) -> Tuple['SharedArray',
+                                                shared_memory.SharedMemory]:
+        array = np.asarray(array)
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        return cls(block.name, array.shape, array.dtype.str), block
+
+    def attach(self) -> np.ndarray:
+        block = _ATTACHED.get(self.name)
+        if block is None:
+            block = _open_block(self.name)
+            _ATTACHED[self.name] = block
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+
+
+class SharedFrame:
+    """
+    Picklable handle to a dense DataFrame or Series whose values and index
+    live in shared memory, so worker processes attach to it without a copy.
+    """
+
+    def __init__(self,
+                 values: SharedArray,
+                 index: SharedArray,
+                 index_name: Optional[str],
+                 columns: Optional[List[str]]) -> None:
+        self.values = values
+        self.index = index
+        self.index_name = index_name
+        self.columns = columns
+
+    def attach(self) -> Union[pd.DataFrame, pd.Series]:
+        index = pd.Index(self.index.attach(), name=self.index_name, copy=False)
+        values = self.values.attach()
+        if self.columns is None:
+            return pd.Series(values, index=index, copy=False)
+        return pd.DataFrame(values, index=index, columns=self.columns,
+                            copy=False)
+
+
+Shareable = Union[pd.DataFrame, pd.Series, SharedFrame]
+
+
+def resolve(obj: Any) -> Any:
+    """
+    Attach to a shared frame, passing anything else through unchanged.
+    """
+    if isinstance(obj, SharedFrame):
+        return obj.attach()
+    return obj
+
+
+class ModelExecutor:
+    """
+    One long-lived process pool shared by every model fit in a run.
+
+    Frames passed through `share` are copied once into shared memory and
+    handed to workers as small handles, instead of being pickled to every
+    task. The blocks are released when the executor is closed.
+
+    By default there is one worker per fit of a run, up to the number of
+    cores, and each worker's fits share its `cores // processes` threads.
+    """
+
+    def __init__(self, processes: Optional[int] = None) -> None:
+        cores = os.cpu_count() or 1
+        processes = processes or min(cores, RUN_FITS)
+        threads = max(cores // processes, 1)
+        self.processes = processes
+        self.threads = threads
+        # Workers share the tracker of this process, which owns the blocks,
+        # rather than each starting one that unlinks them when it exits.
+        resource_tracker.ensure_running()
+        self._pool = ProcessPoolExecutor(max_workers=processes,
+                                         initializer=_init_worker,
+                                         initargs=(threads,))
+        self._blocks: List[shared_memory.SharedMemory] = []
+
+    def share(self, obj: Shareable) -> Shareable:
+        """
+        Move a dense numeric frame or series into shared memory. Sparse
+        frames already scale with their non-zeros and are passed through
+        as is.
+        """
+        if isinstance(obj, SharedFrame):
+            return obj
+        if isinstance(obj, pd.DataFrame) and is_sparse_frame(obj):
+            return obj
+        values = obj.to_numpy()
+        index = obj.index.to_numpy()
+        if values.dtype.hasobject or index.dtype.hasobject:
+            # Python objects cannot be placed in shared memory.
+            return obj
+        values, values_block = SharedArray.create(values)
+        index, index_block = SharedArray.create(index)
+        self._blocks.extend([values_block, index_block])
+        columns = list(obj.columns) if isinstance(obj, pd.DataFrame) else None
+        return SharedFrame(values, index, obj.index.name, columns)
+
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        return self._pool.submit(fn, *args)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self) -> 'ModelExecutor':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def worker_threads() -> int:
+    """
+    Threads a fit may start, as `n_jobs`: a pool worker's share of the
+    cores, or -1 for all of them outside a pool.
+    """
+    return _threads or -1
+
+
+def _init_worker(threads: int) -> None:
+    global _threads
+    _threads = threads
+    # OpenMP estimators, such as hist-GBM, take their threads from here.
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(threads)
+
+
+def _open_block(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to a block created by another process without registering it
+    with the resource tracker, which would otherwise treat this process as
+    an owner and report the block leaked, or unlink it, when it exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Before 3.13 attaching always registers. Unregistering afterwards
+    # would also drop the creator's registration from the shared tracker,
+    # so registration is skipped for the duration of the attach instead.
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
@@ -0,0 +1,182 @@
+import itertools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Path of a JSON lines trace file. Set by `configure`, so that worker
+# processes started afterwards trace to the same file.
+TRACE_ENV = 'BEDROCK_TRACE'
+
+Record = Dict[str, Any]
+Sink = Callable[[Record], None]
+
+_sink: Optional[Sink] = None
+_ids = itertools.count()
+_local = threading.local()
+
+
+class JsonLinesSink:
+    """
+    Append each span to a file as one line of JSON. Lines are written with
+    a single `os.write` on an append-only descriptor, so spans from many
+    processes and threads can share one file without interleaving.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o644)
+
+    def __call__(self, record: Record) -> None:
+        line = json.dumps(record, default=str) + '\n'
+        os.write(self._fd, line.encode('utf-8'))
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class LoggingSink:
+    """
+    Log each span as JSON at INFO level.
+    """
+
+    def __init__(self, log: logging.Logger = logger) -> None:
+        self.log = log
+
+    def __call__(self, record: Record) -> None:
+        self.log.info(json.dumps(record, default=str))
+
+
+class Span:
+    """
+    A timed stage. On exit the span records its duration, the growth of
+    the process's peak RSS while it ran and any fields set on it, such as
+    row counts, then hands the record to the sink.
+    """
+
+    __slots__ = ('name', 'fields', 'id', 'parent', '_start', '_wall',
+                 '_rss')
+
+    def __init__(self, name: str, fields: Dict[str, Any]) -> None:
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields: Any) -> None:
+        self.fields.update(fields)
+
+    def __enter__(self) -> 'Span':
+        stack = _stack()
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self._rss = _peak_rss()
+        self._wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        duration = time.perf_counter() - self._start
+        rss = _peak_rss()
+        _stack().pop()
+        record = {
+            'name': self.name,
+            'id': self.id,
+            'parent': self.parent,
+            'pid': os.getpid(),
+            'start': self._wall,
+            'duration': duration,
+            'peak_rss_mib': rss,
+            'peak_rss_delta_mib': rss - self._rss,
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.fields)
+        sink = _sink
+        if sink is not None:
+            sink(record)
+
+
+class _NullSpan:
+    """
+    Returned while instrumentation is off: entering, setting fields and
+    exiting do nothing.
+    """
+
+    __slots__ = ()
+
+    def set(self, **fields: Any) -> None:
+        pass
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **fields: Any) -> Any:
+    """
+    Time a stage of work: `with span('fit', rows=len(df)) as s: ...`.
+    While no sink is configured this returns a shared no-op, so a span
+    costs one global lookup.
+    """
+    if _sink is None:
+        return _NULL_SPAN
+    return Span(name, fields)
+
+
+def configure(path: Optional[str] = None, sink: Optional[Sink] = None) -> None:
+    """
+    Turn instrumentation on, writing spans to the JSON lines file at
+    `path` or handing them to any callable `sink`. A path is also
+    exported in the environment for worker processes.
+    """
+    global _sink
+    if path is not None:
+        os.environ[TRACE_ENV] = path
+        sink = JsonLinesSink(path)
+    if sink is None:
+        raise ValueError('Either a trace path or a sink is required')
+    _sink = sink
+
+
+def disable() -> None:
+    global _sink
+    sink, _sink = _sink, None
+    os.environ.pop(TRACE_ENV, None)
+    if isinstance(sink, JsonLinesSink):
+        sink.close()
+
+
+def enabled() -> bool:
+    return _sink is not None
+
+
+def read_spans(path: str) -> List[Record]:
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _stack() -> List[Span]:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _peak_rss() -> float:
+    # Linux reports ru_maxrss in KiB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if os.environ.get(TRACE_ENV):
+    configure(os.environ[TRACE_ENV])
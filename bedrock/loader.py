@@ -0,0 +1,258 @@
+import io
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterator, Optional, Union
+
+import pandas as pd
+
+from instrument import span
+
+logger = logging.getLogger(__name__)
+
+# Layout of the project bucket: the source files and model submissions.
+SOURCE_PATH = 'bedrock'
+SOURCE_FILES = {
+    'policies': 'train_policies.pkl',
+    'claims': 'train_claims.pkl',
+    'test': 'test_policies.pkl'
+}
+SUBMISSION_PATH = 'submissions'
+SUBMISSION_FILES = {
+    'slm': 'astrange-LM-01Vanilla.pkl',
+    'glm': 'astrange-GLM-01Vanilla.pkl',
+    'mlm': 'astrange-ML-01Vanilla.pkl'
+}
+
+# Size of each ranged read against the bucket.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+PARQUET_SUFFIXES = ('.parquet', '.pq')
+ARROW_SUFFIXES = ('.arrow', '.feather')
+
+Frames = Union[pd.DataFrame, Iterator[pd.DataFrame]]
+
+
+class LocalBlob:
+    """
+    Filesystem stand-in for a `google.cloud.storage.Blob`, implementing the
+    subset of the interface used by the bedrock pipeline.
+    """
+
+    def __init__(self, bucket: 'LocalBucket', name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.generation = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, *self.name.split('/'))
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def reload(self) -> None:
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+
+    def open(self,
+             mode: str = 'rb',
+             chunk_size: Optional[int] = None) -> BinaryIO:
+        if 'r' not in mode:
+            raise ValueError(f'LocalBlob only supports reading, not {mode!r}')
+        return open(self.path, mode, buffering=chunk_size or -1)
+
+    def download_to_file(self, file_obj: BinaryIO) -> None:
+        with open(self.path, 'rb') as f:
+            shutil.copyfileobj(f, file_obj, CHUNK_SIZE)
+
+    def upload_from_file(self, file_obj: BinaryIO) -> None:
+        """
+        Write via a temporary file in the target directory so readers never
+        see a partially written blob.
+        """
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(file_obj, f, CHUNK_SIZE)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class LocalBucket:
+    """
+    A directory standing in for a GCS bucket, so the loaders can be run
+    without network access.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.name = root
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+
+def store_results(results: Dict[str, pd.DataFrame], bucket) -> None:
+    """
+    Upload each model's predictions to the submissions folder of a GCS or
+    local bucket and write a local CSV copy.
+    """
+    # Uploads run in the background while the CSV copies are written.
+    executor = ThreadPoolExecutor(max_workers=len(results))
+    with span('store_results'), executor:
+        uploads = [executor.submit(store_pickle_file, res, name, bucket)
+                   for name, res in results.items()]
+        for name, res in results.items():
+            res.to_csv(f'{name}.csv', encoding='utf-8')
+        for upload in uploads:
+            upload.result()
+
+
+def store_pickle_file(df: pd.DataFrame, name: str, bucket) -> None:
+    logger.info(f'Upload {name}')
+    filename = SUBMISSION_FILES.get(name)
+    path = '/'.join([SOURCE_PATH, SUBMISSION_PATH, filename])
+    blob = bucket.blob(path)
+    with span('upload', model=name, rows=len(df)):
+        df_io = io.BytesIO()
+        pickle.dump(df, df_io)
+        df_io.seek(0)
+        blob.upload_from_file(df_io)
+        df_io.close()
+
+
+class ParquetWriter:
+    """
+    Append DataFrame chunks to one Parquet file, each as a row group, with
+    the schema of the first chunk, so a frame too large for memory can be
+    written a chunk at a time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._writer = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._writer.schema,
+                                         preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self) -> 'ParquetWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def write_parquet(frames: Iterator[pd.DataFrame], path: str) -> None:
+    """
+    Write a stream of frames to a Parquet file, one row group per frame.
+    The file is written under a temporary name and renamed, so readers
+    never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        with ParquetWriter(tmp_path) as writer:
+            for df in frames:
+                writer.write(df)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def is_columnar(name: str) -> bool:
+    """
+    Whether a file is Parquet or Arrow, which can be read in batches.
+    """
+    return name.lower().endswith(PARQUET_SUFFIXES + ARROW_SUFFIXES)
+
+
+def read_frame(blob, batch_size: Optional[int] = None) -> Frames:
+    """
+    Stream a blob into a DataFrame without first buffering the whole
+    object in memory.
+
+    Parquet and Arrow files are read in record batches of at most
+    `batch_size` rows. Pickles can only be loaded whole, so they are
+    unpickled straight off the stream and sliced afterwards.
+
+    Returns a single DataFrame when `batch_size` is None, otherwise an
+    iterator of DataFrames.
+    """
+    chunks = _iter_chunks(blob, batch_size)
+    if batch_size is None:
+        df = next(chunks)
+        chunks.close()
+        return df
+    return chunks
+
+
+def _iter_chunks(blob, batch_size: Optional[int]) -> Iterator[pd.DataFrame]:
+    name = blob.name.lower()
+    with blob.open('rb', chunk_size=CHUNK_SIZE) as f:
+        if name.endswith(PARQUET_SUFFIXES):
+            yield from _read_parquet(f, batch_size)
+        elif name.endswith(ARROW_SUFFIXES):
+            yield from _read_arrow(f, batch_size)
+        else:
+            yield from _read_pickle(f, batch_size)
+
+
+def _read_parquet(f: BinaryIO,
+                  batch_size: Optional[int]) -> Iterator[pd.DataFrame]:
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(f)
+    if batch_size is None:
+        yield parquet_file.read().to_pandas()
+        return
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def _read_arrow(f: BinaryIO,
+                batch_size: Optional[int]) -> Iterator[pd.DataFrame]:
+    import pyarrow as pa
+
+    reader = pa.ipc.open_file(f)
+    if batch_size is None:
+        yield reader.read_all().to_pandas()
+        return
+    for i in range(reader.num_record_batches):
+        table = pa.Table.from_batches([reader.get_batch(i)])
+        for batch in table.to_batches(max_chunksize=batch_size):
+            yield batch.to_pandas()
+
+
+def _read_pickle(f: BinaryIO,
+                 batch_size: Optional[int]) -> Iterator[pd.DataFrame]:
+    df = pickle.load(f)
+    if batch_size is None:
+        yield df
+        return
+    for start in range(0, len(df), batch_size):
+        yield df.iloc[start:start + batch_size]
@@ -1,132 +1,415 @@
 import logging
-from multiprocessing import Pool
-from typing import Union
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Dict, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 from statsmodels.genmod.generalized_linear_model import GLMResults
 from statsmodels.regression.linear_model import RegressionResults
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.base import BaseEstimator
+from sklearn.ensemble import (HistGradientBoostingRegressor,
+                              RandomForestRegressor)
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from artifacts import ModelArtifact
+from executor import ModelExecutor, Shareable, resolve, worker_threads
+from instrument import span
+from scoring import RatingTable
+from solvers import LinearFit, as_design, fit_glm, fit_ols, is_sparse_frame
 
 logger = logging.getLogger(__name__)
 
-Results = Union[RegressionResults, GLMResults]
+Results = Union[RegressionResults, GLMResults, LinearFit]
 
+# Largest combined cell code before the codes are compacted again.
+CELL_CODE_LIMIT = 2 ** 62
 
-def evaluate_slm(independents: pd.DataFrame,
-                 counts: pd.Series,
-                 amounts: pd.Series,
-                 testing: pd.DataFrame) -> pd.DataFrame:
+
+class Fitted(NamedTuple):
     """
-    Fit a simple linear model, evaluate on the testing data and return
-    the predictions.
+    What a worker sends back for one fit: the test predictions, with the
+    compact artifact and rating table of the model where there is one.
     """
-    pool = Pool(processes=2)
-
-    logger.info('Build frequency model: SLM.')
-    freq_results = pool.apply_async(build_slm, (counts, independents))
-
-    logger.info('Build severity model: SLM.')
-    sev_results = pool.apply_async(build_slm, (amounts, independents))
-
-    freq_results = freq_results.get()
-    sev_results = sev_results.get()
-
-    freq_predictions = pool.apply_async(freq_results.predict, [testing])
-    sev_predictions = pool.apply_async(sev_results.predict, [testing])
+    predictions: pd.Series
+    artifact: Optional[ModelArtifact]
+    table: Optional[RatingTable]
 
-    pool.close()
-    pool.join()
-
-    _log_model_results(freq_results, 'slm_freq')
-    _log_model_results(sev_results, 'slm_sev')
-
-    res = pd.concat([freq_predictions.get(), sev_predictions.get()], axis=1)
-    res.columns = ['E[N]', 'E[X]']
-    return res
 
+class PendingModel:
+    """
+    Frequency and severity fits submitted to a `ModelExecutor`, resolving
+    to the frame of test set predictions.
+    """
 
-def build_slm(dep: pd.Series, indep: pd.DataFrame) -> RegressionResults:
+    def __init__(self,
+                 freq: Future,
+                 sev: Future,
+                 executor: Optional[ModelExecutor] = None) -> None:
+        self.freq = freq
+        self.sev = sev
+        self._executor = executor
+
+    def result(self) -> pd.DataFrame:
+        try:
+            res = pd.concat([self.freq.result().predictions,
+                             self.sev.result().predictions], axis=1)
+        finally:
+            # An executor created for this model alone is released with it.
+            if self._executor is not None:
+                self._executor.close()
+        res.columns = ['E[N]', 'E[X]']
+        return res
+
+    def artifacts(self) -> Dict[str, Optional[ModelArtifact]]:
+        """
+        Artifacts of the frequency and severity fits, None for a model
+        other than a linear model or GLM.
+        """
+        return {'freq': self.freq.result().artifact,
+                'sev': self.sev.result().artifact}
+
+    def tables(self) -> Dict[str, Optional[RatingTable]]:
+        """
+        Rating tables of the frequency and severity fits, when they were
+        submitted with `tables`, None for a table that could not be built.
+        """
+        return {'E[N]': self.freq.result().table,
+                'E[X]': self.sev.result().table}
+
+
+def evaluate_slm(independents: Shareable,
+                 counts: Shareable,
+                 amounts: Shareable,
+                 testing: Shareable,
+                 compress: bool = False,
+                 executor: Optional[ModelExecutor] = None) -> pd.DataFrame:
+    """
+    Fit a simple linear model, evaluate on the testing data and return
+    the predictions. With `compress` the model is fitted on the unique
+    rating cells, weighted by their policy counts.
+    """
+    return submit_slm(independents, counts, amounts, testing,
+                      compress, executor).result()
+
+
+def submit_slm(independents: Shareable,
+               counts: Shareable,
+               amounts: Shareable,
+               testing: Shareable,
+               compress: bool = False,
+               executor: Optional[ModelExecutor] = None,
+               tables: bool = False) -> PendingModel:
+    return _submit('slm', build_slm, build_slm, independents, counts,
+                   amounts, testing, compress, executor, tables)
+
+
+def build_slm(dep: pd.Series,
+              indep: pd.DataFrame,
+              weights: Optional[np.ndarray] = None) -> Results:
+    if is_sparse_frame(indep):
+        results = fit_ols(as_design(indep), dep.to_numpy(), weights)
+        return _named(results, indep)
+    if weights is not None:
+        return sm.WLS(dep, indep, weights=weights).fit()
     model = sm.OLS(dep, indep)
     return model.fit()
 
 
-def evaluate_glm(independents: pd.DataFrame,
-                 counts: pd.Series,
-                 amounts: pd.Series,
-                 testing: pd.DataFrame) -> pd.DataFrame:
+def evaluate_glm(independents: Shareable,
+                 counts: Shareable,
+                 amounts: Shareable,
+                 testing: Shareable,
+                 compress: bool = False,
+                 executor: Optional[ModelExecutor] = None) -> pd.DataFrame:
     """
     Fit a statsmodel GLM using poisson for the frequency and gamma for
-    severity.
+    severity. With `compress` the models are fitted on the unique rating
+    cells, weighted by their policy counts.
     """
-    pool = Pool(processes=2)
-
-    logger.info('Build frequency model: GLM.')
-    freq_results = pool.apply_async(build_glm_freq, (counts, independents))
-
-    logger.info('Build severity model: GLM.')
-    sev_results = pool.apply_async(build_glm_sev, (amounts, independents))
-
-    freq_results = freq_results.get()
-    sev_results = sev_results.get()
-
-    freq_predictions = pool.apply_async(freq_results.predict, [testing])
-    sev_predictions = pool.apply_async(sev_results.predict, [testing])
-
-    pool.close()
-    pool.join()
-
-    _log_model_results(freq_results, 'glm_freq')
-    _log_model_results(sev_results, 'glm_sev')
-
-    res = pd.concat([freq_predictions.get(), sev_predictions.get()], axis=1)
-    res.columns = ['E[N]', 'E[X]']
-    return res
-
-
-def build_glm_freq(dep: pd.Series, indep: pd.DataFrame) -> GLMResults:
-    family = sm.families.Poisson(sm.families.links.log)
-    model = sm.GLM(dep, indep, family=family)
+    return submit_glm(independents, counts, amounts, testing,
+                      compress, executor).result()
+
+
+def submit_glm(independents: Shareable,
+               counts: Shareable,
+               amounts: Shareable,
+               testing: Shareable,
+               compress: bool = False,
+               executor: Optional[ModelExecutor] = None,
+               tables: bool = False) -> PendingModel:
+    return _submit('glm', build_glm_freq, build_glm_sev, independents,
+                   counts, amounts, testing, compress, executor, tables)
+
+
+def build_glm_freq(dep: pd.Series,
+                   indep: pd.DataFrame,
+                   weights: Optional[np.ndarray] = None) -> Results:
+    if is_sparse_frame(indep):
+        results = fit_glm(as_design(indep), dep.to_numpy(), 'poisson', 'log',
+                          weights)
+        return _named(results, indep)
+    family = sm.families.Poisson(sm.families.links.log())
+    model = sm.GLM(dep, indep, family=family, freq_weights=weights)
     return model.fit()
 
 
-def build_glm_sev(dep: pd.Series, indep: pd.DataFrame) -> GLMResults:
-    family = sm.families.Gamma(sm.families.links.identity)
-    model = sm.GLM(dep, indep, family=family)
+def build_glm_sev(dep: pd.Series,
+                  indep: pd.DataFrame,
+                  weights: Optional[np.ndarray] = None) -> Results:
+    if is_sparse_frame(indep):
+        results = fit_glm(as_design(indep), dep.to_numpy(),
+                          'gamma', 'identity', weights)
+        return _named(results, indep)
+    family = sm.families.Gamma(sm.families.links.identity())
+    model = sm.GLM(dep, indep, family=family, freq_weights=weights)
     return model.fit()
 
 
-def evaluate_mlm(independents: pd.DataFrame,
-                 counts: pd.Series,
-                 amounts: pd.Series,
-                 testing: pd.DataFrame) -> pd.DataFrame:
-
-    logger.info('Build frequency model: MLM.')
-    freq_results = build_mlm(counts, independents)
-    freq_predictions = freq_results.predict(testing)
-
-    logger.info('Build severity model: MLM.')
-    sev_results = build_mlm(amounts, independents)
-    sev_predictions = sev_results.predict(testing)
-
-    res = pd.np.column_stack((freq_predictions,
-                              sev_predictions,
-                              testing.pol_id))
-    res = pd.DataFrame(res, coluns=['pol_id', 'E[N]', 'E[X]'])
-    res.set_index('pol_id')
-    return res
+class Cells(NamedTuple):
+    """
+    Unique rows of a design matrix. `codes` maps every policy to its cell
+    and `weights` counts the policies in each cell.
+    """
+    design: pd.DataFrame
+    codes: np.ndarray
+    weights: np.ndarray
 
 
-def build_mlm(dep: pd.Series, indep: pd.DataFrame) -> RandomForestRegressor:
-    rf = RandomForestRegressor(n_estimators=1000, random_state=42, n_jobs=-1)
-    rf.fit(indep, dep)
+def compress_cells(indep: pd.DataFrame) -> Cells:
+    """
+    Collapse identical rows of the design into rating cells. Each column
+    is factorised once and the codes combined into one cell code per row,
+    so the cost is O(rows × columns) with no sort.
+    """
+    codes = np.zeros(len(indep), dtype=np.int64)
+    n_cells = 1
+    for col in indep.columns:
+        col_codes, uniques = pd.factorize(np.asarray(indep[col]))
+        if n_cells * len(uniques) > CELL_CODE_LIMIT:
+            codes, seen = pd.factorize(codes)
+            n_cells = len(seen)
+        codes = codes * len(uniques) + col_codes
+        n_cells *= len(uniques)
+    codes, uniques = pd.factorize(codes)
+
+    # Factorised codes are numbered in order of first appearance, so each
+    # cell starts where the running maximum steps up.
+    running_max = np.maximum.accumulate(codes)
+    first = np.flatnonzero(np.r_[True, running_max[1:] > running_max[:-1]])
+    weights = np.bincount(codes, minlength=len(uniques)).astype(np.float64)
+    return Cells(indep.iloc[first], codes, weights)
+
+
+def cell_means(cells: Cells, dep: pd.Series) -> pd.Series:
+    """
+    Mean response of each cell. With the cell counts as frequency weights,
+    the Poisson, Gamma and least squares estimating equations on the cells
+    are identical to those on the full data.
+    """
+    totals = np.bincount(cells.codes,
+                         weights=dep.to_numpy(dtype=np.float64),
+                         minlength=len(cells.weights))
+    return pd.Series(totals / cells.weights, index=cells.design.index)
+
+
+def _submit(kind: str,
+            build_freq: Callable,
+            build_sev: Callable,
+            independents: Shareable,
+            counts: Shareable,
+            amounts: Shareable,
+            testing: Shareable,
+            compress: bool,
+            executor: Optional[ModelExecutor],
+            tables: bool = False) -> PendingModel:
+    """
+    Submit the frequency and severity fits of one model. Without an
+    executor a two-process one is created and released with the result.
+    With `tables` each fit is also exported as a `RatingTable`.
+    """
+    owned = None
+    if executor is None:
+        executor = owned = ModelExecutor(processes=2)
+
+    if compress:
+        indep = resolve(independents)
+        freq_args = _compressed(indep, resolve(counts))
+        sev_args = _compressed(indep, resolve(amounts))
+    else:
+        freq_args = (counts, independents, None)
+        sev_args = (amounts, independents, None)
+
+    logger.info(f'Build frequency model: {kind.upper()}.')
+    freq = executor.submit(_fit_and_predict, build_freq, *freq_args,
+                           testing, f'{kind}_freq', tables)
+
+    logger.info(f'Build severity model: {kind.upper()}.')
+    sev = executor.submit(_fit_and_predict, build_sev, *sev_args,
+                          testing, f'{kind}_sev', tables)
+    return PendingModel(freq, sev, owned)
+
+
+def _compressed(indep: pd.DataFrame,
+                dep: pd.Series) -> Tuple[pd.Series, pd.DataFrame,
+                                         np.ndarray]:
+    """
+    Response, design and weights of a fit on the rating cells of the
+    policies with a response.
+    """
+    cells = compress_cells(_matching_rows(indep, dep))
+    logger.info(f'Compressed {len(cells.codes)} policies '
+                f'into {len(cells.weights)} cells.')
+    return cell_means(cells, dep), cells.design, cells.weights
+
+
+def _matching_rows(indep: pd.DataFrame, dep: pd.Series) -> pd.DataFrame:
+    # The severity is only defined, and fitted, on the policies with a
+    # claim.
+    if indep.index.equals(dep.index):
+        return indep
+    return indep.loc[dep.index]
+
+
+def _fit_and_predict(build: Callable,
+                     dep: Shareable,
+                     indep: Shareable,
+                     weights: Optional[np.ndarray],
+                     testing: Shareable,
+                     name: Optional[str],
+                     tables: bool = False) -> Fitted:
+    """
+    Worker task: attach to the shared frames, fit, log the fitted model
+    and return the test predictions with the compact artifact, and the
+    rating table if asked for, so the fitted results never have to be
+    pickled back to the parent.
+    """
+    dep, indep, testing = resolve(dep), resolve(indep), resolve(testing)
+    indep = _matching_rows(indep, dep)
+    with span('fit', model=name, rows=len(indep)):
+        results = build(dep, indep, weights)
+    artifact = None
+    if not isinstance(results, BaseEstimator):
+        artifact = ModelArtifact.from_results(results)
+        _log_model_results(artifact, name)
+        if artifact.diagnostics.get('converged') is False:
+            logger.warning(f'The {name} model did not converge; its '
+                           f'coefficients are unreliable.')
+    with span('predict', model=name, rows=len(testing)):
+        predictions = results.predict(testing)
+    table = None
+    if tables:
+        # A table too large to build is skipped rather than failing the
+        # fit, so the predictions are still returned and stored.
+        try:
+            with span('rating_table', model=name):
+                table = RatingTable.from_model(results, indep)
+        except Exception:
+            logger.exception(f'Rating table of {name} model not built.')
+    return Fitted(pd.Series(np.asarray(predictions), index=testing.index),
+                  artifact, table)
+
+
+def evaluate_mlm(independents: Shareable,
+                 counts: Shareable,
+                 amounts: Shareable,
+                 testing: Shareable,
+                 executor: Optional[ModelExecutor] = None,
+                 engine: str = 'forest') -> pd.DataFrame:
+    """
+    Fit an ML model for each of frequency and severity with the chosen
+    engine from `MLM_ENGINES`, evaluate on the testing data and return the
+    predictions.
+    """
+    return submit_mlm(independents, counts, amounts, testing,
+                      executor, engine).result()
+
+
+def submit_mlm(independents: Shareable,
+               counts: Shareable,
+               amounts: Shareable,
+               testing: Shareable,
+               executor: Optional[ModelExecutor] = None,
+               engine: str = 'forest',
+               tables: bool = False) -> PendingModel:
+    _, freq_loss, sev_loss = MLM_ENGINES[engine]
+    build_freq = partial(build_mlm, engine=engine, loss=freq_loss)
+    build_sev = partial(build_mlm, engine=engine, loss=sev_loss)
+    return _submit('mlm', build_freq, build_sev, independents, counts,
+                   amounts, testing, False, executor, tables)
+
+
+def build_mlm(dep: pd.Series,
+              indep: pd.DataFrame,
+              weights: Optional[np.ndarray] = None,
+              engine: str = 'forest',
+              loss: Optional[str] = None) -> BaseEstimator:
+    build, freq_loss, _ = MLM_ENGINES[engine]
+    return build(dep, indep, weights, loss or freq_loss)
+
+
+def build_forest(dep: pd.Series,
+                 indep: pd.DataFrame,
+                 weights: Optional[np.ndarray] = None,
+                 loss: str = 'squared_error') -> RandomForestRegressor:
+    # Inside a pool each worker gets its share of the cores, so concurrent
+    # fits do not oversubscribe them.
+    rf = RandomForestRegressor(n_estimators=1000, criterion=loss,
+                               random_state=42, n_jobs=worker_threads())
+    rf.fit(indep, dep, sample_weight=weights)
     return rf
 
 
-def _log_model_results(res: Results, name: str) -> None:
+def build_hist_gbm(dep: pd.Series,
+                   indep: pd.DataFrame,
+                   weights: Optional[np.ndarray] = None,
+                   loss: str = 'poisson') -> BaseEstimator:
     """
-    Store the results of a model fitting in a log file.
+    Gradient boosting on binned features, with early stopping on a held
+    out tenth of the data. The Gamma severity loss needs the positive
+    claim averages of `features.aggregate_claims`.
+    Sparse features are densified in a pipeline step, since the model
+    only accepts dense input.
+    """
+    gbm = HistGradientBoostingRegressor(loss=loss,
+                                        max_iter=1000,
+                                        early_stopping=True,
+                                        validation_fraction=0.1,
+                                        n_iter_no_change=10,
+                                        random_state=42)
+    if is_sparse_frame(indep):
+        gbm = Pipeline([('dense', FunctionTransformer(_dense)),
+                        ('gbm', gbm)])
+        return gbm.fit(indep, dep, gbm__sample_weight=weights)
+    gbm.fit(indep, dep, sample_weight=weights)
+    return gbm
+
+
+def _dense(indep: pd.DataFrame) -> pd.DataFrame:
+    if is_sparse_frame(indep):
+        return indep.sparse.to_dense()
+    return indep
+
+
+# Builder and frequency/severity losses of each ML engine.
+MLM_ENGINES = {
+    'forest': (build_forest, 'squared_error', 'squared_error'),
+    'hist_gbm': (build_hist_gbm, 'poisson', 'gamma'),
+}
+
+
+def _log_model_results(artifact: ModelArtifact, name: str) -> None:
+    """
+    Store the coefficients and diagnostics of a model fitting in a log
+    file.
     """
     logger.info(f'Logging results of {name} model.')
     with open(f'{name}.log', 'w') as f:
-        f.write(res.summary().as_text())
+        f.write(artifact.summary_text())
+
+
+def _named(res: LinearFit, indep: pd.DataFrame) -> LinearFit:
+    res.names = list(indep.columns)
+    return res
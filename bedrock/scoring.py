@@ -0,0 +1,571 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from features import CATEGORICAL_COLS, FeatureSchema, Matrix
+from solvers import LINKS, as_design, is_sparse_frame
+
+logger = logging.getLogger(__name__)
+
+TABLE_VERSION = 2
+
+# The one feature a linear model applies through its coefficient instead
+# of the table, so it can take any value.
+CONTINUOUS_COL = 'sum_insured'
+
+# Largest rating table built before giving up on the cartesian product.
+MAX_CELLS = 10 ** 7
+
+# Micro-batching defaults of the scoring service.
+MAX_BATCH = 1024
+MAX_WAIT = 0.005
+
+
+class RatingTable:
+    """
+    Predictions of a fitted model for every rating cell, so scoring is an
+    integer-coded gather rather than a call to the model.
+
+    Each factor is a numeric feature or a group of one-hot flags, reduced
+    to one key per policy. A cell is one combination of the factor levels
+    seen in training. For a linear or generalised linear model the
+    continuous `sum_insured` term is kept out of the cells and applied
+    through its coefficient, as `inverse_link(table[cell] + slope * x)`.
+
+    Any other model is tabulated over intervals of the sum insured instead,
+    split at `edges`: the thresholds at which the model's trees split on
+    it, between which a tree ensemble predicts the same value. Any sum
+    insured, seen in training or not, then scores as the model would. A
+    model without split thresholds is tabulated at the training levels and
+    scores other values at the nearest of them. Policies with a level of
+    another factor outside the table score as NaN.
+    """
+
+    def __init__(self,
+                 columns: List[str],
+                 factors: List[List[int]],
+                 levels: List[np.ndarray],
+                 values: np.ndarray,
+                 slope: Optional[float] = None,
+                 link: str = 'identity',
+                 edges: Optional[np.ndarray] = None) -> None:
+        self.columns = columns
+        self.factors = factors
+        self.levels = levels
+        self.values = values
+        self.slope = slope
+        self.link = link
+        self.edges = edges
+        self.shape = tuple(len(level) for level in levels)
+        # Position of the sum insured among the factors when binned.
+        self.binned = None
+        if edges is not None:
+            self.binned = factors.index([columns.index(CONTINUOUS_COL)])
+
+    @classmethod
+    def from_model(cls, model: Any, features: pd.DataFrame) -> 'RatingTable':
+        """
+        Tabulate `model` over the levels found in its training `features`.
+        """
+        columns = [str(col) for col in features.columns]
+        linear = _linear_params(model)
+        keyed = [i for i, col in enumerate(columns)
+                 if linear is None or col != CONTINUOUS_COL]
+        factors = _factor_columns(columns, keyed)
+        X = _matrix(features)
+        # A one-hot group also gets the all-zero level of a category unseen
+        # in training, which the model itself would score.
+        levels = []
+        for cols in factors:
+            keys = _factor_keys(X, cols)
+            if len(cols) > 1:
+                keys = np.append(keys, 0)
+            levels.append(np.unique(keys))
+
+        edges = None
+        if linear is None and CONTINUOUS_COL in columns:
+            continuous = columns.index(CONTINUOUS_COL)
+            binned = factors.index([continuous])
+            edges, levels[binned] = _bins(model, continuous,
+                                          levels[binned], X.dtype)
+
+        shape = tuple(len(level) for level in levels)
+        n_cells = int(np.prod(shape, dtype=np.int64))
+        if n_cells > MAX_CELLS:
+            raise ValueError(f'Rating table of {n_cells} cells exceeds '
+                             f'the limit of {MAX_CELLS}')
+        grid = np.indices(shape).reshape(len(shape), -1)
+        design = np.zeros((n_cells, len(columns)))
+        for cols, level, codes in zip(factors, levels, grid):
+            design[:, cols] = _factor_design(level[codes], len(cols))
+
+        if linear is None:
+            cells = pd.DataFrame(design.astype(X.dtype), columns=columns)
+            values = np.asarray(model.predict(cells), dtype=np.float64)
+            return cls(columns, factors, levels, values, edges=edges)
+        params, link = linear
+        return cls(columns, factors, levels, design @ params,
+                   float(params[columns.index(CONTINUOUS_COL)]), link)
+
+    def codes(self, X: Matrix) -> np.ndarray:
+        """
+        Flat cell index of every row of an encoded feature matrix, or -1
+        where a factor level is not in the table.
+        """
+        known = np.ones(X.shape[0], dtype=bool)
+        codes = []
+        for i, (cols, level) in enumerate(zip(self.factors, self.levels)):
+            keys = _factor_keys(X, cols)
+            if i == self.binned:
+                # Trees send x <= threshold left, so intervals are closed
+                # on the right.
+                code = np.searchsorted(self.edges, keys, side='left')
+                known &= ~np.isnan(keys)
+            else:
+                code = np.minimum(np.searchsorted(level, keys),
+                                  len(level) - 1)
+                known &= level[code] == keys
+            codes.append(code)
+        flat = np.ravel_multi_index(codes, self.shape)
+        return np.where(known, flat, -1)
+
+    def score(self, X: Matrix) -> np.ndarray:
+        """
+        Predict the mean response of every row of an encoded feature
+        matrix with the same columns as the training features.
+        """
+        codes = self.codes(X)
+        known = codes >= 0
+        values = self.values[np.where(known, codes, 0)]
+        if self.slope is not None:
+            _, inverse, _ = LINKS[self.link]
+            continuous = _column(X, self.columns.index(CONTINUOUS_COL))
+            values = inverse(values + self.slope * continuous)
+        if not known.all():
+            logger.warning(f'{np.count_nonzero(~known)} policies fall '
+                           f'outside the rating table.')
+        return np.where(known, values, np.nan)
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        arrays = {f'{prefix}values': self.values}
+        for i, level in enumerate(self.levels):
+            arrays[f'{prefix}level{i}'] = level
+        if self.edges is not None:
+            arrays[f'{prefix}edges'] = self.edges
+        return arrays
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'columns': self.columns,
+            'factors': self.factors,
+            'slope': self.slope,
+            'link': self.link,
+            'binned': self.edges is not None,
+        }
+
+    @classmethod
+    def from_arrays(cls,
+                    data: Dict[str, object],
+                    arrays: Any,
+                    prefix: str) -> 'RatingTable':
+        levels = [arrays[f'{prefix}level{i}']
+                  for i in range(len(data['factors']))]
+        edges = arrays[f'{prefix}edges'] if data['binned'] else None
+        return cls(data['columns'], data['factors'], levels,
+                   arrays[f'{prefix}values'], data['slope'], data['link'],
+                   edges)
+
+
+class RatingModel:
+    """
+    The rating tables of one model's frequency and severity fits, with
+    the feature schema needed to encode raw policies for them.
+    """
+
+    def __init__(self,
+                 schema: FeatureSchema,
+                 tables: Dict[str, RatingTable]) -> None:
+        self.schema = schema
+        self.tables = tables
+
+    def score(self, policies: pd.DataFrame) -> pd.DataFrame:
+        """
+        Score a frame of raw policies into one column per table, indexed
+        by `pol_id`.
+        """
+        return self.score_matrix(*self.encode(policies))
+
+    def encode(self, policies: pd.DataFrame) -> Tuple[Matrix, pd.Index]:
+        """
+        Encode a frame of raw policies with the schema, raising on records
+        that cannot be encoded, and index them by `pol_id`.
+        """
+        X = self.schema.transform(policies)
+        index = pd.Index(policies['pol_id'].to_numpy(), name='pol_id')
+        return X, index
+
+    def score_matrix(self, X: Matrix, index: pd.Index) -> pd.DataFrame:
+        return pd.DataFrame({name: table.score(X)
+                             for name, table in self.tables.items()},
+                            index=index)
+
+    def save(self, path: str) -> None:
+        """
+        Write the tables as one `.npz` file, with their metadata and the
+        schema stored as JSON alongside the arrays.
+        """
+        names = list(self.tables)
+        meta = {
+            'version': TABLE_VERSION,
+            'schema': self.schema.to_dict(),
+            'tables': {name: self.tables[name].to_dict() for name in names},
+            'order': names,
+        }
+        arrays = {}
+        for i, name in enumerate(names):
+            arrays.update(self.tables[name].to_arrays(f't{i}_'))
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'RatingModel':
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            if meta.get('version') != TABLE_VERSION:
+                raise ValueError(
+                    f'Unsupported rating table version {meta.get("version")}'
+                )
+            tables = {
+                name: RatingTable.from_arrays(meta['tables'][name], arrays,
+                                              f't{i}_')
+                for i, name in enumerate(meta['order'])
+            }
+        return cls(FeatureSchema.from_dict(meta['schema']), tables)
+
+
+class BatchScorer:
+    """
+    Collects scoring requests from many threads into micro-batches of at
+    most `max_batch` policies, waiting no longer than `max_wait` seconds
+    for a batch to fill, and scores each batch in one vectorised call.
+    """
+
+    def __init__(self,
+                 model: RatingModel,
+                 max_batch: int = MAX_BATCH,
+                 max_wait: float = MAX_WAIT) -> None:
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._requests: queue.Queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def score(self, records: List[Dict[str, object]]) -> pd.DataFrame:
+        """
+        Score a list of policy records, blocking until its batch is done.
+        """
+        request = _Request(records)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0].records)
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.records)
+            self._score_batch(batch)
+
+    def _score_batch(self, batch: List['_Request']) -> None:
+        # Each request is encoded on its own, so a malformed record fails
+        # only the request that sent it, and the rest are scored together.
+        encoded = []
+        for request in batch:
+            try:
+                X, index = self.model.encode(pd.DataFrame(request.records))
+            except Exception as e:
+                request.error = e
+                continue
+            encoded.append((request, X, index))
+        if encoded:
+            requests, matrices, indexes = zip(*encoded)
+            stack = sp.vstack if sp.issparse(matrices[0]) else np.vstack
+            try:
+                scores = self.model.score_matrix(
+                    stack(matrices), indexes[0].append(list(indexes[1:])))
+                start = 0
+                for request in requests:
+                    stop = start + len(request.records)
+                    request.result = scores.iloc[start:stop]
+                    start = stop
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+        for request in batch:
+            request.done.set()
+
+
+class _Request:
+
+    def __init__(self, records: List[Dict[str, object]]) -> None:
+        self.records = records
+        self.result: Optional[pd.DataFrame] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+def serve(model: RatingModel,
+          host: str = '127.0.0.1',
+          port: int = 8080,
+          max_batch: int = MAX_BATCH,
+          max_wait: float = MAX_WAIT) -> ThreadingHTTPServer:
+    """
+    Local stand-in for a scoring service. POST a JSON list of policy
+    records to `/score` to receive their predictions as a JSON list.
+    Concurrent requests are micro-batched through a `BatchScorer`. The
+    server is returned unstarted; call `serve_forever` on it.
+    """
+    scorer = BatchScorer(model, max_batch, max_wait)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self) -> None:
+            if self.path != '/score':
+                self.send_error(404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                records = json.loads(self.rfile.read(length))
+                scores = scorer.score(records)
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                # Every request gets a reply, whatever failed its batch.
+                logger.exception('Scoring request failed.')
+                self.send_error(500, str(e))
+                return
+            body = scores.reset_index().to_json(orient='records').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            logger.debug(format % args)
+
+    return _Server((host, port), Handler)
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of five drops connections under concurrent load,
+    # which shows up as one second retransmits in the latency tail.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def measure_latency(url: str,
+                    policies: pd.DataFrame,
+                    requests: int = 1000,
+                    concurrency: int = 16,
+                    batch_size: int = 1) -> Dict[str, float]:
+    """
+    Send `requests` requests of `batch_size` policies each to a scoring
+    service from `concurrency` threads and return latency percentiles in
+    milliseconds, with the overall throughput in policies per second.
+    """
+    records = json.loads(policies.to_json(orient='records'))
+
+    def post(i: int) -> float:
+        start = (i * batch_size) % max(len(records) - batch_size, 1)
+        body = json.dumps(records[start:start + batch_size]).encode()
+        request = urllib.request.Request(
+            url, body, {'Content-Type': 'application/json'})
+        began = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - began
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(post, range(requests))))
+    elapsed = time.perf_counter() - began
+    p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+    return {'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+            'policies_per_s': requests * batch_size / elapsed}
+
+
+def _linear_params(model: Any) -> Optional[Tuple[np.ndarray, str]]:
+    """
+    Coefficients and link name of a linear or generalised linear model,
+    or None for any other model.
+    """
+    params = getattr(model, 'params', None)
+    if params is None:
+        return None
+    link = getattr(model, 'link', None)
+    if link is None:
+        family = getattr(model.model, 'family', None)
+        link = 'identity' if family is None else type(family.link).__name__
+    link = link.lower()
+    if link not in LINKS:
+        return None
+    return np.asarray(params, dtype=np.float64), link
+
+
+def _bins(model: Any,
+          column: int,
+          levels: np.ndarray,
+          dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Interval edges of a continuous feature, and a value of the feature's
+    `dtype` in each interval at which the table is evaluated. The edges are
+    the model's split thresholds on the feature, or the midpoints between
+    the training levels for a model without trees.
+    """
+    thresholds = _split_thresholds(model, column)
+    if thresholds is None or not len(thresholds):
+        return (levels[:-1] + levels[1:]) / 2, levels
+    edges = np.unique(thresholds)
+    # Each interval but the last is closed on its upper edge, so the edge
+    # itself, rounded down to the dtype the model compares, lies inside.
+    values = edges.astype(dtype)
+    above = values > edges
+    values[above] = np.nextafter(values[above], -np.inf, dtype=dtype)
+    # Trees only split below the largest training level, which lies in the
+    # last interval.
+    return edges, np.append(values.astype(np.float64), levels[-1])
+
+
+def _split_thresholds(model: Any, column: int) -> Optional[np.ndarray]:
+    """
+    Thresholds at which the trees of a random forest or a hist-GBM, bare
+    or at the end of a pipeline, split on a feature; None for any other
+    model.
+    """
+    steps = getattr(model, 'steps', None)
+    if steps:
+        model = steps[-1][1]
+    if hasattr(model, 'estimators_'):
+        trees = [tree.tree_ for tree in model.estimators_]
+        return np.concatenate([tree.threshold[tree.feature == column]
+                               for tree in trees])
+    predictors = getattr(model, '_predictors', None)
+    if predictors is not None:
+        nodes = [predictor.nodes for trees in predictors
+                 for predictor in trees]
+        return np.concatenate([
+            node['num_threshold'][(node['feature_idx'] == column)
+                                  & (node['is_leaf'] == 0)]
+            for node in nodes
+        ])
+    return None
+
+
+def _factor_columns(columns: List[str], keyed: List[int]) -> List[List[int]]:
+    """
+    Group the keyed columns into factors: the one-hot flags of each
+    categorical column form one factor, every other column its own.
+    """
+    factors = []
+    grouped = set()
+    for col in CATEGORICAL_COLS:
+        flags = [i for i in keyed if columns[i].startswith(f'{col}_')]
+        if flags:
+            factors.append(flags)
+            grouped.update(flags)
+    return [[i] for i in keyed if i not in grouped] + factors
+
+
+def _factor_keys(X: Matrix, cols: List[int]) -> np.ndarray:
+    """
+    One key per row for a factor: the value of a single column, or the
+    one-based position of the set flag in a one-hot group, zero for none.
+    """
+    if len(cols) == 1:
+        return _column(X, cols[0])
+    keys = X[:, cols] @ np.arange(1, len(cols) + 1, dtype=np.float64)
+    return np.asarray(keys, dtype=np.float64).ravel()
+
+
+def _factor_design(keys: np.ndarray, width: int) -> np.ndarray:
+    if width == 1:
+        return keys[:, None]
+    flags = np.zeros((len(keys), width))
+    known = keys > 0
+    flags[np.flatnonzero(known), keys[known].astype(np.int64) - 1] = 1
+    return flags
+
+
+def _column(X: Matrix, i: int) -> np.ndarray:
+    column = X[:, i]
+    if sp.issparse(column):
+        column = column.toarray()
+    return np.asarray(column, dtype=np.float64).ravel()
+
+
+def _matrix(features: pd.DataFrame) -> Matrix:
+    if is_sparse_frame(features):
+        return as_design(features)
+    return features.to_numpy()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Serve a rating table over HTTP, or measure the '
+                    'latency of a running service.')
+    parser.add_argument('table', nargs='?', help='rating table .npz file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT)
+    parser.add_argument('--measure', metavar='POLICIES',
+                        help='pickle of policies to send to the service')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s: %(message)s')
+    if args.measure:
+        url = f'http://{args.host}:{args.port}/score'
+        stats = measure_latency(url, pd.read_pickle(args.measure),
+                                args.requests, args.concurrency,
+                                args.batch_size)
+        print(json.dumps(stats, indent=2))
+        return
+
+    server = serve(RatingModel.load(args.table), args.host, args.port,
+                   args.max_batch, args.max_wait)
+    logger.info(f'Serving {args.table} on {args.host}:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import logging
+from typing import (Callable, Dict, Iterable, Iterator, Optional, Tuple,
+                    Union)
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.special import xlogy
+
+logger = logging.getLogger(__name__)
+
+Design = Union[np.ndarray, sp.spmatrix]
+
+# A block of rows (design, response, weights) and a callable producing a
+# fresh pass over all of them.
+Batch = Tuple[Design, np.ndarray, Optional[np.ndarray]]
+Batches = Callable[[], Iterable[Batch]]
+
+# Rows of a dense design converted to float64 at a time when accumulating
+# the normal equations.
+BLOCK_ROWS = 100000
+
+# Smallest fitted mean allowed in the variance and deviance functions.
+EPS = np.finfo(np.float64).eps
+
+# Link functions as (link, inverse link, derivative of the inverse link).
+LINKS: Dict[str, Tuple[Callable, Callable, Callable]] = {
+    'identity': (lambda mu: mu, lambda eta: eta, np.ones_like),
+    'log': (np.log, np.exp, np.exp),
+}
+
+VARIANCES: Dict[str, Callable] = {
+    'gaussian': np.ones_like,
+    'poisson': lambda mu: mu,
+    'gamma': lambda mu: mu ** 2,
+}
+
+
+def _unit_deviance(variance: str, y: np.ndarray, mu: np.ndarray) -> np.ndarray:
+    if variance == 'gaussian':
+        return (y - mu) ** 2
+    mu = np.maximum(mu, EPS)
+    if variance == 'poisson':
+        return 2 * (xlogy(y, y / mu) - (y - mu))
+    if variance == 'gamma':
+        y = np.maximum(y, EPS)
+        return 2 * (-np.log(y / mu) + (y - mu) / mu)
+    raise ValueError(f'Unknown variance function {variance}')
+
+
+class LinearFit:
+    """
+    Coefficients of a linear or generalised linear model fitted by one of
+    the solvers below, which work on dense and sparse designs alike.
+    """
+
+    def __init__(self,
+                 params: np.ndarray,
+                 link: str = 'identity',
+                 variance: str = 'gaussian',
+                 deviance: Optional[float] = None,
+                 iterations: int = 0,
+                 converged: bool = True,
+                 names: Optional[list] = None) -> None:
+        self.params = params
+        self.link = link
+        self.variance = variance
+        self.deviance = deviance
+        self.iterations = iterations
+        self.converged = converged
+        self.names = names
+
+    def predict(self,
+                exog: Union[pd.DataFrame, Design]
+                ) -> Union[pd.Series, np.ndarray]:
+        """
+        Predict the mean response. A DataFrame, dense or sparse, gives a
+        Series on the same index.
+        """
+        _, inverse, _ = LINKS[self.link]
+        if isinstance(exog, pd.DataFrame):
+            return pd.Series(inverse(as_design(exog) @ self.params),
+                             index=exog.index)
+        return inverse(exog @ self.params)
+
+
+def as_design(df: pd.DataFrame) -> Design:
+    """
+    The design matrix behind a feature frame: CSR for a sparse frame,
+    otherwise the dense values.
+    """
+    if is_sparse_frame(df):
+        return df.sparse.to_coo().tocsr()
+    return df.to_numpy()
+
+
+def is_sparse_frame(df: pd.DataFrame) -> bool:
+    return len(df.columns) > 0 and all(
+        isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes
+    )
+
+
+def normal_equations(X: Design,
+                     w: np.ndarray,
+                     z: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Accumulate XᵀWX and XᵀWz in float64. A sparse design only touches its
+    non-zeros; a dense one is converted a block of rows at a time.
+    """
+    if sp.issparse(X):
+        X = X.tocsr().astype(np.float64)
+        Xw = sp.diags(w) @ X
+        return (X.T @ Xw).toarray(), Xw.T @ z
+
+    n_cols = X.shape[1]
+    gram = np.zeros((n_cols, n_cols))
+    rhs = np.zeros(n_cols)
+    for start in range(0, X.shape[0], BLOCK_ROWS):
+        block = np.asarray(X[start:start + BLOCK_ROWS], dtype=np.float64)
+        block_w = w[start:start + BLOCK_ROWS]
+        weighted = block * block_w[:, None]
+        gram += block.T @ weighted
+        rhs += weighted.T @ z[start:start + BLOCK_ROWS]
+    return gram, rhs
+
+
+def solve_normal_equations(gram: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    """
+    Solve XᵀWX b = XᵀWz. Columns are rescaled to unit norm first, since
+    sum insured and year built are orders of magnitude larger than the
+    flags, and the pseudo-inverse gives the minimum-norm solution for a
+    rank-deficient design, as statsmodels does.
+    """
+    scale = np.sqrt(np.diag(gram))
+    scale[scale == 0] = 1
+    scaled = gram / np.outer(scale, scale)
+    return np.linalg.pinv(scaled) @ (rhs / scale) / scale
+
+
+def fit_ols(X: Design,
+            y: np.ndarray,
+            weights: Optional[np.ndarray] = None) -> LinearFit:
+    """
+    Ordinary (or weighted) least squares via the normal equations.
+    """
+    return fit_ols_batches(lambda: [(X, y, weights)])
+
+
+def fit_ols_batches(batches: Batches) -> LinearFit:
+    """
+    Least squares from the sufficient statistics XᵀWX, XᵀWy and yᵀWy,
+    accumulated in a single pass over the batches. Memory is bounded by
+    the largest batch, however many rows there are in total.
+    """
+    gram, rhs, yy = 0, 0, 0
+    for X, y, w in _prepared(batches()):
+        batch_gram, batch_rhs = normal_equations(X, w, y)
+        gram = gram + batch_gram
+        rhs = rhs + batch_rhs
+        yy += float(np.sum(w * y ** 2))
+    if not isinstance(gram, np.ndarray):
+        raise ValueError('Cannot fit a least squares model on no batches.')
+    params = solve_normal_equations(gram, rhs)
+    deviance = yy - 2 * params @ rhs + params @ gram @ params
+    return LinearFit(params, deviance=float(deviance))
+
+
+def fit_glm(X: Design,
+            y: np.ndarray,
+            variance: str,
+            link: str,
+            weights: Optional[np.ndarray] = None,
+            max_iter: int = 100,
+            tol: float = 1e-8) -> LinearFit:
+    """
+    Fit a GLM by iteratively reweighted least squares. Each iteration
+    solves the weighted normal equations, so its cost scales with the
+    non-zeros of a sparse design rather than rows × columns.
+    """
+    return fit_glm_batches(lambda: [(X, y, weights)], variance, link,
+                           max_iter, tol)
+
+
+def fit_glm_batches(batches: Batches,
+                    variance: str,
+                    link: str,
+                    max_iter: int = 100,
+                    tol: float = 1e-8) -> LinearFit:
+    """
+    Fit a GLM by IRLS with one pass over the batches per iteration: each
+    pass accumulates XᵀWX and XᵀWz under the current coefficients, so only
+    one batch is held in memory at a time. Every pass reads the batches
+    again, so they should come from local disk rather than the network.
+    """
+    link_fun, inverse, inverse_deriv = LINKS[link]
+    variance_fun = VARIANCES[variance]
+
+    total, weight = 0.0, 0.0
+    for _, y, w in _prepared(batches()):
+        total += float(w @ y)
+        weight += float(w.sum())
+    if not weight:
+        raise ValueError('Cannot fit a GLM on no batches or zero weight.')
+    y_mean = total / weight
+
+    params = None
+    converged = False
+    for iteration in range(1, max_iter + 1):
+        gram, rhs = 0, 0
+        for X, y, w in _prepared(batches()):
+            if params is None:
+                # Same starting point as statsmodels.
+                mu = (y + y_mean) / 2
+                eta = link_fun(mu)
+            else:
+                eta = X @ params
+                mu = inverse(eta)
+            deriv = inverse_deriv(eta)
+            irls_w = w * deriv ** 2 / np.maximum(variance_fun(mu), EPS)
+            z = eta + (y - mu) / deriv
+            batch_gram, batch_rhs = normal_equations(X, irls_w, z)
+            gram = gram + batch_gram
+            rhs = rhs + batch_rhs
+
+        previous = params
+        params = solve_normal_equations(gram, rhs)
+        # Converge on the coefficients rather than the deviance, whose scale
+        # depends on whether the data was compressed into cells.
+        if previous is not None and np.allclose(params, previous,
+                                                rtol=tol, atol=0):
+            converged = True
+            break
+
+    if not converged:
+        logger.warning(f'IRLS did not converge in {max_iter} iterations.')
+    deviance = sum(float(np.sum(w * _unit_deviance(variance, y,
+                                                   inverse(X @ params))))
+                   for X, y, w in _prepared(batches()))
+    return LinearFit(params, link, variance, deviance, iteration, converged)
+
+
+def _prepared(batches: Iterable[Batch]) -> Iterator[Batch]:
+    for X, y, w in batches:
+        y = np.asarray(y, dtype=np.float64)
+        if w is None:
+            w = np.ones_like(y)
+        yield X, y, np.asarray(w, dtype=np.float64)
@@ -0,0 +1,153 @@
+import logging
+from typing import Callable, Dict, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.neural_network import MLPRegressor
+from sklearn.preprocessing import StandardScaler
+
+from features import FeatureSchema
+from solvers import Batches, fit_glm_batches, fit_ols_batches
+
+logger = logging.getLogger(__name__)
+
+# Produces a fresh pass over a policy file, one DataFrame chunk at a time.
+Source = Callable[[], Iterator[pd.DataFrame]]
+
+# Passes of stochastic gradient descent over the training batches, and the
+# hidden layers of the network fitted by them.
+MLM_EPOCHS = 5
+MLM_LAYERS = (32, 16)
+
+
+def claim_statistics(claims: pd.DataFrame) -> pd.DataFrame:
+    """
+    Claim count and average claim amount for every policy with a claim, on
+    the targets of `features.aggregate_claims`: the count is of claim ids,
+    and the average, E[X] given a claim, is NaN unless the claim amounts
+    total more than zero. This scales with the number of claims, not
+    policies, so it is held in memory while the policies are streamed.
+    """
+    grouped = claims.groupby('pol_id')
+    totals = grouped['claim_amount'].sum()
+    averages = totals / grouped['claim_amount'].count()
+    return pd.DataFrame({'count': grouped['claim_id'].count(),
+                         'average': averages.where(totals > 0)})
+
+
+def training_batches(source: Source,
+                     schema: FeatureSchema,
+                     stats: pd.DataFrame,
+                     sparse: bool = False) -> Tuple[Batches, Batches]:
+    """
+    Batch factories for the frequency and severity targets. Every pass
+    re-reads the policies from `source`, encodes each chunk with `schema`
+    and looks up its targets in the claim statistics. The frequency covers
+    every policy; the severity, as in memory, only the policies with a
+    claim.
+    """
+    def frequency() -> Iterator[tuple]:
+        for chunk in source():
+            y = (stats['count']
+                 .reindex(chunk['pol_id'].to_numpy())
+                 .fillna(0.0)
+                 .to_numpy())
+            yield schema.transform(chunk, sparse=sparse), y, None
+
+    def severity() -> Iterator[tuple]:
+        for chunk in source():
+            y = stats['average'].reindex(chunk['pol_id'].to_numpy())
+            claimed = y.notna().to_numpy()
+            if claimed.any():
+                yield (schema.transform(chunk[claimed], sparse=sparse),
+                       y.to_numpy()[claimed], None)
+
+    return frequency, severity
+
+
+class StreamingMLM:
+    """
+    Out-of-core stand-in for the in-memory random forest. No tree ensemble
+    in scikit-learn learns incrementally, so a multi-layer perceptron is
+    fitted instead: like the forest, it captures interactions between the
+    rating factors that the SLM and GLM cannot. The features are scaled
+    and the target divided by its root mean square for the optimiser, and
+    predictions are floored at zero as both targets are non-negative.
+    """
+
+    def __init__(self, sparse: bool = False) -> None:
+        self.scaler = StandardScaler(with_mean=not sparse)
+        self.model = MLPRegressor(hidden_layer_sizes=MLM_LAYERS,
+                                  random_state=42)
+        self.y_scale = 1.0
+
+    def fit_batches(self, batches: Batches) -> 'StreamingMLM':
+        """
+        Fit the scaling in a first pass over the batches, then the network
+        by `partial_fit` over `MLM_EPOCHS` further passes. Sample weights
+        are not supported by the network and are ignored.
+        """
+        total, count = 0.0, 0
+        for X, y, _ in batches():
+            self.scaler.partial_fit(X)
+            total += float(np.sum(np.square(y)))
+            count += len(y)
+        if not count:
+            raise ValueError('Cannot fit a model on no batches.')
+        self.y_scale = float(np.sqrt(total / count)) or 1.0
+        for _ in range(MLM_EPOCHS):
+            for X, y, _ in batches():
+                self.model.partial_fit(self.scaler.transform(X),
+                                       np.asarray(y) / self.y_scale)
+        return self
+
+    def predict(self, X) -> np.ndarray:
+        predicted = self.model.predict(self.scaler.transform(X))
+        return np.maximum(predicted * self.y_scale, 0.0)
+
+
+def build_mlm_batches(batches: Batches,
+                      sparse: bool = False) -> StreamingMLM:
+    """
+    Fit the out-of-core ML model, a `StreamingMLM`, on the batches.
+    """
+    return StreamingMLM(sparse).fit_batches(batches)
+
+
+def run_streaming_models(source: Source,
+                         claims: pd.DataFrame,
+                         testing: Source,
+                         sparse: bool = False) -> Dict[str, pd.DataFrame]:
+    """
+    Fit the SLM, GLM and ML models on policy chunks read from `source`,
+    then score the chunks of `testing`. Memory stays constant in the
+    number of policies: only one chunk, the claim statistics and the
+    normal equations are held at a time. The SLM and GLM coefficients
+    match the in-memory fits to within the IRLS tolerance.
+    """
+    logger.info('Fit feature schema on policy chunks.')
+    schema = FeatureSchema.fit_batches(source())
+    stats = claim_statistics(claims)
+    freq, sev = training_batches(source, schema, stats, sparse)
+
+    logger.info('Build streaming models.')
+    models = {
+        'slm': (fit_ols_batches(freq), fit_ols_batches(sev)),
+        'glm': (fit_glm_batches(freq, 'poisson', 'log'),
+                fit_glm_batches(sev, 'gamma', 'identity')),
+        'mlm': (build_mlm_batches(freq, sparse),
+                build_mlm_batches(sev, sparse)),
+    }
+
+    logger.info('Score test policies.')
+    predictions = {name: [] for name in models}
+    for chunk in testing():
+        X = schema.transform(chunk, sparse=sparse)
+        index = pd.Index(chunk['pol_id'].to_numpy(), name='pol_id')
+        for name, (freq_model, sev_model) in models.items():
+            predictions[name].append(pd.DataFrame(
+                {'E[N]': np.asarray(freq_model.predict(X)),
+                 'E[X]': np.asarray(sev_model.predict(X))},
+                index=index,
+            ))
+    return {name: pd.concat(frames) for name, frames in predictions.items()}
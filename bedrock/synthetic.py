@@ -0,0 +1,195 @@
+import logging
+import os
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+from loader import ParquetWriter
+
+logger = logging.getLogger(__name__)
+
+# Rows generated at a time, bounding the working memory of a large book.
+CHUNK_SIZE = 1000000
+
+# Files of a book written by `write_book`, named as the `SOURCE_FILES` of
+# the bucket but in Parquet, which can be written a chunk at a time.
+BOOK_FILES = {
+    'policies': 'train_policies.parquet',
+    'claims': 'train_claims.parquet',
+    'test': 'test_policies.parquet'
+}
+
+# The universe of the project README: four rating factors drive a Poisson
+# claim frequency and a log-normal claim size, which is expressed as a
+# share of the sum insured and capped at a total loss.
+TRADES = ['Factory', 'Office', 'Restaurant', 'Retail']
+YEARS = np.arange(1990, 2001)
+HEIGHTS = np.arange(1, 6)
+SUM_INSURED = np.arange(200000, 1000001, 80000, dtype=np.float64)
+
+# Claim frequency per trade, with multiplicative relativities per year
+# after 1990, per storey above the first and for sprinklers.
+TRADE_FREQUENCY = np.array([0.65, 0.055, 0.45, 0.25])
+YEAR_FREQUENCY = 0.97
+HEIGHT_FREQUENCY = 1.05
+SPRINKLER_FREQUENCY = 0.7
+
+# Mean and standard deviation of the log of claim size / sum insured,
+# with additive effects on the mean.
+TRADE_SEVERITY = np.array([-0.9, -2.2, -1.6, -1.9])
+YEAR_SEVERITY = -0.01
+HEIGHT_SEVERITY = 0.05
+SPRINKLER_SEVERITY = -0.3
+SEVERITY_SIGMA = 1.2
+
+
+def generate_book(n_policies: int,
+                  seed: int = 0,
+                  start_id: int = 1,
+                  chunk_size: int = CHUNK_SIZE
+                  ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Simulate `n_policies` policies and their claims, in the format of the
+    project's `train_policies.pkl` and `train_claims.pkl`.
+    """
+    policies, claims = zip(*iter_book(n_policies, seed, start_id,
+                                      chunk_size))
+    return (pd.concat(policies, ignore_index=True),
+            pd.concat(claims, ignore_index=True))
+
+
+def iter_book(n_policies: int,
+              seed: int = 0,
+              start_id: int = 1,
+              chunk_size: int = CHUNK_SIZE
+              ) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Simulate a book one chunk of policies at a time. The book is fixed by
+    the seed and chunk size, whatever the number of chunks consumed.
+    """
+    n_chunks = max(-(-n_policies // chunk_size), 1)
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    claim_id = 1
+    for i, chunk_seed in enumerate(seeds):
+        start = i * chunk_size
+        n = min(chunk_size, n_policies - start)
+        rng = np.random.default_rng(chunk_seed)
+        policies = _policies(rng, n, start_id + start)
+        claims = _claims(rng, policies, claim_id)
+        claim_id += len(claims)
+        yield policies, claims
+
+
+def expected(policies: pd.DataFrame) -> pd.DataFrame:
+    """
+    The true E[N] and E[X] of each policy under the simulated universe,
+    the target every model is benchmarked against.
+    """
+    trade, year, height, sprinklers = _factors(policies)
+    mu = _severity_mu(trade, year, height, sprinklers)
+    sigma = SEVERITY_SIGMA
+    # Mean of min(R, 1) for log-normal R.
+    capped = (np.exp(mu + sigma ** 2 / 2) * ndtr((-mu - sigma ** 2) / sigma)
+              + ndtr(mu / sigma))
+    return pd.DataFrame(
+        {'E[N]': _frequency(trade, year, height, sprinklers),
+         'E[X]': capped * policies['sum_insured'].to_numpy()},
+        index=pd.Index(policies['pol_id'].to_numpy(), name='pol_id'),
+    )
+
+
+def write_book(root: str,
+               n_policies: int,
+               n_test: Optional[int] = None,
+               seed: int = 0,
+               chunk_size: int = CHUNK_SIZE) -> None:
+    """
+    Write a training book, its claims and a test book under `root`, laid
+    out as the `bedrock` source folder of a local bucket. The books are
+    written as Parquet, one chunk of `iter_book` at a time, so only a
+    chunk is held in memory whatever the size of the book.
+    """
+    n_test = n_policies // 2 if n_test is None else n_test
+    path = os.path.join(root, 'bedrock')
+    os.makedirs(os.path.join(path, 'submissions'), exist_ok=True)
+
+    logger.info(f'Simulate {n_policies} training policies.')
+    with ParquetWriter(os.path.join(path, BOOK_FILES['policies'])) as pol, \
+            ParquetWriter(os.path.join(path, BOOK_FILES['claims'])) as clm:
+        for policies, claims in iter_book(n_policies, seed,
+                                          chunk_size=chunk_size):
+            pol.write(policies)
+            clm.write(claims)
+
+    logger.info(f'Simulate {n_test} test policies.')
+    with ParquetWriter(os.path.join(path, BOOK_FILES['test'])) as test:
+        for policies, _ in iter_book(n_test, seed + 1, n_policies + 1,
+                                     chunk_size):
+            test.write(policies)
+
+
+def _policies(rng: np.random.Generator,
+              n: int,
+              start_id: int) -> pd.DataFrame:
+    pol_id = np.arange(start_id, start_id + n)
+    # Categorical gathers build the string columns without a Python loop.
+    trade = pd.Categorical.from_codes(rng.integers(len(TRADES), size=n),
+                                      TRADES)
+    years = [f'year:{year}' for year in YEARS]
+    year_built = pd.Categorical.from_codes(rng.integers(len(YEARS), size=n),
+                                           years)
+    sprinklers = pd.Categorical.from_codes(rng.integers(2, size=n),
+                                           ['No', 'Yes'])
+    # The end points of the sum insured grid are half as likely, as in the
+    # original data, which rounded a uniform draw to the grid.
+    steps = len(SUM_INSURED) - 1
+    grid = np.rint(rng.uniform(0, steps, size=n)).astype(np.int64)
+    return pd.DataFrame({
+        'pol_id': pol_id,
+        'insured': np.char.add('Company_', pol_id.astype(str)).astype(object),
+        'trade': np.asarray(trade, dtype=object),
+        'year_built': np.asarray(year_built, dtype=object),
+        'height': rng.choice(HEIGHTS, size=n),
+        'sprinklers': np.asarray(sprinklers, dtype=object),
+        'sum_insured': SUM_INSURED[grid],
+    })
+
+
+def _claims(rng: np.random.Generator,
+            policies: pd.DataFrame,
+            first_id: int) -> pd.DataFrame:
+    trade, year, height, sprinklers = _factors(policies)
+    counts = rng.poisson(_frequency(trade, year, height, sprinklers))
+    rows = np.repeat(np.arange(len(policies)), counts)
+    mu = _severity_mu(trade, year, height, sprinklers)[rows]
+    share = np.minimum(rng.lognormal(mu, SEVERITY_SIGMA), 1.0)
+    sum_insured = policies['sum_insured'].to_numpy()[rows]
+    return pd.DataFrame({
+        'pol_id': policies['pol_id'].to_numpy()[rows],
+        'claim_id': np.arange(first_id, first_id + len(rows)),
+        'claim_amount': share * sum_insured,
+    })
+
+
+def _factors(policies: pd.DataFrame) -> Tuple[np.ndarray, ...]:
+    trade = pd.Index(TRADES).get_indexer(policies['trade'])
+    year = pd.to_numeric(policies['year_built'].str[-4:]).to_numpy()
+    height = policies['height'].to_numpy()
+    sprinklers = (policies['sprinklers'] == 'Yes').to_numpy()
+    return trade, year - YEARS[0], height - HEIGHTS[0], sprinklers
+
+
+def _frequency(trade, year, height, sprinklers) -> np.ndarray:
+    return (TRADE_FREQUENCY[trade]
+            * YEAR_FREQUENCY ** year
+            * HEIGHT_FREQUENCY ** height
+            * np.where(sprinklers, SPRINKLER_FREQUENCY, 1.0))
+
+
+def _severity_mu(trade, year, height, sprinklers) -> np.ndarray:
+    return (TRADE_SEVERITY[trade]
+            + YEAR_SEVERITY * year
+            + HEIGHT_SEVERITY * height
+            + SPRINKLER_SEVERITY * sprinklers)
@@ -0,0 +1,162 @@
+"""
+Benchmark `road_matcher.ROAD_MATCHER`, behind `parser.street_address`,
+against the original ``ROAD_PATTERN`` regex, checking that both give
+identical output.
+
+Addresses are read one per line from a file, or simulated in the style of
+UK property addresses when no file is given.
+
+Example
+-------
+    $ python -m cyutils.address.benchmark --addresses addresses.txt
+    $ python -m cyutils.address.benchmark -n 1000000
+
+Functions
+---------
+"""
+import argparse
+import random
+import time
+
+from cyutils.address import parser
+from cyutils.address.road_matcher import find_road
+from cyutils.address.road_types import STREET_NAMES
+
+
+PREFIXES = ['', '', '', 'FLAT 2, ', 'Unit 14 ', 'APARTMENT 7, ', 'Flat 3A ',
+            'THE OLD MILL, ', 'Rose Cottage, ', 'SUITE 5, 2ND FLOOR, ']
+DESCRIPTORS = ['', '', '', '', 'ST ', 'St. ', 'SAINT ', 'KING ', 'Upper ',
+               'GREAT ', 'WEST ', 'OLD ', 'North ']
+STREETS = ['HIGH', 'CHURCH', 'Mill', 'STATION', 'PARK', 'VICTORIA', 'GREEN',
+           "JOHN'S", 'MANOR', 'Queens', 'ALBERT', 'Kings', 'BRIDGE', 'LONDON']
+LOCALITIES = ['', '', 'CHELSEA, ', 'Little Snoring, ', 'Headingley ',
+              'NORTH, ', 'Old Town, ']
+TOWNS = ['LONDON', 'Manchester', 'LEEDS', 'Bristol', 'NORWICH', 'Cardiff',
+         'EDINBURGH', 'Milton Keynes']
+
+
+def simulate_addresses(n, seed=0):
+    """
+    Simulate UK style address strings, with mixed case, abbreviated and
+    multi-word road types, descriptors and some addresses with no road.
+
+    :param int n: number of addresses
+    :param int seed: random seed
+    :returns: simulated addresses
+    :rtype: list[str]
+    """
+    rng = random.Random(seed)
+    addresses = []
+    for _ in range(n):
+        if rng.random() < 0.1:
+            road = rng.choice(['The Barn', 'MEADOW VIEW', 'Hillside'])
+        else:
+            road = '{}{} {}'.format(rng.choice(DESCRIPTORS),
+                                    rng.choice(STREETS),
+                                    rng.choice(STREET_NAMES))
+        addresses.append('{}{}{} {},  {}{} {}{} {}{}{}'.format(
+            rng.choice(PREFIXES), rng.randint(1, 250),
+            rng.choice(['', '', 'A', 'B']), road,
+            rng.choice(LOCALITIES), rng.choice(TOWNS),
+            rng.choice('ABCEGLMNSW'), rng.randint(1, 30), rng.randint(0, 9),
+            rng.choice('ABDEFGHJ'), rng.choice('LNPQRSTUWXYZ'),
+        ))
+    return addresses
+
+
+def read_addresses(path):
+    """
+    Read addresses from a text file, one per line.
+
+    :param str path: file to read
+    :returns: addresses
+    :rtype: list[str]
+    """
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def regex_street_address(full_address):
+    """
+    `parser.street_address` as implemented with ``ROAD_PATTERN``, for
+    reference.
+
+    :param str full_address: street address to parse
+    :returns: parsed street address
+    :rtype: str
+    """
+    full_address = parser.normalise_address(full_address)
+    capture_groups = parser.ROAD_PATTERN.findall(full_address)
+    if capture_groups:
+        name, _type = parser.process_capture_groups(capture_groups)
+        return '{} {}'.format(name, _type)
+    return ''
+
+
+def benchmark_street_address(addresses):
+    """
+    Time the regex and the road matcher over the same addresses, on
+    normalised strings alone and through `street_address`, and check the
+    two agree on every address.
+
+    :param list[str] addresses: addresses to parse
+    :returns: seconds per address for each method, and mismatches
+    :rtype: dict[str, object]
+    """
+    normalised = [parser.normalise_address(address) for address in addresses]
+    timings = {}
+
+    start = time.perf_counter()
+    expected = [parser.ROAD_PATTERN.search(address) for address in normalised]
+    timings['regex_search'] = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [find_road(address) for address in normalised]
+    timings['find_road'] = time.perf_counter() - start
+    expected = [match.group(0) if match else '' for match in expected]
+
+    start = time.perf_counter()
+    before = [regex_street_address(address) for address in addresses]
+    timings['regex_street_address'] = time.perf_counter() - start
+    start = time.perf_counter()
+    after = [parser.street_address(address) for address in addresses]
+    timings['street_address'] = time.perf_counter() - start
+
+    mismatches = [address for address, old, new, a, b
+                  in zip(addresses, before, after, expected, found)
+                  if old != new or a != b]
+    results = {name: seconds / max(len(addresses), 1)
+               for name, seconds in timings.items()}
+    results['addresses'] = len(addresses)
+    results['mismatches'] = mismatches
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark street address parsing against ROAD_PATTERN.')
+    arg_parser.add_argument('--addresses',
+                            help='text file with one address per line')
+    arg_parser.add_argument('-n', type=int, default=1000000,
+                            help='addresses to simulate without a file')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    if args.addresses:
+        addresses = read_addresses(args.addresses)
+    else:
+        addresses = simulate_addresses(args.n, args.seed)
+    results = benchmark_street_address(addresses)
+
+    print('{} addresses, {} mismatches'.format(results['addresses'],
+                                               len(results['mismatches'])))
+    for address in results['mismatches'][:10]:
+        print('  mismatch: {!r}'.format(address))
+    for old, new in [('regex_search', 'find_road'),
+                     ('regex_street_address', 'street_address')]:
+        print('{:>22}: {:6.2f} us  {:>16}: {:6.2f} us  speedup {:.1f}x'.format(
+            old, results[old] * 1e6, new, results[new] * 1e6,
+            results[old] / results[new]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Postcode and street gazetteer stored as a compact, memory-mapped index.
+
+The index is one file of fixed-width records, each a postcode, street and
+town, sorted by postcode then street. Opening it maps the file into memory
+and reads only every `FENCE_STRIDE`th key, so a gazetteer of millions of
+records loads in milliseconds and its pages are shared between processes.
+A lookup bisects the fences in memory, then binary searches the one block
+of records between two fences in place.
+
+Example
+-------
+    >>> build_gazetteer([('SW3 4XD', 'Bywater St', 'London')], 'gb.idx')
+    1
+    >>> with Gazetteer('gb.idx') as gazetteer:
+    ...     gazetteer.contains('SW3 4XD', 'BYWATER STREET')
+    True
+
+Functions
+---------
+"""
+import bisect
+import mmap
+import struct
+from collections import namedtuple
+
+from cyutils.address.road_types import STREET_ABBREVIATION_TO_NAME
+
+
+MAGIC = b'CYGAZIDX'
+INDEX_VERSION = 1
+# Magic, version, record count, and the widths of the street and town.
+HEADER = struct.Struct('<8sIQII')
+POSTCODE_WIDTH = 8
+STREET_WIDTH = 48
+TOWN_WIDTH = 32
+# Records between the keys held in memory to narrow each search.
+FENCE_STRIDE = 64
+
+GazetteerEntry = namedtuple('GazetteerEntry', ['postcode', 'street', 'town'])
+
+
+def postcode_key(postcode):
+    """
+    Normalise a postcode for the index: upper case without spaces.
+
+    :param str postcode: UK postcode
+    :returns: postcode key
+    :rtype: str
+    """
+    return ''.join(str(postcode).upper().split())
+
+
+def format_postcode(postcode):
+    """
+    Write a postcode in its standard form, upper case with a single space
+    before the inward code.
+
+    .. doctest::
+        >>> format_postcode('sw34xd')
+        SW3 4XD
+
+    :param str postcode: UK postcode
+    :returns: formatted postcode
+    :rtype: str
+    """
+    key = postcode_key(postcode)
+    return '{} {}'.format(key[:-3], key[-3:])
+
+
+def street_key(street):
+    """
+    Normalise a street for the index as `parser.street_address` does: upper
+    case, single spaces, no commas and the road type expanded.
+
+    :param str street: street name and type
+    :returns: street key
+    :rtype: str
+    """
+    tokens = str(street).upper().replace(',', ' ').split()
+    if tokens and tokens[-1] in STREET_ABBREVIATION_TO_NAME:
+        tokens[-1] = STREET_ABBREVIATION_TO_NAME[tokens[-1]]
+    return ' '.join(tokens)
+
+
+def build_gazetteer(records, path, street_width=STREET_WIDTH,
+                    town_width=TOWN_WIDTH):
+    """
+    Write an index of (postcode, street, town) records, such as rows of an
+    open postcode directory, to `path`. Duplicate records are dropped, and
+    streets and towns longer than their width are truncated.
+
+    :param iterable[tuple[str, str, str]] records: postcode, street and town
+    :param str path: index file to write
+    :param int street_width: bytes stored per street
+    :param int town_width: bytes stored per town
+    :returns: number of records written
+    :rtype: int
+    """
+    rows = set()
+    for postcode, street, town in records:
+        rows.add(_pack(postcode_key(postcode), POSTCODE_WIDTH)
+                 + _pack(street_key(street), street_width)
+                 + _pack(' '.join(str(town).upper().split()), town_width))
+    rows = sorted(rows)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, INDEX_VERSION, len(rows), street_width,
+                            town_width))
+        f.writelines(rows)
+    return len(rows)
+
+
+class Gazetteer:
+    """
+    Read-only view of an index written by `build_gazetteer`. Records are
+    compared as bytes in the mapped file, and a lookup reads at most a
+    handful of them whatever the size of the gazetteer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, street_width, town_width = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != INDEX_VERSION:
+            self._map.close()
+            raise ValueError('{} is not a version {} gazetteer index'.format(
+                path, INDEX_VERSION))
+        self._count = count
+        self._street_width = street_width
+        self._town_width = town_width
+        self._width = POSTCODE_WIDTH + street_width + town_width
+        key_width = POSTCODE_WIDTH + street_width
+        self._fences = [self._key(i, key_width)
+                        for i in range(0, count, FENCE_STRIDE)]
+
+    def __len__(self):
+        return self._count
+
+    def entries(self, postcode):
+        """
+        Every record for a postcode.
+
+        :param str postcode: UK postcode, with or without its space
+        :returns: matching records, sorted by street
+        :rtype: list[GazetteerEntry]
+        """
+        key = _pack(postcode_key(postcode), POSTCODE_WIDTH)
+        entries = []
+        i = self._bisect(key)
+        while i < self._count and self._key(i, POSTCODE_WIDTH) == key:
+            entries.append(self._entry(i))
+            i += 1
+        return entries
+
+    def contains(self, postcode, street=None):
+        """
+        Whether a postcode, or a street within it, is in the gazetteer.
+
+        :param str postcode: UK postcode, with or without its space
+        :param str street: street name and type, or None for any
+        :returns: whether a record matches
+        :rtype: bool
+        """
+        key = _pack(postcode_key(postcode), POSTCODE_WIDTH)
+        if street is not None:
+            key += _pack(street_key(street), self._street_width)
+        i = self._bisect(key)
+        return i < self._count and self._key(i, len(key)) == key
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _bisect(self, key):
+        # First record whose leading bytes are >= key. It follows the last
+        # fence below the key and is at most the next fence.
+        fence = bisect.bisect_left(self._fences, key)
+        low = max((fence - 1) * FENCE_STRIDE + 1, 0)
+        high = min(fence * FENCE_STRIDE, self._count)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle, len(key)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _key(self, i, length):
+        offset = HEADER.size + i * self._width
+        return self._map[offset:offset + length]
+
+    def _entry(self, i):
+        record = self._key(i, self._width)
+        street_end = POSTCODE_WIDTH + self._street_width
+        postcode = _unpack(record[:POSTCODE_WIDTH])
+        return GazetteerEntry(format_postcode(postcode),
+                              _unpack(record[POSTCODE_WIDTH:street_end]),
+                              _unpack(record[street_end:]))
+
+
+def _pack(text, width):
+    data = text.encode('utf-8')[:width]
+    return data + b'\0' * (width - len(data))
+
+
+def _unpack(data):
+    return data.rstrip(b'\0').decode('utf-8', errors='ignore')
@@ -12,9 +12,15 @@ Example
 Functions
 ---------
 """
+import bisect
+import itertools
+import json
 import re
 import warnings
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
+from cyutils.address.road_matcher import find_road
 from cyutils.address.road_types import STREET_NAMES
 from cyutils.address.road_types import STREET_ABBREVIATION_TO_NAME
 
@@ -37,6 +43,45 @@ NUMBER_PATTERN = re.compile(NUMBER_PATTERN.format(number_prefix,
                                                   numeric_part_1,
                                                   numeric_part_2))
 
+NUMBER_WARNING = """\n
+        This parser should be used with the knowledge that this
+        function is open to four significant vulnerabilities:
+           1) `number()` will parse the first numeric characters it
+              an address string contains (read from left to right).
+              If the address string has:
+                a) no building number
+                b) numeric characters unrelated to addressable
+                   information at the start of the address string
+           2) Address numbers separated by `&` or `,` will not be parsed
+           3) Building names that include numeric characters are
+              incorrectly parsed as building numbers\n
+    """
+
+# Columns of `parse_addresses`, and the rows sent to each process at a time.
+ADDRESS_FIELDS = ['street', 'type', 'postcode', 'number']
+CHUNK_SIZE = 100000
+
+CACHE_SIZE = 1000000
+CACHE_VERSION = 1
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# The cache of parsed addresses shared by the extractors, if enabled.
+_cache = None
+
+# Structured result of `number_match`. `multiple` is set when the address
+# has further numbers, as in 12 & 14 or FLAT 3, 12 HIGH ST, and
+# `building_name` when the number may belong to a building or floor name, as
+# in TOWER 42 or 3RD FLOOR. Each flag scales the confidence of a match.
+NumberMatch = namedtuple('NumberMatch', ['number', 'confidence', 'multiple',
+                                         'building_name'])
+NUMBER_CONFIDENCE = {'multiple': 0.5, 'building_name': 0.5}
+NAMED_NUMBER = re.compile(r'\d[A-Z]{2}')
+# NUMBER_PATTERN matches at any digit, so a digit outside a postcode means
+# a further number.
+DIGIT = re.compile(r'\d')
+
+_number_warned = False
+
 
 def process_capture_groups(group):
     """
@@ -48,10 +93,21 @@ def process_capture_groups(group):
     :returns: (concatenated address, extended abbreviation)
     :rtype: tuple[str, str]
     """
-    group = group[0][0].replace(',', '')
-    group = group.split(' ')
-    street_type = group[-1]
-    street_name = ' '.join(group[:-1])
+    return split_road(group[0][0])
+
+
+def split_road(road):
+    """
+    Remove any commas from a matched road, split on whitespace and if the last
+    token is an abbreviation of a road type, replace it with the full string.
+
+    :param str road: road matched by ROAD_PATTERN or `find_road`
+    :returns: (concatenated address, extended abbreviation)
+    :rtype: tuple[str, str]
+    """
+    tokens = road.replace(',', '').split(' ')
+    street_type = tokens[-1]
+    street_name = ' '.join(tokens[:-1])
     if street_type in STREET_ABBREVIATION_TO_NAME.keys():
         street_type = STREET_ABBREVIATION_TO_NAME[street_type]
     return street_name, street_type
@@ -70,10 +126,12 @@ def street_address(full_address):
     :returns: parsed street address
     :rtype: str
     """
+    if _cache is not None:
+        return _cache.get(full_address)[0]
     full_address = normalise_address(full_address)
-    capture_groups = ROAD_PATTERN.findall(full_address)
-    if capture_groups:
-        name, _type = process_capture_groups(capture_groups)
+    road = find_road(full_address)
+    if road:
+        name, _type = split_road(road)
         return '{} {}'.format(name, _type)
     return ''
 
@@ -90,6 +148,8 @@ def postcode(full_address):
     :returns: matched postcode
     :rtype: str
     """
+    if _cache is not None:
+        return _cache.get(full_address)[2]
     return capture_address_element(POSTCODE_PATTERN, full_address)
 
 
@@ -105,23 +165,315 @@ def number(full_address):
     :returns: matched building number
     :rtype: str
     """
-    warning_message = """\n
-        This parser should be used with the knowledge that this
-        function is open to four significant vulnerabilities:
-           1) `number()` will parse the first numeric characters it
-              an address string contains (read from left to right).
-              If the address string has:
-                a) no building number
-                b) numeric characters unrelated to addressable
-                   information at the start of the address string
-           2) Address numbers separated by `&` or `,` will not be parsed
-           3) Building names that include numeric characters are
-              incorrectly parsed as building numbers\n
-    """
-    warnings.warn(warning_message)
+    warnings.warn(NUMBER_WARNING)
+    if _cache is not None:
+        return _cache.get(full_address)[3]
     return capture_address_element(NUMBER_PATTERN, full_address)
 
 
+def number_match(full_address):
+    """
+    Parse a building number from a string as `number` does, without the
+    warning, and flag the ambiguities the warning describes.
+
+    .. doctest::
+        >>> number_match('Tower 42, 25 Old Broad St')
+        NumberMatch(number='42', confidence=0.25, multiple=True,
+                    building_name=True)
+
+    :param str full_address: string to search for a building number
+    :returns: matched building number, confidence and ambiguity flags
+    :rtype: NumberMatch
+    """
+    address = normalise_address(full_address)
+    match = NUMBER_PATTERN.search(address)
+    if not match:
+        return NumberMatch('', 0.0, False, False)
+    # The digits of a postcode are not further building numbers.
+    rest = POSTCODE_PATTERN.sub(' ', address[match.end():])
+    multiple = DIGIT.search(rest) is not None
+    # An unprefixed number after other words of its part of the address.
+    building_name = bool(
+        NAMED_NUMBER.search(match.group(0))
+        or (match.group(2) is None
+            and address[address.rfind(',', 0, match.start()) + 1:
+                        match.start()].strip())
+    )
+    confidence = 1.0
+    if multiple:
+        confidence *= NUMBER_CONFIDENCE['multiple']
+    if building_name:
+        confidence *= NUMBER_CONFIDENCE['building_name']
+    return NumberMatch(match.group(0), confidence, multiple, building_name)
+
+
+def extract_numbers(addresses):
+    """
+    Parse the building numbers of many addresses with `number_match`, giving
+    the `number` warning once per process.
+
+    :param iterable[str] addresses: addresses, e.g. a pandas Series
+    :returns: number, confidence and flags of each address
+    :rtype: list[NumberMatch]
+    """
+    warn_number_usage()
+    return [number_match(address) for address in addresses]
+
+
+def warn_number_usage():
+    """
+    Give the warning of `number` the first time it is called in a process.
+    """
+    global _number_warned
+    if not _number_warned:
+        warnings.warn(NUMBER_WARNING)
+        _number_warned = True
+
+
+def parse_address(full_address):
+    """
+    Parse the street, road type, postcode and building number of an address,
+    normalising it once for all of them. Each field is as returned by
+    `street_address`, `postcode` and `number`, with the road type as
+    expanded by `street_address`.
+
+    .. doctest::
+        >>> parse_address('221b Baker St, London NW1 6XE')
+        ('BAKER STREET', 'STREET', 'NW1 6XE', '221B')
+
+    :param str full_address: address to parse
+    :returns: street, road type, postcode and building number
+    :rtype: tuple[str, str, str, str]
+    """
+    if _cache is not None:
+        return _cache.get(full_address)
+    return _parse_address(full_address)
+
+
+def _parse_address(full_address):
+    address = normalise_address(full_address)
+    road = find_road(address)
+    if road:
+        name, _type = split_road(road)
+        street = '{} {}'.format(name, _type)
+    else:
+        street = _type = ''
+    match = POSTCODE_PATTERN.search(address)
+    _postcode = match.group(0) if match else ''
+    match = NUMBER_PATTERN.search(address)
+    _number = match.group(0) if match else ''
+    return street, _type, _postcode, _number
+
+
+def parse_addresses(addresses, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Parse a column of addresses with `parse_address`. The `number` warning
+    is given once per process rather than once per address. Each distinct
+    address is parsed once, and only if it is not in the enabled cache, to
+    which it is then added. With `processes`, addresses are parsed in
+    chunks of `chunk_size` across a process pool.
+
+    .. doctest::
+        >>> import pandas as pd
+        >>> parse_addresses(pd.Series(['privet dr', '9 Bywater St SW3 4XD']))
+                   street    type postcode number
+        0    PRIVET DRIVE   DRIVE
+        1  BYWATER STREET  STREET  SW3 4XD      9
+
+    :param iterable[str] addresses: addresses, e.g. a pandas Series
+    :param int processes: number of processes, or None to parse in this one
+    :param int chunk_size: addresses sent to a process at a time
+    :returns: one row per address, on the index of a Series
+    :rtype: pandas.DataFrame
+    """
+    import pandas as pd
+
+    index = addresses.index if isinstance(addresses, pd.Series) else None
+    keys = [str(address) for address in addresses]
+    warn_number_usage()
+    # Workers do not share this process's cache, so it is consulted here
+    # and only the misses are sent out.
+    fields = {}
+    misses = []
+    for key in OrderedDict.fromkeys(keys):
+        cached = None if _cache is None else _cache.lookup(key)
+        if cached is None:
+            misses.append(key)
+        else:
+            fields[key] = cached
+    if processes and len(misses) > chunk_size:
+        chunks = [misses[i:i + chunk_size]
+                  for i in range(0, len(misses), chunk_size)]
+        with ProcessPoolExecutor(processes) as executor:
+            parsed = list(itertools.chain.from_iterable(
+                executor.map(_parse_chunk, chunks)))
+    else:
+        parsed = _parse_chunk(misses)
+    for key, row in zip(misses, parsed):
+        fields[key] = row
+        if _cache is not None:
+            _cache.add(key, row)
+    rows = [fields[key] for key in keys]
+    return pd.DataFrame(rows, columns=ADDRESS_FIELDS, index=index)
+
+
+def _parse_chunk(addresses):
+    return [_parse_address(address) for address in addresses]
+
+
+class AddressCache:
+    """
+    Bounded cache of parsed addresses, keyed on the raw string and evicting
+    the least recently used. An address is normalised and parsed once for
+    every extractor: `street_address`, `postcode`, `number` and
+    `parse_address` all read their field from the same entry.
+
+    Enable it for the module with `enable_cache`. It lives in the enabling
+    process: `parse_addresses` reads it before sending the misses to its
+    workers, and adds their results to it.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, full_address):
+        """
+        Parsed fields of an address, as `parse_address`, from the cache if
+        present.
+
+        :param str full_address: address to parse
+        :returns: street, road type, postcode and building number
+        :rtype: tuple[str, str, str, str]
+        """
+        if not isinstance(full_address, str):
+            full_address = str(full_address)
+        fields = self.lookup(full_address)
+        if fields is None:
+            fields = _parse_address(full_address)
+            self.add(full_address, fields)
+        return fields
+
+    def lookup(self, full_address):
+        """
+        Parsed fields of an address if cached, without parsing it.
+
+        :param str full_address: address to look up
+        :returns: street, road type, postcode and building number, or None
+        :rtype: tuple[str, str, str, str]
+        """
+        fields = self._entries.get(full_address)
+        if fields is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(full_address)
+        return fields
+
+    def add(self, full_address, fields):
+        """
+        Cache the parsed fields of an address, such as those parsed by
+        another process, evicting the least recently used if full.
+
+        :param str full_address: address parsed
+        :param tuple[str, str, str, str] fields: its parsed fields
+        """
+        self._entries[full_address] = fields
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def preload(self, addresses):
+        """
+        Parse addresses into the cache ahead of a run.
+
+        :param iterable[str] addresses: addresses to parse
+        """
+        for address in addresses:
+            self.get(address)
+
+    def info(self):
+        """
+        :returns: hits, misses, maximum and current size
+        :rtype: CacheInfo
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        self.hits = self.misses = 0
+        self._entries.clear()
+
+    def save(self, path):
+        """
+        Write the cached addresses to a JSON file, least recently used
+        first, for `load` to restore in a later run.
+
+        :param str path: file to write
+        """
+        with open(path, 'w') as f:
+            json.dump({'version': CACHE_VERSION,
+                       'entries': list(self._entries.items())}, f)
+
+    @classmethod
+    def load(cls, path, maxsize=CACHE_SIZE):
+        """
+        Read a cache written by `save`. Entries parsed with a different
+        cache version are not trusted and the cache starts empty.
+
+        :param str path: file to read
+        :param int maxsize: maximum number of entries
+        :returns: the loaded cache
+        :rtype: AddressCache
+        """
+        cache = cls(maxsize)
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') == CACHE_VERSION:
+            for key, fields in data['entries'][-maxsize:]:
+                cache._entries[key] = tuple(fields)
+        return cache
+
+
+def enable_cache(maxsize=CACHE_SIZE, path=None):
+    """
+    Cache parsed addresses for every extractor in this module, optionally
+    starting from a cache saved to `path`.
+
+    .. doctest::
+        >>> cache = enable_cache()
+        >>> street_address('privet dr'), postcode('privet dr')
+        ('PRIVET DRIVE', '')
+        >>> cache.info()
+        CacheInfo(hits=1, misses=1, maxsize=1000000, currsize=1)
+
+    :param int maxsize: maximum number of addresses cached
+    :param str path: file saved by `AddressCache.save`, if any
+    :returns: the enabled cache
+    :rtype: AddressCache
+    """
+    global _cache
+    if path is None:
+        _cache = AddressCache(maxsize)
+    else:
+        _cache = AddressCache.load(path, maxsize)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def address_cache():
+    """
+    :returns: the enabled cache, or None
+    :rtype: AddressCache
+    """
+    return _cache
+
+
 def capture_address_element(regex_object, full_address):
     """
     Search a string for the first instance of a regex pattern, returning the
@@ -145,8 +497,76 @@ def normalise_address(address):
     with a single space, removing spaces prior to commas and uppercasing
     the string.
 
+    Splitting on whitespace and joining with single spaces collapses the
+    same characters as the regex \\s+, in one pass over the string.
+
     :param str address: string to be normalised
     :returns: normalised string
     :rtype: str
     """
-    return re.sub('\s+', ' ', str(address).upper()).replace(' ,', ',')
+    address = str(address).upper()
+    text = ' '.join(address.split())
+    if text:
+        if address[0].isspace():
+            text = ' ' + text
+        if address[-1].isspace():
+            text += ' '
+    elif address:
+        text = ' '
+    return text.replace(' ,', ',')
+
+
+class NormalisedAddress(namedtuple('NormalisedAddress',
+                                   ['text', 'tokens', 'starts'])):
+    """
+    A normalised address with its tokens, the text split on single spaces,
+    and the offset in the text at which each token starts. Matches found in
+    the text, such as `road_span`, map back to tokens with `token_range`.
+    """
+
+    __slots__ = ()
+
+    def token_range(self, start, end):
+        """
+        :param int start: offset of the first character of a span
+        :param int end: offset after its last character
+        :returns: index of the first token in the span, and after the last
+        :rtype: tuple[int, int]
+        """
+        return (bisect.bisect_right(self.starts, start) - 1,
+                bisect.bisect_left(self.starts, end))
+
+    def span(self, first, last):
+        """
+        :param int first: index of the first token
+        :param int last: index after the last token
+        :returns: offsets of the text covering the tokens
+        :rtype: tuple[int, int]
+        """
+        return (self.starts[first],
+                self.starts[last - 1] + len(self.tokens[last - 1]))
+
+
+def tokenise_address(address):
+    """
+    Normalise an address as `normalise_address` and split it into tokens.
+
+    .. doctest::
+        >>> address = tokenise_address('221b  baker st , london')
+        >>> address.text
+        '221B BAKER ST, LONDON'
+        >>> address.tokens, address.starts
+        (['221B', 'BAKER', 'ST,', 'LONDON'], [0, 5, 11, 15])
+        >>> address.token_range(5, 13), address.span(1, 3)
+        ((1, 3), (5, 14))
+
+    :param str address: string to be normalised
+    :returns: normalised text, tokens and token offsets
+    :rtype: NormalisedAddress
+    """
+    text = normalise_address(address)
+    tokens = text.split(' ')
+    starts = [0]
+    starts.extend(itertools.accumulate(len(token) + 1
+                                       for token in tokens[:-1]))
+    return NormalisedAddress(text, tokens, starts)
@@ -0,0 +1,120 @@
+"""
+Road matcher returning the same first road in an address as
+``parser.ROAD_PATTERN``, in a fraction of the time.
+
+``ROAD_PATTERN`` puts a word of any length before a 68-way alternation of
+road types, so from every character of the string the regex engine grows
+the word, then backtracks through it trying every road type after each
+shorter word. ``ROAD_MATCHER`` is the same automaton with the redundant
+paths removed:
+
+- road types and descriptors are compiled into character tries, so that
+  types sharing a prefix share its tests: ST(?:R(?:EET|T|)|) rather than
+  STREET|STRT|ST|STR;
+- a road name without a descriptor is only started at the beginning of a
+  word, as starting inside it can only find the same road type;
+- matches are only attempted at letters, which the engine skips to.
+
+Example
+-------
+    >>> road_matcher.find_road('4 PRIVET DR, LITTLE WHINGING')
+    PRIVET DR
+
+Functions
+---------
+"""
+import re
+
+from cyutils.address.road_types import STREET_NAMES
+
+
+# Words ROAD_PATTERN accepts before the name of a road, as in ST JOHNS ROAD.
+STREET_DESCRIPTORS = ['ST.', 'ST', 'SAINT', 'KING', 'QUEEN', 'UPPER', 'LOWER',
+                      'HALF', 'GREAT', 'WEST', 'EAST', 'NORTH', 'SOUTH', 'OLD']
+
+# The only location ROAD_PATTERN can match after a road type: its
+# alternation binds the leading space to NORTH alone, and the other
+# locations cannot follow a word boundary.
+LOCATION_SUFFIX = ' NORTH,'
+
+
+def trie_pattern(words):
+    """
+    Build a regex alternation of `words` from a character trie. Branches
+    are ordered by the first word they lead to, so where one listed word
+    is a prefix of another, as HILL is of HILL STREET, the one listed first
+    is tried first, as in a plain alternation.
+
+    .. doctest::
+        >>> trie_pattern(['STREET', 'STRT', 'ST', 'STR'])
+        ST(?:R(?:EET|T|)|)
+
+    :param list[str] words: words to match, in priority order
+    :returns: regex pattern
+    :rtype: str
+    """
+    trie = {}
+    for priority, word in enumerate(words):
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node.setdefault('', priority)
+
+    def branch(node):
+        alternatives = []
+        for character, child in node.items():
+            if character:
+                priority, pattern = branch(child)
+                alternatives.append((priority, re.escape(character) + pattern))
+            else:
+                alternatives.append((child, ''))
+        alternatives.sort()
+        patterns = [pattern for _, pattern in alternatives]
+        if len(patterns) == 1:
+            return alternatives[0][0], patterns[0]
+        return alternatives[0][0], '(?:{})'.format('|'.join(patterns))
+
+    return branch(trie)[1]
+
+
+ROAD_MATCHER = re.compile(
+    r"(?=[A-Za-z'])"
+    r"(?:\b(?:{}) [A-Za-z']+|(?<![A-Za-z'])[A-Za-z']+)"
+    r" (?:{})\b(?:{})?".format(trie_pattern(STREET_DESCRIPTORS),
+                               trie_pattern(STREET_NAMES),
+                               re.escape(LOCATION_SUFFIX))
+)
+
+
+def find_road(address):
+    """
+    Find the first road in an address: the road type with the word before
+    it and any descriptor or location around them. The address should be
+    normalised, as road types are matched in upper case.
+
+    .. doctest::
+        >>> find_road('FLAT 2, 14 ST JOHNS ROAD NORTH, LONDON')
+        ST JOHNS ROAD NORTH,
+
+    :param str address: address to search
+    :returns: matched road or empty string
+    :rtype: str
+    """
+    match = ROAD_MATCHER.search(address)
+    if match:
+        return match.group(0)
+    return ''
+
+
+def road_span(address):
+    """
+    Locate the first road in an address, as `find_road`.
+
+    :param str address: address to search
+    :returns: start and end offset of the road
+    :rtype: tuple[int, int] or None
+    """
+    match = ROAD_MATCHER.search(address)
+    if match:
+        return match.span()
+    return None
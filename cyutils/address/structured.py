@@ -0,0 +1,173 @@
+"""
+Structured parser splitting a UK address into its sub-building, building
+name and number, street, locality, town and postcode, optionally validated
+against a `gazetteer.Gazetteer` of known postcodes and streets.
+
+The postcode is found with ``parser.POSTCODE_PATTERN`` and the street with
+`road_matcher.road_span`, as in `parser.parse_address`. The rest of the
+address is split on commas around them: parts before the street hold the
+sub-building, building name and number, and parts after it the locality and
+town.
+
+Example
+-------
+    >>> structured.parse_structured('Flat 2, 14 St Johns Rd, Chelsea, '
+    ...                             'London SW3 4XD')
+    StructuredAddress(sub_building='FLAT 2', building_name='',
+                      building_number='14', street='ST JOHNS ROAD',
+                      locality='CHELSEA', town='LONDON', postcode='SW3 4XD',
+                      postcode_valid=None, street_valid=None)
+
+Functions
+---------
+"""
+import re
+from collections import namedtuple
+
+from cyutils.address.gazetteer import format_postcode
+from cyutils.address.parser import POSTCODE_PATTERN
+from cyutils.address.parser import normalise_address, split_road
+from cyutils.address.road_matcher import road_span
+
+
+# Fields of a structured address. The validity flags are None without a
+# gazetteer to check against.
+STRUCTURED_FIELDS = ['sub_building', 'building_name', 'building_number',
+                     'street', 'locality', 'town', 'postcode',
+                     'postcode_valid', 'street_valid']
+StructuredAddress = namedtuple('StructuredAddress', STRUCTURED_FIELDS)
+
+# Words opening the part of an address naming a flat, unit or floor within
+# a building.
+SUB_BUILDING_PREFIXES = ['FLAT', 'FLATS', 'APARTMENT', 'APT', 'UNIT', 'UNITS',
+                         'SUITE', 'ROOM', 'STUDIO', 'MAISONETTE']
+SUB_BUILDING_PATTERN = re.compile(
+    r'(?:{})\b|\S+ FLOOR\b|BASEMENT\b'.format('|'.join(SUB_BUILDING_PREFIXES)))
+# A building number or range, as in 12, 221B, 12-14 or 3/5.
+BUILDING_NUMBER_PATTERN = re.compile(r'\d+[A-Z]?(?:[-/]\d+[A-Z]?)?')
+
+
+def parse_structured(full_address, gazetteer=None):
+    """
+    Split an address into its parts. With a gazetteer, the postcode and the
+    street within it are checked, and the town is taken from the gazetteer
+    where the address gives none or runs it into the locality.
+
+    .. doctest::
+        >>> parse_structured('Rose Cottage 3 Mill Lane Little Snoring')
+        StructuredAddress(sub_building='', building_name='ROSE COTTAGE',
+                          building_number='3', street='MILL LANE',
+                          locality='', town='LITTLE SNORING', postcode='',
+                          postcode_valid=None, street_valid=None)
+
+    :param str full_address: address to parse
+    :param gazetteer.Gazetteer gazetteer: known postcodes and streets, if any
+    :returns: parts of the address, upper case
+    :rtype: StructuredAddress
+    """
+    address = normalise_address(full_address)
+
+    # The postcode ends a UK address, so take the last one.
+    _postcode = ''
+    for match in POSTCODE_PATTERN.finditer(address):
+        _postcode = match
+    if _postcode:
+        address = address[:_postcode.start()] + address[_postcode.end():]
+        _postcode = format_postcode(_postcode.group(0))
+
+    span = road_span(address)
+    if span:
+        name, _type = split_road(address[span[0]:span[1]])
+        street = '{} {}'.format(name, _type)
+        premises = _segments(address[:span[0]])
+        areas = _segments(address[span[1]:])
+        building_number = _pop_building_number(premises)
+    else:
+        street, premises, areas, building_number = _split_unnamed(address)
+
+    sub_buildings = []
+    building_names = []
+    for segment in premises:
+        if SUB_BUILDING_PATTERN.match(segment):
+            sub_buildings.append(segment)
+        else:
+            building_names.append(segment)
+
+    postcode_valid = street_valid = None
+    known_town = ''
+    if gazetteer is not None:
+        entries = gazetteer.entries(_postcode) if _postcode else []
+        postcode_valid = bool(entries)
+        # The gazetteer compares the street truncated as it is stored.
+        street_valid = postcode_valid and gazetteer.contains(_postcode,
+                                                             street)
+        if entries:
+            known_town = entries[0].town
+    locality, town = _split_areas(areas, known_town)
+
+    return StructuredAddress(', '.join(sub_buildings),
+                             ', '.join(building_names), building_number,
+                             street, locality, town, _postcode,
+                             postcode_valid, street_valid)
+
+
+def parse_structured_addresses(addresses, gazetteer=None):
+    """
+    Parse a column of addresses with `parse_structured`.
+
+    :param iterable[str] addresses: addresses, e.g. a pandas Series
+    :param gazetteer.Gazetteer gazetteer: known postcodes and streets, if any
+    :returns: one row per address, on the index of a Series
+    :rtype: pandas.DataFrame
+    """
+    import pandas as pd
+
+    index = addresses.index if isinstance(addresses, pd.Series) else None
+    rows = [parse_structured(address, gazetteer) for address in addresses]
+    return pd.DataFrame(rows, columns=STRUCTURED_FIELDS, index=index)
+
+
+def _segments(text):
+    return [segment.strip() for segment in text.split(',') if segment.strip()]
+
+
+def _pop_building_number(premises):
+    # The building number is the last word before the street, unless it
+    # numbers a sub-building, as in UNIT 14 HIGH STREET.
+    if not premises:
+        return ''
+    words = premises[-1].split(' ')
+    if not BUILDING_NUMBER_PATTERN.fullmatch(words[-1]):
+        return ''
+    if len(words) == 2 and words[0] in SUB_BUILDING_PREFIXES:
+        return ''
+    premises[-1] = ' '.join(words[:-1])
+    if not premises[-1]:
+        premises.pop()
+    return words[-1]
+
+
+def _split_unnamed(address):
+    # Without a road type, a street is the words after the first building
+    # number opening a part of the address, as in 12 MEADOW VIEW.
+    segments = _segments(address)
+    for i, segment in enumerate(segments):
+        number, _, rest = segment.partition(' ')
+        if rest and BUILDING_NUMBER_PATTERN.fullmatch(number):
+            return rest, segments[:i], segments[i + 1:], number
+    if len(segments) > 1:
+        return '', segments[:1], segments[1:], ''
+    return '', [], segments, ''
+
+
+def _split_areas(areas, known_town):
+    # The last part is the town, unless the gazetteer's town ends it, as in
+    # CHELSEA LONDON, and the parts between the street and town are the
+    # locality.
+    if not areas:
+        return '', known_town
+    *localities, town = areas
+    if known_town and town != known_town and town.endswith(' ' + known_town):
+        localities.append(town[:-len(known_town) - 1])
+        town = known_town
+    return ', '.join(localities), town
@@ -1,62 +1,594 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
 import os
 import re
-import csv
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from bedrock import instrument
+from bedrock.instrument import span
+
 
 FILE_LOC = 'Submissions'
 ANSWER_FILE = 'test_policies_with_answers.csv'
-BASE_PATTERN = "([a-zA-Z]*)-{}-01Vanilla.pkl"
+RESULTS_FILE = 'SubmissionAnswers.csv'
+GRADES_FILE = 'SubmissionGrades.json'
+BASE_PATTERN = "([a-zA-Z]*)-{}-01Vanilla\\.(?:pkl|parquet|csv)"
 MODEL_PATTERN = "-([a-zA-Z]{2,3})-"
 
 
 MODELS = ['LM', 'GLM', 'ML']
+TARGETS = ['E[N]', 'E[X]']
+FIELD_NAMES = ['model', 'scientist', 'MSE E[N]', 'MSE E[X]']
+INTERVAL_FIELDS = [f'{stat} {target}' for target in TARGETS
+                   for stat in ('MSE low', 'MSE high', 'P(best)')]
+SUBMISSION_COLUMNS = ['pol_id'] + TARGETS
+
+# Rows read at a time from Parquet and CSV submissions.
+BATCH_ROWS = 65536
+
+# Answer columns by name, each a contiguous array sorted by `pol_id`.
+Answers = Dict[str, np.ndarray]
+# Submitted ids, and the predicted targets as the rows of one matrix.
+Batch = Tuple[np.ndarray, np.ndarray]
+
+STORE_VERSION = 3
+HASH_CHUNK = 8 * 1024 * 1024
+
+# Seconds between scans of the submissions folder in watch mode.
+WATCH_INTERVAL = 5.0
+
+# The block bootstrap resamples runs of consecutive policies in `pol_id`
+# order, with the same draws for every submission.
+BOOTSTRAP_BLOCKS = 1000
+REPLICATES = 1000
+CONFIDENCE = 0.95
+BOOTSTRAP_SEED = 0
 
+logger = logging.getLogger(__name__)
 
-answers = pd.read_csv(ANSWER_FILE)
-sum_e_n = sum(answers['E[N]'])
-sum_e_x = sum(answers['E[X]'])
+# The answers memory-mapped by this grading process.
+_answers: Optional[Answers] = None
 
 
-def determine_model(file_name):
+class SubmissionError(ValueError):
+    """
+    A submission file that cannot be graded.
+    """
+
+
+def determine_model(file_name: str) -> str:
     return re.findall(MODEL_PATTERN, file_name)[0]
 
 
-def determine_scientist(file_name, model):
+def determine_scientist(file_name: str, model: str) -> str:
     name_pattern = BASE_PATTERN.format(model)
     return re.findall(name_pattern, file_name)[0]
 
 
-def submission_results(file_location):
-    submission = pd.read_pickle(submitted_file)
-    e_n = sum(submission['E[N]'])
-    e_x = sum(submission['E[X]'])
-    return e_n, e_x
-
-
-collect_results = []
-submissions = os.listdir(FILE_LOC)
-for file_name in submissions:
-    model = determine_model(file_name)
-    scientist = determine_scientist(file_name, model)
-    submitted_file = os.path.join(FILE_LOC, file_name)
-    e_n, e_x = submission_results(submitted_file)
-
-    collect_results.append(
-        {
-            'model': model,
-            'scientist': scientist,
-            # This isn't computing MSE
-            'MSE E[N]': sum_e_n - e_n,
-            'MSE E[X]': sum_e_x - e_x,
-        }
-    )
-
-
-field_names = ['model', 'scientist', 'MSE E[N]', 'MSE E[X]']
-with open('SubmissionAnswers.csv', 'w') as _file:
-    writer = csv.DictWriter(_file, fieldnames=field_names)
-    writer.writeheader()
-    for result in collect_results:
-        writer.writerow(result)
+def load_answers(answer_file: str, directory: str) -> None:
+    """
+    Read the answers CSV once and save it, sorted by `pol_id`, as `.npy`
+    files in `directory` for every grading process to memory-map: the
+    ids, and the targets as the rows of one matrix.
+    """
+    with span('load_answers', file=answer_file) as stage:
+        df = pd.read_csv(answer_file, usecols=['pol_id'] + TARGETS)
+        df = df.sort_values('pol_id')
+        pol_id = df['pol_id'].to_numpy(dtype=np.int64)
+        if (pol_id[1:] == pol_id[:-1]).any():
+            raise ValueError(f'Duplicate pol_id in {answer_file}')
+        np.save(os.path.join(directory, 'pol_id.npy'), pol_id)
+        np.save(os.path.join(directory, 'targets.npy'),
+                np.ascontiguousarray(df[TARGETS].to_numpy(np.float64).T))
+        stage.set(rows=len(df))
+
+
+def attach_answers(directory: str) -> None:
+    """
+    Pool initialiser: map the saved answers into this process. The pages
+    are shared with every other grading process through the page cache.
+    """
+    global _answers
+    targets = np.load(os.path.join(directory, 'targets.npy'), mmap_mode='r')
+    _answers = {'pol_id': np.load(os.path.join(directory, 'pol_id.npy'),
+                                  mmap_mode='r')}
+    _answers.update(zip(TARGETS, targets))
+
+
+def read_submission(file_location: str,
+                    max_rows: Optional[int] = None) -> Iterator[Batch]:
+    """
+    Stream the ids and predictions of a submission in batches, reading
+    only `pol_id`, `E[N]` and `E[X]`. Parquet and CSV files are read a
+    batch at a time and pickles whole. Column types are checked before
+    any rows are read and values as each batch arrives, so a malformed
+    file is rejected with a `SubmissionError` as early as possible, as
+    is one with more than `max_rows` rows.
+    """
+    extension = os.path.splitext(file_location)[1].lower()
+    if extension == '.parquet':
+        batches = _read_parquet(file_location, max_rows)
+    elif extension == '.csv':
+        batches = _read_csv(file_location)
+    elif extension == '.pkl':
+        batches = _read_pickle(file_location)
+    else:
+        raise SubmissionError(f'Unsupported submission format {extension}')
+
+    rows = 0
+    for pol_id, predicted in batches:
+        rows += len(pol_id)
+        if max_rows is not None and rows > max_rows:
+            raise SubmissionError(f'More than {max_rows} rows')
+        if not np.isfinite(predicted).all():
+            raise SubmissionError('Missing or infinite predictions')
+        yield pol_id, predicted
+
+
+def _read_parquet(file_location: str,
+                  max_rows: Optional[int]) -> Iterator[Batch]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    try:
+        parquet = pq.ParquetFile(file_location)
+    except pa.ArrowException as e:
+        raise SubmissionError(f'Unreadable Parquet file: {e}') from e
+    schema = parquet.schema_arrow
+    missing = [name for name in SUBMISSION_COLUMNS
+               if schema.get_field_index(name) < 0]
+    if missing:
+        raise SubmissionError(f'Missing columns {missing}')
+    if not pa.types.is_integer(schema.field('pol_id').type):
+        raise SubmissionError('pol_id is not an integer column')
+    for target in TARGETS:
+        kind = schema.field(target).type
+        if not (pa.types.is_floating(kind) or pa.types.is_integer(kind)):
+            raise SubmissionError(f'{target} is not a numeric column')
+    if max_rows is not None and parquet.metadata.num_rows > max_rows:
+        raise SubmissionError(f'More than {max_rows} rows')
+
+    for batch in parquet.iter_batches(batch_size=BATCH_ROWS,
+                                      columns=SUBMISSION_COLUMNS):
+        if batch.column('pol_id').null_count:
+            raise SubmissionError('Missing pol_id')
+        yield (batch.column('pol_id').to_numpy().astype(np.int64),
+               np.vstack([batch.column(target).to_numpy(zero_copy_only=False)
+                          for target in TARGETS]).astype(np.float64))
+
+
+def _read_csv(file_location: str) -> Iterator[Batch]:
+    header = pd.read_csv(file_location, nrows=0).columns
+    missing = [name for name in SUBMISSION_COLUMNS if name not in header]
+    if missing:
+        raise SubmissionError(f'Missing columns {missing}')
+    chunks = pd.read_csv(file_location,
+                         usecols=SUBMISSION_COLUMNS,
+                         dtype={'pol_id': np.int64, 'E[N]': np.float64,
+                                'E[X]': np.float64},
+                         chunksize=BATCH_ROWS)
+    try:
+        for chunk in chunks:
+            yield (chunk['pol_id'].to_numpy(),
+                   chunk[TARGETS].to_numpy(np.float64).T)
+    except (TypeError, ValueError) as e:
+        raise SubmissionError(f'Malformed CSV: {e}') from e
+
+
+def _read_pickle(file_location: str) -> Iterator[Batch]:
+    # Pickles cannot be read in part; prefer Parquet for large submissions.
+    submission = pd.read_pickle(file_location)
+    if not isinstance(submission, pd.DataFrame):
+        raise SubmissionError(
+            f'Expected a DataFrame, got {type(submission).__name__}')
+    if 'pol_id' in submission.columns:
+        pol_id = submission['pol_id']
+    else:
+        pol_id = submission.index
+    missing = [target for target in TARGETS
+               if target not in submission.columns]
+    if missing:
+        raise SubmissionError(f'Missing columns {missing}')
+    if not pd.api.types.is_integer_dtype(pol_id.dtype):
+        raise SubmissionError('pol_id is not an integer column')
+    for target in TARGETS:
+        if not pd.api.types.is_numeric_dtype(submission[target].dtype):
+            raise SubmissionError(f'{target} is not a numeric column')
+    yield (pol_id.to_numpy(dtype=np.int64),
+           submission[TARGETS].to_numpy(np.float64).T)
+
+
+def submission_results(file_location: str,
+                       answers: Answers) -> Dict[str, object]:
+    """
+    Per-policy MSE of a submission's E[N] and E[X] against the answers.
+    Each batch read is aligned to the answers on `pol_id` with a binary
+    search over the sorted answer ids, and its squared errors added to
+    running totals, so grading keeps pace with reading. The totals are
+    kept per bootstrap block, under `blocks`, for `add_intervals`.
+
+    A submission must predict every policy in the answers: one that
+    leaves any out is rejected, as its MSE would otherwise be taken over
+    only the policies it chose to predict.
+    """
+    answer_ids = answers['pol_id']
+    n_blocks = min(BOOTSTRAP_BLOCKS, len(answer_ids))
+    seen = np.zeros(len(answer_ids), dtype=bool)
+    n_seen = n_unknown = 0
+    counts = np.zeros(n_blocks)
+    totals = np.zeros((len(TARGETS), n_blocks))
+    for pol_id, predicted in read_submission(file_location, len(answer_ids)):
+        position = np.searchsorted(answer_ids, pol_id)
+        position = np.minimum(position, len(answer_ids) - 1)
+        known = answer_ids[position] == pol_id
+        n_unknown += np.count_nonzero(~known)
+        position = position[known]
+        # Only this batch's positions are checked, against each other and
+        # against the ids of earlier batches, keeping each batch's cost
+        # independent of the number of answers.
+        if (np.unique(position).size != position.size
+                or seen[position].any()):
+            raise SubmissionError('Duplicate pol_id')
+        seen[position] = True
+        n_seen += position.size
+        block = position * n_blocks // len(answer_ids)
+        counts += np.bincount(block, minlength=n_blocks)
+        for i, target in enumerate(TARGETS):
+            error = predicted[i][known] - answers[target][position]
+            totals[i] += np.bincount(block, weights=error ** 2,
+                                     minlength=n_blocks)
+
+    if n_unknown:
+        logger.warning(f'{file_location}: {n_unknown} policies are not in '
+                       f'the answers.')
+    if n_seen < len(answer_ids):
+        raise SubmissionError(f'{len(answer_ids) - n_seen} policies are '
+                              f'missing from the submission')
+    results = {f'MSE {target}': float(total.sum() / n_seen)
+               for target, total in zip(TARGETS, totals)}
+    results['blocks'] = {'count': counts.tolist(),
+                         **{target: total.tolist()
+                            for target, total in zip(TARGETS, totals)}}
+    return results
+
+
+def bootstrap_weights(n_blocks: int,
+                      replicates: int = REPLICATES,
+                      seed: int = BOOTSTRAP_SEED) -> np.ndarray:
+    """
+    How often each block is drawn in each replicate of the bootstrap: one
+    row of multinomial counts summing to `n_blocks` per replicate.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks),
+                           size=replicates).astype(np.float64)
+
+
+def add_intervals(rows: List[Dict[str, object]],
+                  replicates: int = REPLICATES,
+                  confidence: float = CONFIDENCE,
+                  seed: int = BOOTSTRAP_SEED) -> None:
+    """
+    Add block bootstrap confidence intervals for each MSE, and the share
+    of replicates in which each submission has the lowest MSE of its
+    model, to the leaderboard rows.
+
+    Replicates reweight the per-block squared errors recorded in grading,
+    so the bootstrap costs one matrix product per target rather than a
+    pass over the policies. Every submission is resampled with the same
+    weights, keeping their scores paired: close submissions scored on the
+    same policies are compared fairly.
+    """
+    if not rows:
+        return
+    with span('bootstrap', submissions=len(rows), replicates=replicates):
+        counts = np.array([row['blocks']['count'] for row in rows])
+        weights = bootstrap_weights(counts.shape[1], replicates, seed)
+        n = weights @ counts.T
+        models = np.array([row['model'] for row in rows])
+        tail = (1 - confidence) / 2
+        for target in TARGETS:
+            totals = np.array([row['blocks'][target] for row in rows])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mse = weights @ totals.T / n
+            low, high = np.nanquantile(mse, [tail, 1 - tail], axis=0)
+            wins = np.zeros(len(rows))
+            for model in np.unique(models):
+                group = np.flatnonzero(models == model)
+                best = group[np.argmin(mse[:, group], axis=1)]
+                wins += np.bincount(best, minlength=len(rows))
+            for i, row in enumerate(rows):
+                row[f'MSE low {target}'] = float(low[i])
+                row[f'MSE high {target}'] = float(high[i])
+                row[f'P(best) {target}'] = wins[i] / replicates
+
+
+def grade(file_location: str) -> Optional[Dict[str, float]]:
+    """
+    Worker task: grade one submission file against the mapped answers.
+    A file that cannot be graded is logged and left ungraded.
+    """
+    file_name = os.path.basename(file_location)
+    try:
+        with span('grade_submission', file=file_name):
+            return submission_results(file_location, _answers)
+    except SubmissionError as e:
+        logger.error(f'Rejected {file_name}: {e}')
+        return None
+    except Exception:
+        logger.exception(f'Could not grade {file_name}.')
+        return None
+
+
+class GradeStore:
+    """
+    Results of earlier grading runs, stored as JSON and keyed by the
+    hashes of the submission and of the answers file, so a submission is
+    only graded again when either changes. File hashes are remembered
+    against the file's size and modification time, so unchanged files
+    are not re-read either.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.results: Dict[str, Dict[str, float]] = {}
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == STORE_VERSION:
+                self.hashes = {name: tuple(value)
+                               for name, value in data['hashes'].items()}
+                self.results = data['results']
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_size,
+                                                 stat.st_mtime_ns):
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+        self.hashes[path] = (stat.st_size, stat.st_mtime_ns,
+                             digest.hexdigest())
+        return digest.hexdigest()
+
+    def prune(self, paths: List[str], keys: List[str]) -> None:
+        """
+        Forget files and results no longer in use.
+        """
+        self.hashes = {path: self.hashes[path] for path in paths
+                       if path in self.hashes}
+        self.results = {key: self.results[key] for key in keys
+                        if key in self.results}
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': STORE_VERSION,
+                           'hashes': self.hashes,
+                           'results': self.results}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class Grader:
+    """
+    Grades the submissions in `file_loc` incrementally: each call to
+    `grade` only sends new or changed files to the process pool. The
+    pool and the memory-mapped answers are kept between calls, and are
+    rebuilt if the answers file changes. With `replicates`, leaderboard
+    rows carry bootstrap confidence intervals.
+    """
+
+    def __init__(self,
+                 file_loc: str = FILE_LOC,
+                 answer_file: str = ANSWER_FILE,
+                 store: Optional[GradeStore] = None,
+                 processes: Optional[int] = None,
+                 replicates: int = REPLICATES,
+                 confidence: float = CONFIDENCE) -> None:
+        self.file_loc = file_loc
+        self.answer_file = answer_file
+        self.store = store or GradeStore()
+        self.processes = processes
+        self.replicates = replicates
+        self.confidence = confidence
+        self._answers_hash: Optional[str] = None
+        self._directory: Optional[tempfile.TemporaryDirectory] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def grade(self, files: Optional[List[str]] = None
+              ) -> List[Dict[str, object]]:
+        """
+        Leaderboard rows for `files`, by default every submission in the
+        folder in file name order, grading only those not in the store.
+        """
+        if files is None:
+            files = [os.path.join(self.file_loc, name)
+                     for name in sorted(os.listdir(self.file_loc))]
+        named = {}
+        for path in files:
+            name = submission_name(os.path.basename(path))
+            if name is None:
+                logger.warning(f'Skip {path}: not a submission file name.')
+            else:
+                named[path] = name
+
+        answers_hash = self.store.file_hash(self.answer_file)
+        keys = {path: f'{self.store.file_hash(path)}:{answers_hash}'
+                for path in named}
+        todo = [path for path in named if keys[path] not in self.store.results]
+        if todo:
+            logger.info(f'Grade {len(todo)} of {len(named)} submissions.')
+            pool = self._get_pool(answers_hash)
+            for path, results in zip(todo, pool.map(grade, todo)):
+                if results is not None:
+                    self.store.results[keys[path]] = results
+        self.store.prune([self.answer_file] + list(named), list(keys.values()))
+        self.store.save()
+
+        rows = []
+        for path, (model, scientist) in named.items():
+            results = self.store.results.get(keys[path])
+            if results is not None:
+                rows.append({'model': model, 'scientist': scientist,
+                             **results})
+        if self.replicates:
+            add_intervals(rows, self.replicates, self.confidence)
+        return rows
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._directory.cleanup()
+            self._pool = self._directory = None
+
+    def _get_pool(self, answers_hash: str) -> ProcessPoolExecutor:
+        if self._pool is None or answers_hash != self._answers_hash:
+            self.close()
+            self._directory = tempfile.TemporaryDirectory()
+            load_answers(self.answer_file, self._directory.name)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=attach_answers,
+                initargs=(self._directory.name,),
+            )
+            self._answers_hash = answers_hash
+        return self._pool
+
+    def __enter__(self) -> 'Grader':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+def submission_name(file_name: str) -> Optional[Tuple[str, str]]:
+    """
+    The model and scientist of a submission file, or None if the name
+    does not follow the submission convention.
+    """
+    try:
+        model = determine_model(file_name)
+        return model, determine_scientist(file_name, model)
+    except IndexError:
+        return None
+
+
+def grade_submissions(file_loc: str = FILE_LOC,
+                      answer_file: str = ANSWER_FILE,
+                      processes: Optional[int] = None,
+                      store_path: Optional[str] = None,
+                      replicates: int = REPLICATES
+                      ) -> List[Dict[str, object]]:
+    """
+    Grade every submission in `file_loc` in parallel, in file name order.
+    With `store_path`, results of earlier runs are reused.
+    """
+    with Grader(file_loc, answer_file, GradeStore(store_path),
+                processes, replicates) as grader:
+        return grader.grade()
+
+
+def watch(grader: Grader,
+          output: str = RESULTS_FILE,
+          interval: float = WATCH_INTERVAL) -> None:
+    """
+    Keep the leaderboard current: scan the submissions folder every
+    `interval` seconds and regrade when it changes. A file is only
+    graded once its size and modification time are the same on two
+    scans in a row, so files still being copied in are left out until
+    they settle, without holding back the files that have.
+    """
+    previous: Dict[str, Tuple[int, int]] = {}
+    graded: Optional[Dict[str, Tuple[int, int]]] = None
+    scans = 0
+    while True:
+        current = {}
+        for entry in os.scandir(grader.file_loc):
+            if entry.is_file():
+                stat = entry.stat()
+                current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        stable = {path: value for path, value in current.items()
+                  if previous.get(path) == value}
+        # Nothing is known to be stable until the second scan.
+        if scans and stable != graded:
+            write_results(grader.grade(sorted(stable)), output)
+            logger.info(f'Leaderboard updated with {len(stable)} files.')
+            graded = stable
+        previous = current
+        scans += 1
+        time.sleep(interval)
+
+
+def write_results(results: List[Dict[str, object]],
+                  path: str = RESULTS_FILE) -> None:
+    fieldnames = FIELD_NAMES
+    if results and INTERVAL_FIELDS[0] in results[0]:
+        fieldnames = FIELD_NAMES + INTERVAL_FIELDS
+    with open(path, 'w') as _file:
+        writer = csv.DictWriter(_file, fieldnames=fieldnames,
+                                extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Grade every submission against the test answers.')
+    parser.add_argument('--submissions', default=FILE_LOC)
+    parser.add_argument('--answers', default=ANSWER_FILE)
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--store', default=GRADES_FILE,
+                        help='results of earlier runs, reused when neither '
+                             'the submission nor the answers changed; an '
+                             'empty path grades everything afresh')
+    parser.add_argument('--processes', type=int,
+                        help='grading processes; defaults to one per core')
+    parser.add_argument('--replicates', type=int, default=REPLICATES,
+                        help='bootstrap replicates for confidence '
+                             'intervals; 0 leaves them out')
+    parser.add_argument('--confidence', type=float, default=CONFIDENCE)
+    parser.add_argument('--watch', action='store_true',
+                        help='keep grading new submissions as they land')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL)
+    parser.add_argument('--trace',
+                        help='write timing spans of every stage, from all '
+                             'grading processes, to this JSON lines file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s: %(message)s')
+    if args.trace:
+        # Set before the pool starts, so the workers trace to the same file.
+        instrument.configure(args.trace)
+    store = GradeStore(args.store or None)
+    with Grader(args.submissions, args.answers, store, args.processes,
+                args.replicates, args.confidence) as grader:
+        if args.watch:
+            watch(grader, args.output, args.interval)
+        else:
+            write_results(grader.grade(), args.output)
+
+
+if __name__ == '__main__':
+    main()
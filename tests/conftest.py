@@ -0,0 +1,9 @@
+import os
+import sys
+
+# bedrock modules import each other by bare name, as when run from their
+# directory, and evaluate_submissions and cyutils sit at the repo root.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'bedrock')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
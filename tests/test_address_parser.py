@@ -0,0 +1,232 @@
+import json
+import multiprocessing
+import random
+import re
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+import pytest
+
+from cyutils.address.parser import (CACHE_SIZE, CACHE_VERSION,
+                                    ROAD_PATTERN, AddressCache, CacheInfo,
+                                    NumberMatch, disable_cache, enable_cache,
+                                    normalise_address, number,
+                                    number_match, parse_address,
+                                    parse_addresses, postcode,
+                                    street_address, tokenise_address)
+from cyutils.address.road_matcher import find_road, road_span
+from cyutils.address.road_types import STREET_NAMES
+
+ADDRESSES = [
+    'privet dr',
+    '9 Bywater St Chelsea, London SW3 4XD',
+    '221b  baker st , london NW1 6XE',
+    'Flat 3, 12 High Street, Leeds LS1 4AB',
+    'Tower 42, 25 Old Broad St',
+    '',
+]
+
+
+def assert_matches_road_pattern(address):
+    match = ROAD_PATTERN.search(address)
+    assert find_road(address) == (match.group(0) if match else '')
+    assert road_span(address) == (match.span() if match else None)
+
+
+@pytest.mark.parametrize('address', [
+    'FLAT 2, 14 ST JOHNS ROAD NORTH, LONDON',
+    '14 ST. JOHNS RD, LONDON',
+    '3 SAINT MARYS ST NORTH LONDON',
+    '5 KING EDWARD ST NORTH,SOUTH, LEEDS',
+    '5 GREAT NORTH WEST RD, LEEDS',
+    '12 HIGH ROAD SOUTH, LEEDS',
+    '12 HIGH ROAD WEST,',
+    "9 ST JOHN'S WOOD RD",
+    "9 O'CONNELL ST, DUBLIN",
+    "'S ROAD",
+    '7 STREETLY ROAD',
+    '7 ROADSIDE LANE',
+    '7 FOOTPATH, MILLSTREET LN',
+    '1 ABSTRACT DRIVE',
+    '22 MEADOW HILL STREET',
+    '22 ABBEY TERRACE MEWS, BATH',
+    '22 NORTH PARK ROAD',
+    '4 VICTORIA STATION ROAD',
+    '4 HILL',
+    'HILL ROAD',
+    'ST ST ST ST',
+    '10 DOWNING STREET SW1A 2AA',
+    'THE BARN, LITTLE SNORING',
+    '',
+])
+def test_find_road_matches_road_pattern(address):
+    assert_matches_road_pattern(address)
+
+
+def test_find_road_matches_road_pattern_on_random_addresses():
+    rng = random.Random(0)
+    words = (STREET_NAMES + ['ST.', 'SAINT', 'KING', 'NORTH', 'NORTH,',
+                             'SOUTH,', 'OLD', 'HIGH', "JOHN'S", "'S",
+                             'STREETLY', 'ROADS', 'MILLSTREET', '12', 'A1',
+                             'FLAT', ',', 'LONDON', 'SW3 4XD'])
+    separators = [' ', ' ', ' ', ', ', ',', '-', '']
+    for _ in range(5000):
+        address = ''.join(rng.choice(words) + rng.choice(separators)
+                          for _ in range(rng.randint(1, 7)))
+        assert_matches_road_pattern(address)
+
+
+@pytest.mark.parametrize('address, number', [
+    ('12 High Street, Leeds LS1 4AB', '12'),
+    ('221b Baker St, London NW1 6XE', '221B'),
+    ('9 Bywater St Chelsea, London SW3 4XD', '9'),
+    ('10 Downing Street SW1A 2AA', '10'),
+])
+def test_number_match_ignores_the_postcode(address, number):
+    assert number_match(address) == NumberMatch(number, 1.0, False, False)
+
+
+@pytest.mark.parametrize('address', [
+    '12 & 14 High Street, Leeds LS1 4AB',
+    'Flat 3, 12 High Street, Leeds LS1 4AB',
+])
+def test_number_match_flags_further_numbers(address):
+    match = number_match(address)
+    assert match.multiple
+    assert match.confidence == 0.5
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_parse_addresses_matches_the_single_extractors(processes):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        parsed = parse_addresses(pd.Series(ADDRESSES, index=range(10, 16)),
+                                 processes, chunk_size=2)
+        expected = pd.DataFrame({
+            'street': [street_address(address) for address in ADDRESSES],
+            'postcode': [postcode(address) for address in ADDRESSES],
+            'number': [number(address) for address in ADDRESSES],
+        }, index=range(10, 16))
+    pd.testing.assert_frame_equal(parsed[expected.columns], expected)
+    road_type = parsed['street'].str.split().str[-1].fillna('')
+    assert (parsed['type'] == road_type).all()
+
+
+def test_parse_addresses_fills_the_cache_from_spawned_workers(monkeypatch):
+    # Spawned workers start without the cache, so the parent must look up
+    # its hits itself and add what the workers parse.
+    context = multiprocessing.get_context('spawn')
+    monkeypatch.setattr('cyutils.address.parser.ProcessPoolExecutor',
+                        partial(ProcessPoolExecutor, mp_context=context))
+    cache = enable_cache()
+    try:
+        cache.preload(ADDRESSES[:1])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parsed = parse_addresses(ADDRESSES + ADDRESSES, 2, chunk_size=2)
+        assert cache.info().currsize == len(ADDRESSES)
+        assert cache.info().hits == 1
+        assert [tuple(row) for row in parsed.itertuples(index=False)] == \
+            [parse_address(address) for address in ADDRESSES + ADDRESSES]
+    finally:
+        disable_cache()
+
+
+def _regex_normalise(address):
+    # normalise_address before the one-pass version.
+    return re.sub(r'\s+', ' ', str(address).upper()).replace(' ,', ',')
+
+
+@pytest.mark.parametrize('address', ADDRESSES + [
+    '  leading and trailing  ',
+    ' ',
+    '\t\n',
+    'a ,b , ,c',
+    'tabs\tand\r\nnewlines\x0b\x0c',
+    'unicode\xa0spaces\u2003and\u3000more\x1c\x1d\x1e\x1f\x85end',
+    12,
+    None,
+])
+def test_normalise_address_matches_the_regex_normalisation(address):
+    assert normalise_address(address) == _regex_normalise(address)
+
+
+def test_normalise_address_matches_the_regex_on_random_strings():
+    rng = random.Random(0)
+    characters = 'ab1, \t\n\r\xa0\u2003'
+    for _ in range(5000):
+        address = ''.join(rng.choice(characters)
+                          for _ in range(rng.randint(0, 12)))
+        assert normalise_address(address) == _regex_normalise(address)
+
+
+@pytest.mark.parametrize('address', ADDRESSES + ['  9  Bywater St ,London '])
+def test_tokenise_address_offsets_locate_each_token(address):
+    tokenised = tokenise_address(address)
+    assert tokenised.text == normalise_address(address)
+    assert ' '.join(tokenised.tokens) == tokenised.text
+    for i, (token, start) in enumerate(zip(tokenised.tokens,
+                                           tokenised.starts)):
+        assert tokenised.text[start:start + len(token)] == token
+        assert tokenised.span(i, i + 1) == (start, start + len(token))
+
+
+def test_road_span_maps_to_its_tokens():
+    tokenised = tokenise_address('flat 2, 14 st johns rd north, london')
+    first, last = tokenised.token_range(*road_span(tokenised.text))
+    assert tokenised.tokens[first:last] == ['ST', 'JOHNS', 'RD', 'NORTH,']
+
+
+def test_address_cache_evicts_the_least_recently_used():
+    cache = AddressCache(maxsize=2)
+    cache.get(ADDRESSES[0])
+    cache.get(ADDRESSES[1])
+    cache.get(ADDRESSES[0])
+    cache.get(ADDRESSES[2])
+    assert cache.info() == CacheInfo(1, 3, 2, 2)
+    assert cache.lookup(ADDRESSES[1]) is None
+    assert cache.lookup(ADDRESSES[0]) == parse_address(ADDRESSES[0])
+    assert cache.lookup(ADDRESSES[2]) == parse_address(ADDRESSES[2])
+
+
+def test_address_cache_save_and_load_keep_the_entries(tmp_path):
+    path = str(tmp_path / 'addresses.json')
+    cache = AddressCache()
+    cache.preload(ADDRESSES)
+    # The first address is now the most recently used.
+    cache.get(ADDRESSES[0])
+    cache.save(path)
+
+    loaded = AddressCache.load(path)
+    assert loaded.info() == CacheInfo(0, 0, CACHE_SIZE, len(ADDRESSES))
+    for address in ADDRESSES:
+        assert loaded.lookup(address) == parse_address(address)
+
+    # A smaller cache keeps the most recently used entries.
+    loaded = AddressCache.load(path, maxsize=2)
+    assert loaded.lookup(ADDRESSES[0]) is not None
+    assert loaded.lookup(ADDRESSES[-1]) is not None
+    assert loaded.lookup(ADDRESSES[1]) is None
+
+
+def test_address_cache_of_another_version_loads_empty(tmp_path):
+    path = tmp_path / 'addresses.json'
+    path.write_text(json.dumps({'version': CACHE_VERSION + 1, 'entries': [
+        ['privet dr', ['STALE', '', '', '']]]}))
+    assert AddressCache.load(str(path)).info().currsize == 0
+
+
+def test_enable_cache_starts_from_a_saved_cache(tmp_path):
+    path = str(tmp_path / 'addresses.json')
+    saved = AddressCache()
+    saved.preload(ADDRESSES)
+    saved.save(path)
+    cache = enable_cache(path=path)
+    try:
+        assert parse_address(ADDRESSES[1]) == saved.lookup(ADDRESSES[1])
+        assert cache.info().hits == 1
+        assert cache.info().misses == 0
+    finally:
+        disable_cache()
@@ -0,0 +1,87 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from artifacts import ModelArtifact
+from features import FeatureSchema, aggregate_claims, unique_policies
+from models import build_glm_freq, build_slm
+from synthetic import generate_book
+
+
+@pytest.fixture(scope='module')
+def book():
+    policies, claims = generate_book(2000, seed=0)
+    schema = FeatureSchema.fit(policies)
+    features = unique_policies(schema.transform_frame(policies))
+    counts = aggregate_claims(features, claims).counts
+    return schema, features, counts
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('build', [build_slm, build_glm_freq])
+def test_saved_artifact_predicts_as_the_fitted_model(book, tmp_path, build,
+                                                     sparse):
+    schema, features, counts = book
+    if sparse:
+        features = features.astype(pd.SparseDtype(np.float64, 0))
+    results = build(counts, features)
+    path = str(tmp_path / 'model.npz')
+    ModelArtifact.from_results(results, schema).save(path)
+    artifact = ModelArtifact.load(path)
+
+    assert artifact.names == list(features.columns)
+    assert artifact.schema.fingerprint() == schema.fingerprint()
+    test, _ = generate_book(300, seed=1)
+    expected = np.asarray(results.predict(schema.transform_frame(test)))
+    np.testing.assert_allclose(artifact.score(test), expected, rtol=1e-12)
+
+
+def test_artifact_with_a_changed_schema_is_rejected(book, tmp_path):
+    schema, features, counts = book
+    path = str(tmp_path / 'model.npz')
+    ModelArtifact.from_results(build_slm(counts, features), schema).save(path)
+
+    with np.load(path) as arrays:
+        meta = json.loads(str(arrays['meta']))
+        params = arrays['params']
+        bse = arrays['bse']
+    meta['schema']['categories']['trade'].reverse()
+    meta['schema']['columns'] = FeatureSchema(
+        meta['schema']['categories']).columns
+    with open(path, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), params=params, bse=bse)
+
+    with pytest.raises(ValueError, match='fingerprint'):
+        ModelArtifact.load(path)
+
+
+def test_artifact_is_checked_against_the_scoring_schema(book, tmp_path):
+    schema, features, counts = book
+    path = str(tmp_path / 'model.npz')
+    ModelArtifact.from_results(build_slm(counts, features), schema).save(path)
+
+    assert ModelArtifact.load(path, schema).schema.fingerprint() == \
+        schema.fingerprint()
+    assert ModelArtifact.load(path, schema.fingerprint()).names == \
+        list(features.columns)
+
+    # A schema fitted on other policies encodes other columns.
+    policies, _ = generate_book(2000, seed=0)
+    other = FeatureSchema.fit(policies[policies['trade'] !=
+                                       policies['trade'].iloc[0]])
+    assert other.fingerprint() != schema.fingerprint()
+    with pytest.raises(ValueError, match='another feature schema'):
+        ModelArtifact.load(path, other)
+    with pytest.raises(ValueError, match='another feature schema'):
+        ModelArtifact.load(path, other.fingerprint())
+
+
+def test_artifact_without_a_schema_fails_a_schema_check(book, tmp_path):
+    schema, features, counts = book
+    path = str(tmp_path / 'model.npz')
+    ModelArtifact.from_results(build_slm(counts, features)).save(path)
+    assert ModelArtifact.load(path).schema is None
+    with pytest.raises(ValueError, match='another feature schema'):
+        ModelArtifact.load(path, schema)
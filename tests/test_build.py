@@ -0,0 +1,41 @@
+import os
+import threading
+
+import build
+from loader import SOURCE_FILES, SOURCE_PATH, LocalBlob
+from synthetic import generate_book
+
+
+def test_main_downloads_the_source_files_at_once(tmp_path, monkeypatch):
+    root = tmp_path / 'bucket'
+    os.makedirs(str(root / SOURCE_PATH))
+    policies, claims = generate_book(300, seed=0)
+    test, _ = generate_book(100, seed=1, start_id=301)
+    for name, frame in [('policies', policies), ('claims', claims),
+                        ('test', test)]:
+        frame.to_pickle(str(root / SOURCE_PATH / SOURCE_FILES[name]))
+
+    # Each read waits for the other two, so the files must be read
+    # concurrently or the barrier breaks.
+    barrier = threading.Barrier(len(SOURCE_FILES), timeout=10)
+    open_blob = LocalBlob.open
+
+    def waiting_open(blob, *args, **kwargs):
+        barrier.wait()
+        return open_blob(blob, *args, **kwargs)
+
+    fitted = {}
+
+    def run_models(policies, claims, testing, *args):
+        fitted.update(policies=policies, claims=claims, testing=testing)
+
+    monkeypatch.setattr(LocalBlob, 'open', waiting_open)
+    monkeypatch.setattr(build, '_load_config',
+                        lambda: {'local_bucket': str(root)})
+    monkeypatch.setattr(build, 'run_models', run_models)
+    build.main()
+
+    assert len(fitted['policies']) == len(policies)
+    assert len(fitted['claims']) == len(claims)
+    assert list(fitted['testing'].columns) == \
+        list(fitted['policies'].columns)
@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import loader
+from cache import BlobCache
+from features import FeatureSchema
+from loader import LocalBucket, read_frame
+from solvers import is_sparse_frame
+from synthetic import generate_book
+
+
+def _write(bucket, name, size):
+    path = os.path.join(bucket.root, name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return bucket.blob(name)
+
+
+def test_fetch_keeps_blob_larger_than_cache(tmp_path):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=10)
+    local = cache.fetch(_write(bucket, 'big.pkl', 100))
+    assert local.exists()
+
+
+def test_blob_in_use_is_not_evicted(tmp_path):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=150)
+    first = _write(bucket, 'first.pkl', 100)
+    second = _write(bucket, 'second.pkl', 100)
+    with cache.use(first) as local:
+        cache.fetch(second)
+        assert local.exists()
+    # Once released, the least recently used blob is evicted again.
+    cache.fetch(_write(bucket, 'third.pkl', 100))
+    assert not local.exists()
+
+
+def test_pickle_is_converted_to_parquet_once(tmp_path, monkeypatch):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    policies, _ = generate_book(500, seed=0)
+    policies.to_pickle(os.path.join(bucket.root, 'policies.pkl'))
+    blob = bucket.blob('policies.pkl')
+    cache = BlobCache(str(tmp_path / 'cache'))
+
+    with cache.use_columnar(blob, batch_size=200) as local:
+        assert local.name.endswith('.parquet')
+        chunks = list(read_frame(local, 200))
+    assert [len(chunk) for chunk in chunks] == [200, 200, 100]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                  policies)
+
+    # The Parquet copy is reused without unpickling the source again.
+    def fail(*args):
+        raise AssertionError('pickle read again')
+    monkeypatch.setattr(loader, '_read_pickle', fail)
+    with cache.use_columnar(blob) as again:
+        assert again.path == local.path
+        pd.testing.assert_frame_equal(read_frame(again), policies)
+
+
+def test_unchanged_blob_is_a_cache_hit(tmp_path, monkeypatch):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    cache = BlobCache(str(tmp_path / 'cache'))
+    downloads = []
+    download = cache._download
+
+    def counted(blob, path):
+        downloads.append(blob.name)
+        download(blob, path)
+    monkeypatch.setattr(cache, '_download', counted)
+
+    blob = _write(bucket, 'policies.pkl', 100)
+    first = cache.fetch(blob)
+    second = cache.fetch(bucket.blob('policies.pkl'))
+    assert first.path == second.path
+    assert downloads == ['policies.pkl']
+
+
+def test_changed_blob_gets_a_new_key(tmp_path):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    cache = BlobCache(str(tmp_path / 'cache'))
+    blob = _write(bucket, 'policies.pkl', 100)
+    key = cache.key(blob)
+    old = cache.fetch(blob)
+
+    blob = _write(bucket, 'policies.pkl', 50)
+    os.utime(blob.path, ns=(1, 1))
+    assert cache.key(blob) != key
+    new = cache.fetch(blob)
+    assert new.path != old.path
+    with open(new.path, 'rb') as f:
+        assert len(f.read()) == 50
+
+
+def test_pinned_blob_survives_eviction_by_frames(tmp_path):
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    os.makedirs(bucket.root)
+    cache = BlobCache(str(tmp_path / 'cache'), max_bytes=1000)
+    with cache.use(_write(bucket, 'policies.pkl', 600)) as local:
+        # The frame alone is over the limit, and only it can go.
+        cache.put_frame('large', pd.DataFrame(np.ones((200, 1))))
+        assert local.exists()
+        assert cache.get_frame('large') is None
+    # Released, the blob is the least recently used entry and goes first.
+    cache.put_frame('small', pd.DataFrame(np.ones((10, 1))))
+    assert not local.exists()
+    assert cache.get_frame('small') is not None
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_put_frame_round_trips(tmp_path, sparse):
+    cache = BlobCache(str(tmp_path / 'cache'))
+    policies, _ = generate_book(500, seed=0)
+    frame = FeatureSchema.fit(policies).transform_frame(policies, sparse)
+    key = cache.frame_key('blob', 'features', str(sparse))
+    assert cache.get_frame(key) is None
+
+    cache.put_frame(key, frame)
+    loaded = cache.get_frame(key)
+    assert loaded.index.equals(frame.index)
+    assert list(loaded.columns) == list(frame.columns)
+    if sparse:
+        assert is_sparse_frame(loaded)
+        loaded, frame = loaded.sparse.to_dense(), frame.sparse.to_dense()
+    else:
+        # Dense values are memory-mapped rather than read into memory.
+        values = loaded.to_numpy()
+        while not isinstance(values, np.memmap):
+            assert values is not None
+            values = values.base
+    pd.testing.assert_frame_equal(loaded, frame, check_dtype=False)
@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bedrock import instrument
+from evaluate_submissions import (TARGETS, SubmissionError, add_intervals,
+                                  main, submission_results, watch)
+
+
+@pytest.fixture
+def answers():
+    pol_id = np.arange(1, 101, dtype=np.int64)
+    return {'pol_id': pol_id,
+            'E[N]': pol_id / 100,
+            'E[X]': pol_id * 1000.0}
+
+
+def write_submission(path, answers, pol_id, error=0.5):
+    position = np.searchsorted(answers['pol_id'], pol_id)
+    submission = pd.DataFrame({'pol_id': pol_id,
+                               'E[N]': answers['E[N]'][position] + error,
+                               'E[X]': answers['E[X]'][position] - error})
+    submission.to_csv(path, index=False)
+    return str(path)
+
+
+def test_full_submission_scores_every_policy(tmp_path, answers):
+    path = write_submission(tmp_path / 'a-LM-01Vanilla.csv', answers,
+                            answers['pol_id'][::-1])
+    results = submission_results(path, answers)
+    assert results['MSE E[N]'] == pytest.approx(0.25)
+    assert results['MSE E[X]'] == pytest.approx(0.25)
+    assert sum(results['blocks']['count']) == len(answers['pol_id'])
+
+
+def test_partial_submission_is_rejected(tmp_path, answers):
+    # Dropping policies must not be a way to improve the MSE.
+    path = write_submission(tmp_path / 'a-LM-01Vanilla.csv', answers,
+                            answers['pol_id'][:60])
+    with pytest.raises(SubmissionError, match='40 policies are missing'):
+        submission_results(path, answers)
+
+
+@pytest.mark.parametrize('first, repeat', [(0, 1), (0, 99)])
+def test_duplicate_policy_is_rejected(tmp_path, answers, monkeypatch,
+                                      first, repeat):
+    # With batches of 16 rows, the id is repeated in the batch of its
+    # first occurrence, or in a later one.
+    monkeypatch.setattr('evaluate_submissions.BATCH_ROWS', 16)
+    pol_id = answers['pol_id'].copy()
+    pol_id[repeat] = pol_id[first]
+    path = write_submission(tmp_path / 'a-LM-01Vanilla.csv', answers, pol_id)
+    with pytest.raises(SubmissionError, match='Duplicate pol_id'):
+        submission_results(path, answers)
+
+
+def test_bootstrap_intervals_bracket_the_mse(tmp_path, answers):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i, (model, scale) in enumerate([('LM', 0.5), ('LM', 0.55),
+                                        ('LM', 2.0), ('GLM', 1.0)]):
+        error = rng.normal(scale=scale, size=len(answers['pol_id']))
+        path = write_submission(tmp_path / f'{i}-{model}-01Vanilla.csv',
+                                answers, answers['pol_id'], error)
+        rows.append(dict(submission_results(path, answers), model=model))
+
+    add_intervals(rows, replicates=500, seed=1)
+    for target in TARGETS:
+        for row in rows:
+            assert (row[f'MSE low {target}'] <= row[f'MSE {target}']
+                    <= row[f'MSE high {target}'])
+            assert row[f'MSE low {target}'] < row[f'MSE high {target}']
+        for model in ('LM', 'GLM'):
+            p_best = [row[f'P(best) {target}'] for row in rows
+                      if row['model'] == model]
+            assert sum(p_best) == pytest.approx(1.0)
+        # Far worse than the others of its model, it is never best.
+        assert rows[2][f'P(best) {target}'] == 0
+
+    # The same seed gives the same intervals.
+    again = [dict(row) for row in rows]
+    add_intervals(again, replicates=500, seed=1)
+    assert again == rows
+
+
+def test_watch_updates_while_a_file_is_copied_in(tmp_path, monkeypatch):
+    done = tmp_path / 'a-LM-01Vanilla.csv'
+    done.write_text('pol_id,E[N],E[X]\n')
+    copying = tmp_path / 'b-LM-01Vanilla.csv'
+    copying.write_text('pol_id')
+    graded = []
+
+    class Grader:
+        file_loc = str(tmp_path)
+
+        def grade(self, files):
+            graded.append([os.path.basename(path) for path in files])
+            return []
+
+    def sleep(interval):
+        # The second file grows between every scan.
+        with open(copying, 'a') as f:
+            f.write(',E[N]')
+        if len(graded) or sleep.scans == 3:
+            raise KeyboardInterrupt
+        sleep.scans += 1
+
+    sleep.scans = 0
+    monkeypatch.setattr('evaluate_submissions.time.sleep', sleep)
+    with pytest.raises(KeyboardInterrupt):
+        watch(Grader(), str(tmp_path / 'leaderboard.csv'))
+    assert graded == [['a-LM-01Vanilla.csv']]
+
+
+def test_main_traces_to_the_given_file(tmp_path, answers, monkeypatch):
+    pd.DataFrame(answers).to_csv(tmp_path / 'answers.csv', index=False)
+    os.makedirs(tmp_path / 'submissions')
+    write_submission(tmp_path / 'submissions' / 'a-LM-01Vanilla.csv',
+                     answers, answers['pol_id'])
+    trace = str(tmp_path / 'trace.jsonl')
+    monkeypatch.setattr('sys.argv', [
+        'evaluate_submissions.py',
+        '--submissions', str(tmp_path / 'submissions'),
+        '--answers', str(tmp_path / 'answers.csv'),
+        '--output', str(tmp_path / 'results.csv'),
+        '--store', '',
+        '--processes', '1',
+        '--replicates', '10',
+        '--trace', trace,
+    ])
+    try:
+        main()
+    finally:
+        instrument.disable()
+
+    names = {record['name'] for record in instrument.read_spans(trace)}
+    assert {'load_answers', 'grade_submission', 'bootstrap'} <= names
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from executor import RUN_FITS, ModelExecutor, resolve, worker_threads
+
+
+def _sum_and_threads(frame):
+    return float(resolve(frame).to_numpy().sum()), worker_threads()
+
+
+def test_workers_attach_shared_frames_with_their_share_of_cores():
+    df = pd.DataFrame({'a': np.arange(10.0), 'b': np.ones(10)})
+    with ModelExecutor(processes=2) as executor:
+        shared = executor.share(df)
+        results = [executor.submit(_sum_and_threads, shared).result()
+                   for _ in range(4)]
+    assert all(total == df.to_numpy().sum() for total, _ in results)
+    assert all(threads >= 1 for _, threads in results)
+    assert worker_threads() == -1
+
+
+@pytest.mark.parametrize('cores, processes, threads', [
+    (32, RUN_FITS, 5),
+    (12, RUN_FITS, 2),
+    (4, 4, 1),
+])
+def test_default_pool_has_a_worker_per_fit_sharing_the_cores(
+        monkeypatch, cores, processes, threads):
+    monkeypatch.setattr('executor.os.cpu_count', lambda: cores)
+    with ModelExecutor() as executor:
+        assert executor.processes == processes
+        results = [executor.submit(_sum_and_threads, pd.Series([1.0]))
+                   for _ in range(processes)]
+        assert {result.result()[1] for result in results} == {threads}
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features import (FeatureSchema, aggregate_claims, parse_year,
+                      unique_policies)
+from synthetic import generate_book
+
+
+def _old_counts(policies, grouped):
+    # get_claim_counts before the one-pass aggregation.
+    counts = grouped['claim_id'].count()
+    counts = policies.join(counts)
+    counts = counts[~counts.index.duplicated(keep=False)]['claim_id']
+    return counts.fillna(0)
+
+
+def _old_amounts(policies, grouped):
+    # get_claim_amounts before the one-pass aggregation.
+    totals = grouped['claim_amount'].sum()
+    averages = totals / grouped['claim_amount'].count()
+    totals = policies.join(totals)
+    totals = totals[~totals.index.duplicated(keep='first')]['claim_amount']
+    averages = policies.join(averages)
+    averages = averages[
+        ~averages.index.duplicated(keep='first')
+    ]['claim_amount']
+    return totals.fillna(0.0), averages.fillna(0.0)
+
+
+def test_aggregate_claims_matches_old_functions_with_duplicate_ids():
+    policies, claims = generate_book(2000, seed=4)
+    # Repeat some policies, some with claims, and add claims on unknown
+    # policies and without an amount.
+    policies = pd.concat([policies, policies.iloc[[0, 5, 17, 300]]],
+                         ignore_index=True)
+    claims = pd.concat([claims, pd.DataFrame({
+        'claim_id': [10 ** 6, 10 ** 6 + 1],
+        'pol_id': [10 ** 7, claims['pol_id'].iloc[0]],
+        'claim_amount': [1000.0, np.nan],
+    })], ignore_index=True)
+    features = FeatureSchema.fit(policies).transform_frame(policies)
+    assert features.index.has_duplicates
+
+    unique = unique_policies(features)
+    targets = aggregate_claims(features, claims)
+    assert not unique.index.has_duplicates
+    assert targets.counts.index.equals(unique.index)
+
+    grouped = claims.groupby('pol_id')
+    counts = _old_counts(features, grouped)
+    totals, averages = _old_amounts(features, grouped)
+    np.testing.assert_array_equal(targets.counts.index, counts.index)
+    np.testing.assert_allclose(targets.counts, counts)
+    np.testing.assert_allclose(targets.totals, totals.loc[unique.index])
+    # The average is only defined where there is a claim.
+    claimed = unique.index[totals.loc[unique.index].to_numpy() > 0]
+    assert targets.averages.index.equals(claimed)
+    np.testing.assert_allclose(targets.averages, averages.loc[claimed])
+
+
+def test_parse_year_reads_the_digits():
+    values = np.array(['year:1990', 'year:2021', 'year:0007'], dtype=object)
+    np.testing.assert_array_equal(parse_year(values), [1990, 2021, 7])
+    assert len(parse_year(np.array([], dtype=object))) == 0
+
+
+@pytest.mark.parametrize('value', [
+    'year:19901', 'year:1990 ', 'year:199', 'year:', '', 'Year:1990',
+    'yr:19901', ' year:1990', 'year:19a0', 'year:-990', None, 1990,
+])
+def test_parse_year_rejects_malformed_values(value):
+    values = np.array(['year:2000', value], dtype=object)
+    with pytest.raises(ValueError, match='year:YYYY'):
+        parse_year(values)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_train_and_test_encodings_share_columns(sparse):
+    policies, _ = generate_book(2000, seed=0)
+    test, _ = generate_book(500, seed=1, start_id=2001)
+    # The test set lacks a trade of the training set and has one unseen.
+    trades = sorted(policies['trade'].unique())
+    test = test[test['trade'] != trades[0]].copy()
+    test.loc[test.index[:3], 'trade'] = 'Unseen'
+
+    schema = FeatureSchema.fit(policies)
+    train = schema.transform_frame(policies, sparse)
+    encoded = schema.transform_frame(test, sparse)
+    assert list(encoded.columns) == list(train.columns) == schema.columns
+    assert list(encoded.dtypes) == list(train.dtypes)
+    flags = [f'trade_{trade}' for trade in trades]
+    assert (encoded[flags].iloc[:3].to_numpy() == 0).all()
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_schema_round_trips(tmp_path, dtype):
+    policies, _ = generate_book(1000, seed=0)
+    schema = FeatureSchema.fit(policies, dtype)
+    path = str(tmp_path / 'schema.json')
+    schema.save(path)
+
+    for loaded in (FeatureSchema.from_dict(schema.to_dict()),
+                   FeatureSchema.load(path)):
+        assert loaded.categories == schema.categories
+        assert loaded.columns == schema.columns
+        assert loaded.dtype == schema.dtype
+        assert loaded.fingerprint() == schema.fingerprint()
+        pd.testing.assert_frame_equal(loaded.transform_frame(policies),
+                                      schema.transform_frame(policies))
+
+
+def test_schema_with_mismatched_columns_is_rejected():
+    policies, _ = generate_book(1000, seed=0)
+    data = FeatureSchema.fit(policies).to_dict()
+    data['columns'] = data['columns'][:-1]
+    with pytest.raises(ValueError, match='do not match categories'):
+        FeatureSchema.from_dict(data)
+
+    data = FeatureSchema.fit(policies).to_dict()
+    data['categories']['trade'].reverse()
+    with pytest.raises(ValueError, match='do not match categories'):
+        FeatureSchema.from_dict(data)
+
+
+def test_schema_of_another_version_is_rejected():
+    policies, _ = generate_book(1000, seed=0)
+    data = FeatureSchema.fit(policies).to_dict()
+    data['version'] = -1
+    with pytest.raises(ValueError, match='Unsupported feature schema'):
+        FeatureSchema.from_dict(data)
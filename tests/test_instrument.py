@@ -0,0 +1,102 @@
+import os
+import threading
+
+import pytest
+
+import instrument
+from instrument import TRACE_ENV, configure, read_spans, span
+
+
+@pytest.fixture
+def records():
+    records = []
+    configure(sink=records.append)
+    yield records
+    instrument.disable()
+
+
+def test_disabled_spans_are_a_shared_no_op():
+    assert not instrument.enabled()
+    first = span('load', rows=1)
+    assert first is span('fit')
+    with first as stage:
+        stage.set(rows=2)
+
+
+def test_span_records_its_fields(records):
+    with span('fit', model='glm') as stage:
+        stage.set(rows=10)
+    record, = records
+    assert record['name'] == 'fit'
+    assert record['parent'] is None
+    assert record['pid'] == os.getpid()
+    assert record['duration'] >= 0
+    assert record['peak_rss_delta_mib'] >= 0
+    assert (record['model'], record['rows']) == ('glm', 10)
+    assert 'error' not in record
+
+
+def test_nested_spans_record_their_parent(records):
+    with span('run') as outer:
+        with span('fit'):
+            pass
+        with span('score'):
+            pass
+    fit, score, run = records
+    assert [record['name'] for record in records] == ['fit', 'score', 'run']
+    assert run['id'] == outer.id
+    assert fit['parent'] == score['parent'] == run['id']
+    assert len({fit['id'], score['id'], run['id']}) == 3
+
+
+def test_threads_nest_spans_separately(records):
+    def work():
+        with span('upload'):
+            pass
+
+    with span('store'):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    upload, store = records
+    assert upload['parent'] is None
+    assert store['parent'] is None
+
+
+def test_span_records_an_error(records):
+    with pytest.raises(ValueError):
+        with span('run'):
+            with span('fit'):
+                raise ValueError('singular matrix')
+    assert [(record['name'], record['error']) for record in records] == \
+        [('fit', 'ValueError'), ('run', 'ValueError')]
+    # The stack is unwound, so a later span is a root again.
+    with span('score'):
+        pass
+    assert records[-1]['parent'] is None
+
+
+def test_trace_file_collects_spans(tmp_path, monkeypatch):
+    monkeypatch.delenv(TRACE_ENV, raising=False)
+    path = str(tmp_path / 'trace.jsonl')
+    configure(path)
+    try:
+        assert instrument.enabled()
+        assert os.environ[TRACE_ENV] == path
+        with span('run', rows=3):
+            with span('fit'):
+                pass
+    finally:
+        instrument.disable()
+    assert TRACE_ENV not in os.environ
+    assert not instrument.enabled()
+
+    fit, run = read_spans(path)
+    assert (fit['name'], run['name'], run['rows']) == ('fit', 'run', 3)
+    assert fit['parent'] == run['id']
+
+
+def test_configure_needs_a_path_or_sink():
+    with pytest.raises(ValueError):
+        configure()
+    assert not instrument.enabled()
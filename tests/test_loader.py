@@ -0,0 +1,87 @@
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+from loader import (SOURCE_PATH, SUBMISSION_FILES, SUBMISSION_PATH,
+                    LocalBlob, LocalBucket, read_frame, store_results,
+                    write_parquet)
+from synthetic import generate_book
+
+
+def _write(policies, path, fmt):
+    if fmt == 'parquet':
+        # Row groups smaller than a batch, so batches span row groups.
+        write_parquet((policies.iloc[start:start + 250]
+                       for start in range(0, len(policies), 250)), path)
+    elif fmt == 'arrow':
+        policies.to_feather(path, chunksize=250)
+    else:
+        policies.to_pickle(path)
+
+
+@pytest.fixture(scope='module')
+def policies():
+    policies, _ = generate_book(1000, seed=0)
+    return policies
+
+
+@pytest.mark.parametrize('name, fmt', [
+    ('policies.parquet', 'parquet'),
+    ('policies.pq', 'parquet'),
+    ('policies.arrow', 'arrow'),
+    ('policies.feather', 'arrow'),
+    ('policies.pkl', 'pickle'),
+])
+@pytest.mark.parametrize('batch_size', [None, 300, 5000])
+def test_read_frame_round_trips(tmp_path, policies, name, fmt, batch_size):
+    bucket = LocalBucket(str(tmp_path))
+    _write(policies, os.path.join(bucket.root, name), fmt)
+
+    frames = read_frame(bucket.blob(name), batch_size)
+    if batch_size is None:
+        assert isinstance(frames, pd.DataFrame)
+        frame = frames
+    else:
+        chunks = list(frames)
+        assert all(len(chunk) <= batch_size for chunk in chunks)
+        assert sum(len(chunk) for chunk in chunks) == len(policies)
+        frame = pd.concat(chunks, ignore_index=True)
+    pd.testing.assert_frame_equal(frame.reset_index(drop=True), policies)
+
+
+def test_write_parquet_leaves_no_partial_file(tmp_path, policies):
+    path = str(tmp_path / 'policies.parquet')
+
+    def frames():
+        yield policies.iloc[:500]
+        raise OSError('source went away')
+
+    with pytest.raises(OSError):
+        write_parquet(frames(), path)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_store_results_uploads_at_once(tmp_path, monkeypatch, policies):
+    monkeypatch.chdir(tmp_path)
+    bucket = LocalBucket(str(tmp_path / 'bucket'))
+    results = {name: policies.head(10) for name in SUBMISSION_FILES}
+
+    # Each upload waits for the others, so they must run concurrently or
+    # the barrier breaks.
+    barrier = threading.Barrier(len(results), timeout=10)
+    upload = LocalBlob.upload_from_file
+
+    def waiting_upload(blob, file_obj):
+        barrier.wait()
+        upload(blob, file_obj)
+
+    monkeypatch.setattr(LocalBlob, 'upload_from_file', waiting_upload)
+    store_results(results, bucket)
+
+    for name, filename in SUBMISSION_FILES.items():
+        path = os.path.join(bucket.root, SOURCE_PATH, SUBMISSION_PATH,
+                            filename)
+        pd.testing.assert_frame_equal(pd.read_pickle(path), results[name])
+        assert os.path.isfile(f'{name}.csv')
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import statsmodels.api as sm
+
+from features import FeatureSchema, aggregate_claims, unique_policies
+from models import (build_glm_freq, build_glm_sev, build_slm, cell_means,
+                    compress_cells, evaluate_glm, evaluate_mlm, evaluate_slm,
+                    _fit_and_predict)
+from synthetic import generate_book
+
+
+def test_dense_fit_matches_float64_baseline_on_large_sums_insured():
+    policies, claims = generate_book(3000, seed=0)
+    # Sums insured in the millions with pence need more digits than
+    # float32 keeps.
+    policies['sum_insured'] = policies['sum_insured'] * 7.3 + 0.37
+    features = unique_policies(FeatureSchema.fit(policies)
+                               .transform_frame(policies))
+    counts = aggregate_claims(features, claims).counts
+
+    design = features.astype(np.float64)
+    design['sum_insured'] = policies['sum_insured'].to_numpy()
+    np.testing.assert_array_equal(features['sum_insured'],
+                                  design['sum_insured'])
+    np.testing.assert_allclose(build_slm(counts, features).params,
+                               sm.OLS(counts, design).fit().params,
+                               rtol=1e-10)
+
+
+@pytest.mark.parametrize('evaluate, options', [
+    (evaluate_slm, {}),
+    (evaluate_glm, {}),
+    (evaluate_glm, {'compress': True}),
+    (evaluate_mlm, {'engine': 'forest'}),
+    (evaluate_mlm, {'engine': 'hist_gbm'}),
+])
+def test_every_model_predicts_severity_given_a_claim(evaluate, options,
+                                                     monkeypatch, tmp_path):
+    # The linear models write their fit logs to the working directory.
+    monkeypatch.chdir(tmp_path)
+    policies, claims = generate_book(3000, seed=0)
+    schema = FeatureSchema.fit(policies)
+    features = unique_policies(schema.transform_frame(policies))
+    targets = aggregate_claims(features, claims)
+    assert (targets.averages > 0).all()
+    assert len(targets.averages) < len(features)
+
+    test, _ = generate_book(1000, seed=1, start_id=3001)
+    predicted = evaluate(features, targets.counts, targets.averages,
+                         schema.transform_frame(test), **options)
+    # Severity is the average claim given a claim on every model, not
+    # diluted by the policies without one.
+    assert predicted['E[X]'].mean() == pytest.approx(
+        targets.averages.mean(), rel=0.25)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('build, target', [
+    (build_slm, 'counts'),
+    (build_glm_freq, 'counts'),
+    (build_glm_sev, 'averages'),
+])
+def test_compressed_fit_matches_row_level_fit(build, target, sparse):
+    policies, claims = generate_book(3000, seed=0)
+    features = unique_policies(FeatureSchema.fit(policies)
+                               .transform_frame(policies, sparse))
+    dep = getattr(aggregate_claims(features, claims), target)
+    features = features.loc[dep.index]
+
+    cells = compress_cells(features)
+    assert len(cells.weights) < len(features)
+    compressed = build(cell_means(cells, dep), cells.design, cells.weights)
+    np.testing.assert_allclose(compressed.params,
+                               build(dep, features).params, rtol=1e-6)
+
+
+@pytest.mark.parametrize('build, target', [
+    (build_slm, 'averages'),
+    (build_glm_freq, 'counts'),
+    (build_glm_sev, 'averages'),
+])
+def test_sparse_fit_matches_dense_fit_on_pipeline_targets(build, target):
+    policies, claims = generate_book(20000, seed=0)
+    schema = FeatureSchema.fit(policies)
+    dense = unique_policies(schema.transform_frame(policies))
+    sparse = unique_policies(schema.transform_frame(policies, sparse=True))
+    dep = getattr(aggregate_claims(dense, claims), target)
+
+    dense_fit = build(dep, dense.loc[dep.index])
+    sparse_fit = build(dep, sparse.loc[dep.index])
+    # An identity-link Gamma fit need not converge, when the linear mean
+    # of a policy turns negative, but both solvers take the same steps.
+    assert getattr(dense_fit, 'converged', True) == sparse_fit.converged
+    np.testing.assert_allclose(sparse_fit.params, dense_fit.params,
+                               rtol=1e-6)
+    np.testing.assert_allclose(np.asarray(sparse_fit.predict(dense)),
+                               np.asarray(dense_fit.predict(dense)),
+                               rtol=1e-6)
+
+
+def test_unconverged_fit_is_logged(caplog, monkeypatch, tmp_path):
+    policies, claims = generate_book(20000, seed=0)
+    features = unique_policies(FeatureSchema.fit(policies)
+                               .transform_frame(policies))
+    averages = aggregate_claims(features, claims).averages
+    monkeypatch.chdir(tmp_path)
+    # The identity-link Gamma fit of this book does not converge.
+    fitted = _fit_and_predict(build_glm_sev, averages, features, None,
+                              features, 'glm_sev')
+    assert fitted.artifact.diagnostics['converged'] is False
+    assert 'glm_sev model did not converge' in caplog.text
@@ -0,0 +1,101 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import (HistGradientBoostingRegressor,
+                              RandomForestRegressor)
+
+from features import FeatureSchema, aggregate_claims, unique_policies
+import models
+import scoring
+from scoring import BatchScorer, RatingModel, RatingTable
+from synthetic import generate_book
+
+
+@pytest.fixture(scope='module')
+def book():
+    policies, claims = generate_book(3000, seed=0)
+    schema = FeatureSchema.fit(policies)
+    features = unique_policies(schema.transform_frame(policies))
+    counts = aggregate_claims(features, claims).counts
+    return schema, features, counts.reindex(features.index).to_numpy()
+
+
+@pytest.mark.parametrize('model', [
+    RandomForestRegressor(n_estimators=20, random_state=0),
+    HistGradientBoostingRegressor(max_iter=20, random_state=0),
+])
+def test_tree_table_scores_unseen_sum_insured_as_model(book, model):
+    schema, features, counts = book
+    model.fit(features, counts)
+    table = RatingTable.from_model(model, features)
+
+    test, _ = generate_book(500, seed=1)
+    rng = np.random.default_rng(0)
+    # Training steps 200k to 1M by 80k; none of these were seen.
+    test['sum_insured'] = rng.uniform(1.18e6, 1e7, size=len(test)).round()
+    test.loc[:99, 'sum_insured'] = rng.uniform(2e5, 1e6, size=100).round()
+    X = schema.transform_frame(test)
+
+    scores = table.score(schema.transform(test))
+    assert not np.isnan(scores).any()
+    np.testing.assert_allclose(scores, model.predict(X), rtol=1e-6)
+
+
+def test_batch_scorer_fails_only_the_malformed_request(book):
+    schema, features, counts = book
+    model = RandomForestRegressor(n_estimators=5, random_state=0)
+    model.fit(features, counts)
+    rating = RatingModel(schema,
+                         {'E[N]': RatingTable.from_model(model, features)})
+    policies, _ = generate_book(4, seed=2)
+    good = policies.to_dict(orient='records')
+    bad = [dict(good[0], sum_insured='unknown')]
+
+    # A long wait puts both requests in one micro-batch.
+    scorer = BatchScorer(rating, max_wait=0.5)
+    results = {}
+
+    def send(name, records):
+        try:
+            results[name] = scorer.score(records)
+        except Exception as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=send, args=args)
+               for args in (('good', good), ('bad', bad))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert isinstance(results['bad'], ValueError)
+    expected = rating.score(policies)
+    pd.testing.assert_frame_equal(results['good'], expected)
+
+
+def test_binned_table_survives_save_and_load(book, tmp_path):
+    schema, features, counts = book
+    model = HistGradientBoostingRegressor(max_iter=10, random_state=0)
+    model.fit(features, counts)
+    rating = RatingModel(schema,
+                         {'E[N]': RatingTable.from_model(model, features)})
+    rating.save(str(tmp_path / 'rating.npz'))
+    loaded = RatingModel.load(str(tmp_path / 'rating.npz'))
+
+    test, _ = generate_book(200, seed=3)
+    test['sum_insured'] = 5e6
+    pd.testing.assert_frame_equal(loaded.score(test), rating.score(test))
+
+
+def test_fit_returns_predictions_when_table_is_too_large(book, monkeypatch,
+                                                         tmp_path):
+    schema, features, counts = book
+    monkeypatch.setattr(scoring, 'MAX_CELLS', 1)
+    monkeypatch.chdir(tmp_path)
+    fitted = models._fit_and_predict(
+        models.build_slm, pd.Series(counts, index=features.index),
+        features, None, features, 'slm_freq', tables=True)
+    assert fitted.table is None
+    assert len(fitted.predictions) == len(features)
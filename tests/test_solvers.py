@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from solvers import fit_glm, fit_glm_batches, fit_ols, fit_ols_batches
+
+
+def test_ols_batches_match_single_fit():
+    rng = np.random.default_rng(0)
+    X = np.column_stack([np.ones(1000), rng.normal(size=(1000, 3))])
+    y = X @ np.array([1.0, 2.0, -1.0, 0.5]) + rng.normal(size=1000)
+
+    def batches():
+        return [(X[:400], y[:400], None), (X[400:], y[400:], None)]
+
+    np.testing.assert_allclose(fit_ols_batches(batches).params,
+                               fit_ols(X, y).params)
+
+
+def test_glm_batches_match_single_fit():
+    rng = np.random.default_rng(0)
+    X = np.column_stack([np.ones(1000), rng.integers(2, size=(1000, 2))])
+    y = rng.poisson(np.exp(X @ np.array([-1.0, 0.5, -0.3])))
+
+    def batches():
+        return [(X[:300], y[:300], None), (X[300:], y[300:], None)]
+
+    np.testing.assert_allclose(
+        fit_glm_batches(batches, 'poisson', 'log').params,
+        fit_glm(X, y, 'poisson', 'log').params, rtol=1e-6)
+
+
+def test_fits_on_no_batches_raise():
+    with pytest.raises(ValueError):
+        fit_ols_batches(lambda: [])
+    with pytest.raises(ValueError):
+        fit_glm_batches(lambda: [], 'poisson', 'log')
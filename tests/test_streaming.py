@@ -0,0 +1,70 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from features import FeatureSchema, aggregate_claims, unique_policies
+from models import build_glm_freq, build_glm_sev, build_slm
+from solvers import fit_glm_batches, fit_ols_batches
+from streaming import (build_mlm_batches, claim_statistics,
+                       training_batches)
+from synthetic import generate_book
+
+
+@pytest.fixture(scope='module')
+def book():
+    policies, claims = generate_book(3000, seed=0)
+    # Claims without an amount count but have no severity.
+    claims.loc[claims.index[:5], 'claim_amount'] = np.nan
+    schema = FeatureSchema.fit(policies)
+    features = unique_policies(schema.transform_frame(policies))
+
+    def source():
+        for start in range(0, len(policies), 1000):
+            yield policies.iloc[start:start + 1000]
+
+    freq, sev = training_batches(source, schema, claim_statistics(claims))
+    return features, aggregate_claims(features, claims), freq, sev
+
+
+def test_streaming_targets_match_aggregate_claims(book):
+    features, targets, freq, sev = book
+    counts = np.concatenate([y for _, y, _ in freq()])
+    np.testing.assert_allclose(counts, targets.counts)
+    # The severity covers the same policies, those with a claim.
+    averages = np.concatenate([y for _, y, _ in sev()])
+    assert sum(len(X) for X, _, _ in sev()) == len(targets.averages)
+    np.testing.assert_allclose(averages, targets.averages)
+
+
+@pytest.mark.parametrize('build, streaming, target', [
+    (build_slm, fit_ols_batches, 'counts'),
+    (build_slm, fit_ols_batches, 'averages'),
+    (build_glm_freq, partial(fit_glm_batches, variance='poisson',
+                             link='log'), 'counts'),
+    (build_glm_sev, partial(fit_glm_batches, variance='gamma',
+                            link='identity'), 'averages'),
+])
+def test_streaming_fit_matches_in_memory_fit(book, build, streaming, target):
+    features, targets, freq, sev = book
+    dep = getattr(targets, target)
+    in_memory = build(dep, features.loc[dep.index])
+    fitted = streaming(freq if target == 'counts' else sev)
+    assert getattr(in_memory, 'converged', True) == fitted.converged
+    np.testing.assert_allclose(fitted.params, in_memory.params, rtol=1e-6)
+
+
+def test_streaming_mlm_learns_an_interaction():
+    # The target depends on the product of two flags, which no linear
+    # model of the flags alone can fit.
+    rng = np.random.default_rng(0)
+    X = rng.integers(2, size=(20000, 2)).astype(float)
+    y = 3.0 * X[:, 0] * X[:, 1]
+
+    def batches():
+        return [(X[i:i + 5000], y[i:i + 5000], None)
+                for i in range(0, len(X), 5000)]
+
+    model = build_mlm_batches(batches)
+    grid = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    np.testing.assert_allclose(model.predict(grid), [0, 0, 0, 3], atol=0.3)
@@ -0,0 +1,122 @@
+import pandas as pd
+import pytest
+
+from cyutils.address.gazetteer import (FENCE_STRIDE, STREET_WIDTH,
+                                       Gazetteer, build_gazetteer,
+                                       street_key)
+from cyutils.address.structured import (StructuredAddress, parse_structured,
+                                        parse_structured_addresses)
+
+LONG_STREET = 'Llanfairpwllgwyngyllgogerychwyrndrobwllllantysiliogogogoch Rd'
+
+# Several fences' worth of postcodes, each with one to three streets, so
+# keys fall on, next to and between the fences.
+RECORDS = [
+    ('AB{} {}CD'.format(district, sector), 'Street {} Rd'.format(street),
+     'Town {}'.format(district))
+    for district in range(10, 60)
+    for sector in range(1, 4)
+    for street in range(sector)
+] + [
+    ('SW3 4XD', 'Bywater St', 'London'),
+    ('SW3 4XD', 'Markham St', 'London'),
+    ('EC1A 1BB', LONG_STREET, 'London'),
+]
+
+
+@pytest.fixture(scope='module')
+def gazetteer(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('gazetteer') / 'gb.idx')
+    assert build_gazetteer(RECORDS + RECORDS[:5], path) == len(RECORDS)
+    with Gazetteer(path) as gazetteer:
+        yield gazetteer
+
+
+def test_gazetteer_spans_several_fences(gazetteer):
+    assert len(gazetteer) == len(RECORDS)
+    assert len(gazetteer) > 4 * FENCE_STRIDE
+
+
+def test_every_record_is_found(gazetteer):
+    for postcode, street, town in RECORDS:
+        assert gazetteer.contains(postcode.replace(' ', '').lower(), street)
+        stored = [(entry.street, entry.town)
+                  for entry in gazetteer.entries(postcode)]
+        assert (street_key(street)[:STREET_WIDTH], town.upper()) in stored
+
+
+@pytest.mark.parametrize('postcode', ['AA1 1AA', 'AB10 9ZZ', 'AB33 0AA',
+                                      'AB99 1CD', 'ZZ99 9ZZ'])
+def test_missing_postcodes_are_not_found(gazetteer, postcode):
+    assert gazetteer.entries(postcode) == []
+    assert not gazetteer.contains(postcode)
+
+
+def test_contains_agrees_with_entries(gazetteer):
+    postcodes = {postcode for postcode, _, _ in RECORDS}
+    for postcode in sorted(postcodes):
+        entries = gazetteer.entries(postcode)
+        assert len(entries) == sum(record[0] == postcode
+                                   for record in RECORDS)
+        assert [entry.street for entry in entries] == \
+            sorted(entry.street for entry in entries)
+        for entry in entries:
+            assert gazetteer.contains(postcode, entry.street)
+        assert not gazetteer.contains(postcode, 'Nowhere Lane')
+    # A street under another postcode is not a match.
+    assert not gazetteer.contains('SW3 4XD', 'Street 0 Road')
+
+
+def test_long_streets_are_truncated_alike(gazetteer):
+    entry, = gazetteer.entries('EC1A 1BB')
+    assert len(entry.street) == STREET_WIDTH
+    assert gazetteer.contains('EC1A 1BB', LONG_STREET)
+
+
+def test_index_of_another_format_is_rejected(tmp_path):
+    path = tmp_path / 'other.idx'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        Gazetteer(str(path))
+
+
+def test_parse_structured_splits_the_parts():
+    assert parse_structured('Flat 2, 14 St Johns Rd, Chelsea, '
+                            'London SW3 4XD') == StructuredAddress(
+        'FLAT 2', '', '14', 'ST JOHNS ROAD', 'CHELSEA', 'LONDON', 'SW3 4XD',
+        None, None)
+
+
+def test_parse_structured_infers_the_town_from_the_gazetteer(gazetteer):
+    # Without a gazetteer the locality runs into the town.
+    address = '9 Bywater St Chelsea London SW3 4XD'
+    assert parse_structured(address).town == 'CHELSEA LONDON'
+    parsed = parse_structured(address, gazetteer)
+    assert (parsed.locality, parsed.town) == ('CHELSEA', 'LONDON')
+    assert parsed.postcode_valid and parsed.street_valid
+
+    # Without any area, the town is the gazetteer's.
+    parsed = parse_structured('12 Street 1 Rd AB10 2CD', gazetteer)
+    assert (parsed.locality, parsed.town) == ('', 'TOWN 10')
+
+
+def test_parse_structured_validates_against_the_gazetteer(gazetteer):
+    parsed = parse_structured('1 {}, London EC1A 1BB'.format(LONG_STREET),
+                              gazetteer)
+    assert parsed.postcode_valid and parsed.street_valid
+
+    parsed = parse_structured('4 Markham Rd, London SW3 4XD', gazetteer)
+    assert parsed.postcode_valid and not parsed.street_valid
+
+    parsed = parse_structured('4 Markham St, London ZZ9 9ZZ', gazetteer)
+    assert not parsed.postcode_valid and not parsed.street_valid
+
+
+def test_parse_structured_addresses_keeps_the_index():
+    addresses = pd.Series(['Rose Cottage 3 Mill Lane Little Snoring',
+                           'Unit 14 High Street, Leeds LS1 4AB'],
+                          index=[7, 9])
+    parsed = parse_structured_addresses(addresses)
+    assert list(parsed.index) == [7, 9]
+    assert list(parsed['building_name']) == ['ROSE COTTAGE', '']
+    assert list(parsed['sub_building']) == ['', 'UNIT 14']
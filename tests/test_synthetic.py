@@ -0,0 +1,19 @@
+import pandas as pd
+
+from loader import LocalBucket, read_frame
+from synthetic import BOOK_FILES, generate_book, write_book
+
+
+def test_write_book_streams_the_generated_book(tmp_path):
+    write_book(str(tmp_path), 2500, n_test=700, seed=3, chunk_size=1000)
+    bucket = LocalBucket(str(tmp_path))
+    policies, claims = generate_book(2500, seed=3, chunk_size=1000)
+
+    def read(name):
+        return read_frame(bucket.blob(f'bedrock/{BOOK_FILES[name]}'))
+
+    pd.testing.assert_frame_equal(read('policies'), policies)
+    pd.testing.assert_frame_equal(read('claims'), claims)
+    test = read('test')
+    assert len(test) == 700
+    assert test['pol_id'].iloc[0] == 2501